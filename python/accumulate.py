@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import pandas as pd
+import numpy as np
+
+'''
+Vectorized accumulation of station and forecasted precipitation over accumulation windows (e.g. 1, 3, 6, 12 and 24 hours) for all stations
+and forecast hours at once.
+'''
+
+
+def accumulateWindows(df, stations, leads, accumHours, product, idCol='ExtSiteID', timeCol='DateTime of forecast',
+                      stationCol='Station precipitation [mm]', productCol='MetService product'):
+    '''
+    Accumulates station and forecasted precipitation per station, forecast hour and accumulation window. For each forecast hour only the
+    timestamps with both a station and a forecasted value are used. The windows are aligned to midnight, closed on the left and labelled with
+    their right edge, and windows without data are left out; this is the same as resample(str(ah)+'H', label='right').sum() per station
+    and forecast hour. The sums are calculated with pandas' grouped sum over the values in time order, which gives the same numbers
+    as the per-station resample.
+
+    Input:
+    ------
+        df:         Dataframe with the station precipitation and a column with the forecasted precipitation for each forecast hour
+        stations:   List with station IDs to include (the output has the order of this list)
+        leads:      List with the names of the forecast hour columns to include (e.g. ['1', '2', ..., '24'])
+        accumHours: List with accumulation windows in hours; each must be a divisor of 24
+        product:    Name of the MetService product
+
+    Optional Input:
+    ---------------
+        idCol:      Name of the station ID column
+        timeCol:    Name of the timestamp column
+        stationCol: Name of the station precipitation column
+        productCol: Name of the product column
+
+    Returns:
+    --------
+        df_accum:   Dataframe with the columns 'DateTime of forecast', 'Forecasted hours', 'Accum. hours', 'ExtSiteID', 'MetService product',
+                    'Accum. station precipitation [mm]', 'Accum. forecasted precipitation [mm]' and 'Hcount', ordered by forecast hour, station,
+                    accumulation window and time.
+    '''
+    columns = ['DateTime of forecast', 'Forecasted hours', 'Accum. hours', 'ExtSiteID', 'MetService product', 'Accum. station precipitation [mm]',
+               'Accum. forecasted precipitation [mm]', 'Hcount']
+    for ah in accumHours:
+        if 24 % ah:
+            raise ValueError('Accumulation window of %s hours is not a divisor of 24' %ah)
+    stations = pd.Index(stations)
+    df = df.loc[df[idCol].isin(stations)]
+
+    #-(rows x forecast hours) matrix and the rows that have a value for both the station and the forecast
+    fc = df[leads].to_numpy(dtype=np.float64)
+    obs = df[stationCol].to_numpy(dtype=np.float64)
+    rowOk = df[[idCol, timeCol, productCol]].notna().all(axis=1).to_numpy() & ~np.isnan(obs)
+    ok = rowOk[:, None] & ~np.isnan(fc)
+    r, l = np.nonzero(ok)
+    st = stations.get_indexer(df[idCol])[r]
+    t = df[timeCol].to_numpy(dtype='datetime64[ns]')[r]
+    #-sort by forecast hour, station and time
+    order = np.lexsort((r, t, st, l))
+    long_df = pd.DataFrame({'lead': l[order], 'st': st[order], 't': t[order], 'obs': obs[r][order], 'fc': fc[r, l][order]})
+    r = None; l = None; st = None; t = None; ok = None
+
+    results = []
+    for k, ah in enumerate(accumHours):
+        #-right edge of the window that each timestamp falls in
+        label = long_df['t'].dt.floor(str(ah) + 'h') + pd.Timedelta(hours=ah)
+        grouped = long_df[['obs', 'fc']].groupby([long_df['lead'], long_df['st'], label.rename('label')], sort=True)
+        sums = grouped.sum()
+        sums['Hcount'] = grouped.size()
+        sums = sums.reset_index()
+        sums['ah'] = k
+        results.append(sums)
+    acc = pd.concat(results, ignore_index=True)
+    results = None
+    #-order by forecast hour, station, accumulation window and time
+    acc = acc.iloc[np.lexsort((acc['label'].to_numpy(), acc['ah'].to_numpy(), acc['st'].to_numpy(), acc['lead'].to_numpy()))]
+
+    df_accum = pd.DataFrame({columns[0]: acc['label'].to_numpy(),
+                             columns[1]: np.asarray([int(h) for h in leads])[acc['lead'].to_numpy()],
+                             columns[2]: np.asarray(accumHours)[acc['ah'].to_numpy()],
+                             columns[3]: stations[acc['st'].to_numpy()],
+                             columns[4]: product,
+                             columns[5]: acc['obs'].to_numpy(),
+                             columns[6]: acc['fc'].to_numpy(),
+                             columns[7]: acc['Hcount'].to_numpy()}, columns=columns)
+    return df_accum
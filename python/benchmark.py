@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+
+import pandas as pd
+import numpy as np
+import xarray as xr
+import os, glob, json, time, platform, subprocess
+import multiprocessing as mp
+from instrument import peakRSS
+from timeutils import utcToLocal
+
+'''
+Benchmark suite for the pipeline. Generates synthetic MetService-like netCDF files (accumulated 'precipitation_amount' on a lat/lon grid
+with the resolution of the product, 85 forecast hours), matching station_xy.csv and station_ts.csv files, and station and catchment
+shapefiles, and times each stage (process_nc, combine_station_forecast, organize_for_plots PART 1, PART 2 and statistics) at several data
+scales. As in organize_for_plots.py, the station to catchment membership is determined (spatial join) in PART 1 and read from its cache in
+the later stages.
+
+Each stage runs in its own process, so that the peak resident memory (RSS) is that of the stage alone; the stages hand over their results
+through pickle files in the work directory. For each stage the run time, the number of processed items, the throughput and the peak RSS are
+appended as one JSON record per line to the results file, together with the git commit and the package versions. compareResults prints the
+change of each stage against the previous results for the same product and scale.
+'''
+
+#-approximate grid resolution (degrees latitude, degrees longitude) of the MetService products over New Zealand
+products = {'ECMWF_8km': (0.072, 0.096), 'NCEP_4km': (0.036, 0.048), 'NCEP_8km': (0.072, 0.096), 'UKMO_8km': (0.072, 0.096)}
+#-domain of the synthetic products (latitude min, latitude max, longitude min, longitude max)
+domain = (-48., -34., 165., 179.)
+#-data scales: number of forecast runs (one every 6 hours) and number of stations
+scales = {'small': {'runs': 4, 'stations': 50}, 'medium': {'runs': 16, 'stations': 200}, 'large': {'runs': 64, 'stations': 500}}
+#-Canterbury extent (NZTM) in which the synthetic stations are located, as in process_nc.py
+extent = (1323766.5234000002965331 - 5000, 5004696.7684000004082918 - 5000, 1692368.8068000003695488 + 5000, 5361879.5686999997124076 + 5000)
+nleads = 85
+#-number of synthetic catchments and their radius (m); overlapping circles within the Canterbury extent, as the buffered catchments
+ncatchments = 46
+catchmentRadius = 60000.
+accumHours = [1, 3, 6, 12, 24]
+timeZone = 'Pacific/Auckland'
+stages = ['process_nc', 'combine_station_forecast', 'organize_part1', 'organize_part2', 'organize_stats']
+
+
+def makeNetCDF(ncF, runTime, lat, lon, rng):
+    '''
+    Writes a synthetic MetService-like netCDF file with accumulated precipitation for nleads forecast hours.
+
+    Input:
+    ------
+        ncF:     Full path of the netCDF file (*.nc)
+        runTime: UTC timestamp of the forecast run
+        lat:     Array with the latitudes of the grid rows
+        lon:     Array with the longitudes of the grid columns
+        rng:     NumPy random generator
+    '''
+    times = pd.date_range(runTime, periods=nleads+1, freq='h')
+    #-intermittent hourly precipitation with some spatial structure
+    wet = rng.random((nleads, len(lat), 1)) < 0.3
+    hourly = (rng.gamma(0.6, 1.5, (nleads, len(lat), len(lon))) * wet).astype(np.float32)
+    accum = np.concatenate([np.zeros((1, len(lat), len(lon)), dtype=np.float32), np.cumsum(hourly, axis=0)])
+    lat2, lon2 = np.meshgrid(lat, lon, indexing='ij')
+    ds = xr.Dataset({'precipitation_amount': (('time', 'south_north', 'west_east'), accum, {'units': 'mm'})},
+                    coords={'time': times, 'latitude': (('south_north', 'west_east'), lat2), 'longitude': (('south_north', 'west_east'), lon2)})
+    ds.to_netcdf(ncF)
+
+def makeStations(fixtureDir, nstations, from_date, to_date, rng):
+    '''
+    Writes synthetic station_xy.csv and station_ts.csv files with stations within the Canterbury extent.
+
+    Input:
+    ------
+        fixtureDir: Directory where the files are written
+        nstations:  Number of stations
+        from_date:  First timestamp of the time-series
+        to_date:    Last timestamp of the time-series
+        rng:        NumPy random generator
+    '''
+    ids = ['S%05d' %i for i in range(nstations)]
+    xmin, ymin, xmax, ymax = extent
+    pd.DataFrame({'ExtSiteID': ids, 'NZTMX': rng.uniform(xmin+20000, xmax-20000, nstations),
+                  'NZTMY': rng.uniform(ymin+20000, ymax-20000, nstations)}).to_csv(os.path.join(fixtureDir, 'station_xy.csv'), index=False)
+    t = pd.date_range(from_date, to_date, freq='h')
+    values = rng.gamma(0.6, 1.5, (nstations, len(t))) * (rng.random((nstations, len(t))) < 0.3)
+    #-some missing records
+    keep = rng.random((nstations, len(t))) > 0.05
+    s, h = np.nonzero(keep)
+    pd.DataFrame({'ExtSiteID': np.asarray(ids)[s], 'DateTime': t[h], 'Value': np.round(values[s, h], 1)}).to_csv(
+        os.path.join(fixtureDir, 'station_ts.csv'), index=False)
+
+def makeCatchments(fixtureDir, rng):
+    '''
+    Writes a point shapefile with the stations of station_xy.csv (stations.shp) and a polygon shapefile with ncatchments overlapping
+    circular catchments within the Canterbury extent (catchments.shp), both in NZTM (EPSG:2193).
+
+    Input:
+    ------
+        fixtureDir: Directory with station_xy.csv, where the shapefiles are written
+        rng:        NumPy random generator
+    '''
+    import geopandas as gpd
+    statXY_df = pd.read_csv(os.path.join(fixtureDir, 'station_xy.csv'))
+    gpd.GeoDataFrame(statXY_df[['ExtSiteID']], geometry=gpd.points_from_xy(statXY_df['NZTMX'], statXY_df['NZTMY']), crs='EPSG:2193').to_file(
+        os.path.join(fixtureDir, 'stations.shp'))
+    xmin, ymin, xmax, ymax = extent
+    centres = gpd.GeoSeries(gpd.points_from_xy(rng.uniform(xmin, xmax, ncatchments), rng.uniform(ymin, ymax, ncatchments)))
+    gpd.GeoDataFrame({'CATCH_NAME': ['Catchment %02d' %i for i in range(ncatchments)]}, geometry=centres.buffer(catchmentRadius),
+                     crs='EPSG:2193').to_file(os.path.join(fixtureDir, 'catchments.shp'))
+
+def makeFixtures(benchDir, product, scale, seed=1):
+    '''
+    Generates the synthetic netCDF files, station files and shapefiles for a product and scale, unless they exist already.
+
+    Input:
+    ------
+        benchDir: Directory of the benchmark
+        product:  Name of the product (key of products)
+        scale:    Name of the data scale (key of scales)
+
+    Optional Input:
+    ---------------
+        seed:     Seed of the random generator
+
+    Returns:
+    --------
+        fixtureDir: Directory with the fixtures
+    '''
+    fixtureDir = os.path.join(benchDir, 'fixtures', product + '_' + scale)
+    ncDir = os.path.join(fixtureDir, 'nc')
+    nruns = scales[scale]['runs']
+    if os.path.isdir(ncDir) and len(glob.glob(os.path.join(ncDir, '*.nc'))) == nruns:
+        if not os.path.isfile(os.path.join(fixtureDir, 'catchments.shp')):
+            makeCatchments(fixtureDir, np.random.default_rng(seed))
+        return fixtureDir
+    os.makedirs(ncDir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    dlat, dlon = products[product]
+    lat = np.arange(domain[0], domain[1] + dlat/2, dlat)
+    lon = np.arange(domain[2], domain[3] + dlon/2, dlon)
+    runTimes = pd.date_range('2019-01-01 00:00', periods=nruns, freq='6h')
+    for runTime in runTimes:
+        makeNetCDF(os.path.join(ncDir, product + '_' + runTime.strftime('%Y%m%d%H') + '.nc'), runTime, lat, lon, rng)
+    local = utcToLocal([runTimes[0], runTimes[-1] + pd.Timedelta(hours=nleads)], timeZone)
+    makeStations(fixtureDir, scales[scale]['stations'], local[0].floor('D'), local[1].ceil('D'), rng)
+    makeCatchments(fixtureDir, rng)
+    return fixtureDir
+
+def _stationSetup(fixtureDir):
+    statXY_df = pd.read_csv(os.path.join(fixtureDir, 'station_xy.csv'))
+    statIDs = pd.unique(statXY_df.ExtSiteID).tolist()
+    statXY_df = statXY_df.drop_duplicates(subset='ExtSiteID').set_index('ExtSiteID').loc[statIDs]
+    return statIDs, statXY_df['NZTMX'].to_numpy(dtype=np.float64), statXY_df['NZTMY'].to_numpy(dtype=np.float64)
+
+def stageProcessNc(fixtureDir, workDir):
+    #-regrid all forecast hours onto the 1 km Canterbury grid and write the GTiffs, as process_nc.py (arrayMode, serial)
+    import process_nc
+    from gridtools import gridNZTM, gridWeights
+    from nctools import readPrecipCube
+    ncFiles = sorted(glob.glob(os.path.join(fixtureDir, 'nc', '*.nc')))
+    tifDir = os.path.join(workDir, 'tif')
+    os.makedirs(tifDir, exist_ok=True)
+    cacheDir = os.path.join(workDir, 'grid_cache')
+    times, cube, lat, lon = readPrecipCube(ncFiles[0]); cube = None
+    X, Y = gridNZTM(lat.ravel(), lon.ravel(), cacheDir)
+    W, inside = gridWeights(X, Y, process_nc.xc, process_nc.yc, cacheDir, bounds=extent)
+    process_nc.initWorker({'tifDir': tifDir, 'tempDir': workDir, 'vrtFile': None, 'arrayMode': True, 'timeZone': timeZone, 'X': X, 'Y': Y, 'W': W,
+                           'inside': inside, 'geoTrans': process_nc.geoTrans, 'shape': process_nc.xc.shape, 'bounds': extent,
+                           'outputFormat': 'gtiff', 'cubeFile': None, 'chunks': None})
+    n = 0
+    for ncF in ncFiles:
+        ncF, outputs, error, run = process_nc.convertNcFile(ncF)
+        if error:
+            raise RuntimeError(error)
+        n += len(outputs)
+    return n
+
+def stageCombine(fixtureDir, workDir):
+    #-station forecasts (sparse matrix of stations x hours x forecast hours) from the netCDF files, as combine_station_forecast.py with
+    #-inputFormat = 'nc'
+    from nctools import readPrecipCube, iterNcSamples
+    from forecastmatrix import newForecastMatrix, fillForecasts, toDataFrame
+    from gridtools import gridNZTM, targetGrid, gridWeights
+    from sampling import stationPixelIndex
+    statIDs, statX, statY = _stationSetup(fixtureDir)
+    statTS_df = pd.read_csv(os.path.join(fixtureDir, 'station_ts.csv'), parse_dates=[1])
+    datetime_range = pd.date_range(statTS_df['DateTime'].min(), statTS_df['DateTime'].max(), freq='h')
+    statTS_df = statTS_df.drop_duplicates(subset=['ExtSiteID', 'DateTime'], keep='first')
+    statValues = np.full((len(statIDs), len(datetime_range)), np.nan)
+    statValues[pd.Index(statIDs).get_indexer(statTS_df.ExtSiteID), datetime_range.get_indexer(statTS_df.DateTime)] = statTS_df['Value'].to_numpy()
+    statTS_df = None
+    ncFiles = sorted(glob.glob(os.path.join(fixtureDir, 'nc', '*.nc')))
+    cacheDir = os.path.join(workDir, 'grid_cache')
+    times, cube, lat, lon = readPrecipCube(ncFiles[0]); cube = None
+    srcX, srcY = gridNZTM(lat.ravel(), lon.ravel(), cacheDir)
+    xmin, ymin, xmax, ymax = extent
+    geoTrans, xc, yc = targetGrid(xmin, ymin, xmax, ymax, np.ceil((xmax-xmin)/1000.), np.ceil((ymax-ymin)/1000.))
+    row, col, valid = stationPixelIndex(geoTrans, xc.shape[0], xc.shape[1], statX, statY)
+    W, inside = gridWeights(srcX, srcY, xc[row, col], yc[row, col], cacheDir, bounds=extent)
+    matrix = newForecastMatrix(len(statIDs), len(datetime_range), nleads)
+    n = fillForecasts(matrix, iterNcSamples(ncFiles, W, inside, timeZone, valid=valid), datetime_range, statValues)
+    df = toDataFrame(matrix, statIDs, datetime_range, statValues, 'synthetic', [str(i) for i in range(1, nleads+1)])
+    df.to_pickle(os.path.join(workDir, 'combined.pkl'))
+    return n
+
+def _membership(fixtureDir, workDir):
+    #-station to catchment membership from the shapefiles (spatial join), cached in the work directory as in organize_for_plots.py
+    from catchments import catchmentMembership
+    membership = catchmentMembership(os.path.join(fixtureDir, 'stations.shp'), os.path.join(fixtureDir, 'catchments.shp'),
+                                     os.path.join(workDir, 'cache'))
+    return membership, ['Catchment %02d' %i for i in range(ncatchments)]
+
+def stageOrganizePart1(fixtureDir, workDir):
+    #-percent errors of all stations, of the stations per catchment and of the catchment averages, as organize_for_plots.py PART 1
+    from verification import percentError
+    from catchments import joinCatchments, catchmentAverage
+    df = pd.read_pickle(os.path.join(workDir, 'combined.pkl'))
+    membership, catchments = _membership(fixtureDir, workDir)
+    cols = [str(i) for i in range(1, nleads+1)]
+    df['Month'] = df['DateTime of forecast'].dt.month
+    df_canterbury = percentError(df, cols, [c for c in df.columns if c not in cols])
+    df_catchment = joinCatchments(df_canterbury, membership)
+    df_avg = catchmentAverage(joinCatchments(df[['ExtSiteID', 'DateTime of forecast', 'Station precipitation [mm]', 'Month'] + cols], membership),
+                              ['DateTime of forecast'], ['Station precipitation [mm]'] + cols + ['Month'], catchments)
+    df_avg = percentError(df_avg, cols, ['Catchment', 'DateTime of forecast', 'Station precipitation [mm]', 'Month'])
+    return len(df_canterbury) + len(df_catchment) + len(df_avg)
+
+def stageOrganizePart2(fixtureDir, workDir):
+    #-accumulation windows of all stations and catchment averages, as organize_for_plots.py PART 2
+    from accumulate import accumulateWindows
+    from catchments import joinCatchments, catchmentAverage
+    df = pd.read_pickle(os.path.join(workDir, 'combined.pkl'))
+    statIDs, statX, statY = _stationSetup(fixtureDir)
+    membership, catchments = _membership(fixtureDir, workDir)
+    cols = [str(i) for i in range(1, 24+1)]
+    n = len(df)
+    df_canterbury = accumulateWindows(df, statIDs, cols, accumHours, 'synthetic'); df = None
+    df_canterbury.rename(columns={'Accum. station precipitation [mm]': 'Accum. catchment precipitation [mm]'}, inplace=True)
+    df_avg = catchmentAverage(joinCatchments(df_canterbury, membership), ['DateTime of forecast', 'Forecasted hours', 'Accum. hours'],
+                              ['Accum. catchment precipitation [mm]', 'Accum. forecasted precipitation [mm]', 'Hcount'], catchments)
+    df_canterbury.to_pickle(os.path.join(workDir, 'cumsum_stations.pkl'))
+    df_avg.to_pickle(os.path.join(workDir, 'cumsum_catchments.pkl'))
+    return n
+
+def stageOrganizeStats(fixtureDir, workDir):
+    #-verification statistics of all stations and of the catchment averages, as organize_for_plots.py
+    from verification import groupSums, statsFromSums
+    df = pd.read_pickle(os.path.join(workDir, 'cumsum_stations.pkl'))
+    df_avg = pd.read_pickle(os.path.join(workDir, 'cumsum_catchments.pkl'))
+    statsFromSums(groupSums(df, ['Forecasted hours', 'Accum. hours'], 'Accum. catchment precipitation [mm]', 'Accum. forecasted precipitation [mm]'))
+    statsFromSums(groupSums(df_avg, ['Catchment', 'Forecasted hours', 'Accum. hours'], 'Accum. catchment precipitation [mm]',
+                            'Accum. forecasted precipitation [mm]'))
+    return len(df) + len(df_avg)
+
+stageFunctions = {'process_nc': stageProcessNc, 'combine_station_forecast': stageCombine, 'organize_part1': stageOrganizePart1,
+                  'organize_part2': stageOrganizePart2, 'organize_stats': stageOrganizeStats}
+
+def _runStage(stage, fixtureDir, workDir, results):
+    t0 = time.perf_counter()
+    n = stageFunctions[stage](fixtureDir, workDir)
+    results.put((time.perf_counter() - t0, n, peakRSS()))
+
+def runStage(stage, fixtureDir, workDir):
+    '''
+    Runs a stage in a separate process and measures the run time and peak memory.
+
+    Input:
+    ------
+        stage:      Name of the stage (key of stageFunctions)
+        fixtureDir: Directory with the fixtures
+        workDir:    Work directory where the stages hand over their results
+
+    Returns:
+    --------
+        [seconds, items, peakRSS]: run time of the stage, number of processed items (GTiffs, forecast hours or table rows), and the peak
+                                   resident memory in MB
+    '''
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    p = ctx.Process(target=_runStage, args=(stage, fixtureDir, workDir, results))
+    p.start()
+    p.join()
+    if p.exitcode != 0:
+        raise RuntimeError('Stage %s failed with exit code %s' %(stage, p.exitcode))
+    return results.get()
+
+def environment():
+    '''
+    Returns the git commit and the versions of Python and the main packages, to be stored with the results.
+    '''
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__, 'xarray': xr.__version__,
+            'machine': platform.node()}
+
+def runBenchmark(benchDir, productList, scaleList, stageList=stages, resultsFile=None):
+    '''
+    Runs the benchmark for all combinations of products and scales and appends the results to the results file (one JSON record per line).
+
+    Input:
+    ------
+        benchDir:    Directory of the benchmark (fixtures and work directories are created in it)
+        productList: List with product names (keys of products)
+        scaleList:   List with data scales (keys of scales)
+
+    Optional Input:
+    ---------------
+        stageList:   List with the stages to run; later stages use the results of earlier stages
+        resultsFile: Full path to the results file (default benchDir/results.jsonl)
+
+    Returns:
+    --------
+        df: Dataframe with the results of this benchmark run
+    '''
+    resultsFile = resultsFile or os.path.join(benchDir, 'results.jsonl')
+    env = environment()
+    started = pd.Timestamp.now().isoformat(timespec='seconds')
+    records = []
+    for product in productList:
+        for scale in scaleList:
+            print('Generating fixtures %s %s' %(product, scale))
+            fixtureDir = makeFixtures(benchDir, product, scale)
+            workDir = os.path.join(benchDir, 'work', product + '_' + scale)
+            os.makedirs(workDir, exist_ok=True)
+            for stage in stageList:
+                seconds, n, rss = runStage(stage, fixtureDir, workDir)
+                record = {'started': started, 'product': product, 'scale': scale, 'stage': stage, 'seconds': seconds, 'items': n,
+                          'items_per_second': n / seconds if seconds > 0 else None, 'peak_rss_mb': rss}
+                record.update(env)
+                records.append(record)
+                print('%-10s %-7s %-25s %8.2f s %10d items %10.1f items/s %8.1f MB' %(product, scale, stage, seconds, n, n / max(seconds, 1e-9), rss or np.nan))
+                with open(resultsFile, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+    return pd.DataFrame(records)
+
+def compareResults(resultsFile, tolerance=0.2):
+    '''
+    Compares the latest benchmark run with the previous run for each product, scale and stage, and flags regressions in run time or
+    peak memory that are larger than tolerance.
+
+    Input:
+    ------
+        resultsFile: Full path to the results file
+
+    Optional Input:
+    ---------------
+        tolerance:   Relative increase (e.g. 0.2 is 20%) above which a change is flagged as regression
+
+    Returns:
+    --------
+        df: Dataframe with the latest and previous run time and peak memory per product, scale and stage, the relative changes and a
+            'regression' column
+    '''
+    with open(resultsFile) as f:
+        df = pd.DataFrame([json.loads(line) for line in f if line.strip()])
+    keys = ['product', 'scale', 'stage']
+    df = df.sort_values('started', kind='stable')
+    latest = df.groupby(keys).nth(-1).set_index(keys)
+    previous = df.groupby(keys).nth(-2).set_index(keys)
+    comp = latest[['commit', 'seconds', 'peak_rss_mb']].join(previous[['commit', 'seconds', 'peak_rss_mb']], rsuffix='_previous', how='left')
+    comp['seconds_change'] = comp['seconds'] / comp['seconds_previous'] - 1
+    comp['peak_rss_change'] = comp['peak_rss_mb'] / comp['peak_rss_mb_previous'] - 1
+    comp['regression'] = (comp['seconds_change'] > tolerance) | (comp['peak_rss_change'] > tolerance)
+    return comp.reset_index()
+
+
+if __name__ == '__main__':
+    #-Directory of the benchmark
+    benchDir = r'C:\Active\Projects\MetService_precip_analysis\Data\benchmark'
+    #-products, scales and stages to run
+    productList = ['NCEP_8km']
+    scaleList = ['small', 'medium']
+    stageList = stages
+    #-relative increase in run time or peak memory that is flagged as regression
+    tolerance = 0.2
+
+    runBenchmark(benchDir, productList, scaleList, stageList)
+    comp = compareResults(os.path.join(benchDir, 'results.jsonl'), tolerance=tolerance)
+    print(comp.to_string(index=False))
+    if comp['regression'].any():
+        print('Regressions found')
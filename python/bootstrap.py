@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+import pandas as pd
+import numpy as np
+import warnings, multiprocessing, threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from verification import statsFromArrays
+
+'''
+Bootstrap confidence intervals of the verification statistics (R-squared, RMSE and bias). The rows are ordered by group, and for a batch of
+groups the resample indices of all groups and resamples are drawn at once as one (resamples x rows) matrix, where each column draws from
+the rows of its own group. The sufficient statistics of all resamples and groups are then summed per group segment (np.add.reduceat) and
+the statistics are derived in closed form (see verification.statsFromArrays), so no regression model is fitted per resample. The batches
+are distributed over worker processes; each batch has its own random stream spawned from one seed, so the intervals do not depend on the
+number of workers.
+'''
+
+#-maximum number of drawn indices (resamples x rows) that is in memory at once per worker
+maxElements = 4000000
+
+#-worker state: the observations ordered by group and the group sizes
+_worker = {}
+
+
+def initWorker(x, y, h, counts):
+    '''
+    Sets the observations of the worker (process). The observations are ordered by group.
+
+    Input:
+    ------
+        x:      Array with the observed precipitation
+        y:      Array with the forecasted precipitation
+        h:      Array with the number of aggregated hours (Hcount)
+        counts: Array with the number of rows per group
+    '''
+    _worker['x'] = x; _worker['y'] = y; _worker['h'] = h
+    _worker['counts'] = counts
+    _worker['starts'] = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+
+def groupBatches(counts, nBoot, limit=None):
+    '''
+    Splits the groups into batches of consecutive groups with at most limit drawn indices per batch (at least one group per batch).
+
+    Input:
+    ------
+        counts:      Array with the number of rows per group
+        nBoot:       Number of bootstrap resamples
+
+    Optional Input:
+    ---------------
+        limit:       Maximum number of drawn indices (resamples x rows) per batch (default is maxElements)
+
+    Returns:
+    --------
+        batches:     List with (first group, last group + 1) tuples
+    '''
+    limit = maxElements if limit is None else limit
+    batches = []
+    g0 = 0; size = 0
+    for g, n in enumerate(counts):
+        if g > g0 and (size + n) * nBoot > limit:
+            batches.append((g0, g))
+            g0 = g; size = 0
+        size += n
+    if g0 < len(counts):
+        batches.append((g0, len(counts)))
+    return batches
+
+def bootstrapBatch(g0, g1, nBoot, quantiles, seed):
+    '''
+    Calculates the bootstrap quantiles of the statistics of a batch of groups. If the indices of all resamples do not fit in maxElements,
+    the resamples are drawn in chunks.
+
+    Input:
+    ------
+        g0, g1:    First group and last group + 1 of the batch
+        nBoot:     Number of bootstrap resamples
+        quantiles: List with the quantiles to return (e.g. [0.025, 0.975])
+        seed:      numpy SeedSequence of the batch
+
+    Returns:
+    --------
+        q:         Array with shape (statistics, quantiles, groups) with the quantiles of the adjusted R-squared, RMSE and bias
+    '''
+    w = _worker
+    counts = w['counts'][g0:g1]
+    start = w['starts'][g0]
+    stop = start + counts.sum()
+    x = w['x'][start:stop]; y = w['y'][start:stop]; h = w['h'][start:stop]
+    #-for each row (column of the index matrix): the first row and the size of its group
+    segments = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+    first = np.repeat(segments, counts)
+    size = np.repeat(counts, counts)
+    n = counts.astype(np.float64)
+    rng = np.random.default_rng(seed)
+    chunk = max(1, min(nBoot, maxElements // max(len(x), 1)))
+    stats = np.full((3, nBoot, len(counts)), np.nan)
+    for b in range(0, nBoot, chunk):
+        nb = min(chunk, nBoot - b)
+        #-uniform indices within the group of each column (scaling uniform floats is about twice as fast as integers with per-column bounds)
+        idx = first + np.minimum((rng.random((nb, len(x))) * size).astype(np.int64), size - 1)
+        xs = x[idx]; ys = y[idx]
+        sums = [np.add.reduceat(a, segments, axis=1) for a in [xs, ys, xs * xs, ys * ys, xs * ys, h[idx]]]
+        stats[:, b:b+nb] = statsFromArrays(n, *sums)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanquantile(stats, quantiles, axis=1).swapaxes(0, 1)
+
+def canFork():
+    '''
+    Returns True if the worker processes can be forked: the platform supports fork and no other threads run in this process. Threads of a
+    dask scheduler or client (e.g. the out-of-core mode of organize_for_plots.py) may hold locks while the process is forked, which can then
+    never be released in the workers.
+    '''
+    return 'fork' in multiprocessing.get_all_start_methods() and threading.active_count() == 1
+
+def bootstrapCI(df, keys, xCol, yCol, countCol='Hcount', nBoot=1000, alpha=0.05, seed=20191001, nWorkers=4):
+    '''
+    Calculates percentile bootstrap confidence intervals of the adjusted R-squared, RMSE and bias (see verification.statsFromSums) for
+    each group, by resampling the rows within each group with replacement.
+
+    Input:
+    ------
+        df:       Dataframe with the observations
+        keys:     List with the names of the columns to group by (e.g. ['Catchment', 'Forecasted hours', 'Accum. hours'])
+        xCol:     Name of the column with the observed precipitation (x)
+        yCol:     Name of the column with the forecasted precipitation (y)
+
+    Optional Input:
+    ---------------
+        countCol: Name of the column with the number of hours that were aggregated (Hcount)
+        nBoot:    Number of bootstrap resamples per group
+        alpha:    The intervals are the alpha/2 and 1-alpha/2 quantiles of the resampled statistics
+        seed:     Seed of the random numbers; the same seed gives the same intervals, also with another number of workers
+        nWorkers: Number of worker processes (1 calculates all batches in this process). The workers are forked, so that scripts such as
+                  organize_for_plots.py are not run again in each worker; where processes cannot be forked (Windows, or while other
+                  threads such as those of a dask scheduler are running, see canFork) threads are used instead, which also run in parallel
+                  because the resampling is done in NumPy without holding the GIL.
+
+    Returns:
+    --------
+        ci:       Dataframe indexed by keys with the lower and upper bounds of each statistic ('R-squared [-] lower', 'R-squared [-] upper',
+                  'RMSE [mm] lower', 'RMSE [mm] upper', 'Bias [%] lower' and 'Bias [%] upper')
+    '''
+    statCols = ['R-squared [-]', 'RMSE [mm]', 'Bias [%]']
+    grouped = df.groupby(keys, sort=True)
+    codes = grouped.ngroup().to_numpy()
+    index = grouped.size().index
+    order = np.argsort(codes, kind='stable')
+    counts = np.bincount(codes, minlength=len(index))
+    x = df[xCol].to_numpy(dtype=np.float64)[order]
+    y = df[yCol].to_numpy(dtype=np.float64)[order]
+    h = df[countCol].to_numpy(dtype=np.float64)[order]
+    quantiles = [alpha / 2, 1 - alpha / 2]
+    batches = groupBatches(counts, nBoot)
+    seeds = np.random.SeedSequence(seed).spawn(len(batches))
+    args = [[g0 for g0, g1 in batches], [g1 for g0, g1 in batches], [nBoot] * len(batches), [quantiles] * len(batches), seeds]
+    if nWorkers > 1 and len(batches) > 1 and canFork():
+        with ProcessPoolExecutor(max_workers=nWorkers, mp_context=multiprocessing.get_context('fork'), initializer=initWorker,
+                                 initargs=(x, y, h, counts)) as pool:
+            results = list(pool.map(bootstrapBatch, *args))
+    else:
+        initWorker(x, y, h, counts)
+        if nWorkers > 1 and len(batches) > 1:
+            with ThreadPoolExecutor(max_workers=nWorkers) as pool:
+                results = list(pool.map(bootstrapBatch, *args))
+        else:
+            results = list(map(bootstrapBatch, *args))
+        _worker.clear()
+    q = np.concatenate(results, axis=2) if results else np.zeros((3, 2, 0))
+    ci = pd.DataFrame(index=index)
+    for i, c in enumerate(statCols):
+        ci[c + ' lower'] = q[i, 0]
+        ci[c + ' upper'] = q[i, 1]
+    return ci
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import pandas as pd
+import numpy as np
+import os, json, hashlib
+from manifest import fileHash
+
+'''
+Station to catchment membership. The stations that are located within each (buffered) catchment are found with one spatial join
+(using the spatial index of geopandas) instead of a point-in-polygon selection per catchment. Because the buffered catchments overlap,
+a station can be a member of more than one catchment. The membership table is cached, keyed by the hashes of the shapefiles, and
+catchment averages are calculated with one groupby over the joined table.
+'''
+
+#-files that make up a shapefile
+_shpParts = ['.shp', '.shx', '.dbf', '.prj']
+
+
+def shapefileHash(shp):
+    '''
+    Returns the sha1 hash (hex string) of a shapefile, calculated from the content hashes of the .shp, .shx, .dbf and .prj files.
+
+    Input:
+    ------
+        shp: Full path to the shapefile (*.shp)
+
+    Returns:
+    --------
+        hash: Hex string
+    '''
+    h = hashlib.sha1()
+    base = os.path.splitext(shp)[0]
+    for ext in _shpParts:
+        if os.path.isfile(base + ext):
+            h.update(fileHash(base + ext).encode())
+    return h.hexdigest()
+
+def catchmentMembership(stationsShp, catchmentShp, cacheDir, idCol='ExtSiteID', catchCol='CATCH_NAME'):
+    '''
+    Returns the station to catchment membership table. A station is a member of a catchment if it is located within one of the polygons
+    of that catchment. The table is ordered by catchment (in the order of the catchment shapefile) and station (in the order of the station
+    shapefile), and is cached in cacheDir as long as both shapefiles do not change.
+
+    Input:
+    ------
+        stationsShp:  Full path to the point shapefile with the station locations
+        catchmentShp: Full path to the polygon shapefile with the catchments
+        cacheDir:     Directory where the membership table is cached
+
+    Optional Input:
+    ---------------
+        idCol:        Name of the station ID attribute
+        catchCol:     Name of the catchment name attribute
+
+    Returns:
+    --------
+        membership:   Dataframe with the columns 'Catchment' and idCol
+    '''
+    key = hashlib.sha1((shapefileHash(stationsShp) + shapefileHash(catchmentShp) + idCol + catchCol).encode()).hexdigest()
+    cacheFile = os.path.join(cacheDir, 'membership_' + key + '.json')
+    if os.path.isfile(cacheFile):
+        with open(cacheFile) as f:
+            return pd.DataFrame(json.load(f), columns=['Catchment', idCol])
+
+    import geopandas as gpd
+    stations_gdf = gpd.read_file(stationsShp)
+    catchment_gdf = gpd.read_file(catchmentShp)
+    if stations_gdf.crs != catchment_gdf.crs:
+        stations_gdf = stations_gdf.to_crs(catchment_gdf.crs)
+    stations_gdf['_station'] = np.arange(len(stations_gdf))
+    catchments = pd.Index(pd.unique(catchment_gdf[catchCol]))
+    joined = gpd.sjoin(stations_gdf[[idCol, '_station', 'geometry']], catchment_gdf[[catchCol, 'geometry']], how='inner', predicate='within')
+    joined['_catch'] = catchments.get_indexer(joined[catchCol])
+    #-a station within more than one polygon of the same catchment is only counted once
+    joined = joined.drop_duplicates(subset=['_catch', '_station'])
+    joined = joined.iloc[np.lexsort((joined['_station'].to_numpy(), joined['_catch'].to_numpy()))]
+    membership = pd.DataFrame({'Catchment': joined[catchCol].to_numpy(), idCol: joined[idCol].to_numpy()})
+
+    if not os.path.exists(cacheDir):
+        os.makedirs(cacheDir)
+    with open(cacheFile, 'w') as f:
+        json.dump({'Catchment': membership['Catchment'].tolist(), idCol: membership[idCol].tolist()}, f)
+    return membership
+
+def joinCatchments(df, membership, idCol='ExtSiteID'):
+    '''
+    Selects the rows of the stations in each catchment. Rows of a station that is a member of several catchments are repeated for each of
+    these catchments.
+
+    Input:
+    ------
+        df:         Dataframe with a station ID column
+        membership: Membership table (see catchmentMembership)
+
+    Optional Input:
+    ---------------
+        idCol:      Name of the station ID column
+
+    Returns:
+    --------
+        df:         Dataframe with a 'Catchment' column as first column, ordered by catchment (in the order of the membership table) and
+                    then by the original row order
+    '''
+    catchments = pd.Index(pd.unique(membership['Catchment']))
+    rows = pd.DataFrame({'_row': np.arange(len(df)), idCol: df[idCol].to_numpy()})
+    m = membership.merge(rows, on=idCol)
+    order = np.lexsort((m['_row'].to_numpy(), catchments.get_indexer(m['Catchment'])))
+    m = m.iloc[order]
+    df = df.iloc[m['_row'].to_numpy()].reset_index(drop=True)
+    df.insert(0, 'Catchment', m['Catchment'].to_numpy())
+    return df
+
+def catchmentAverage(df, keys, valueCols, catchments):
+    '''
+    Averages values over the stations of each catchment in one groupby. Missing values are skipped.
+
+    Input:
+    ------
+        df:         Dataframe with a 'Catchment' column (see joinCatchments)
+        keys:       List with the names of the columns (besides 'Catchment') to group by (e.g. ['DateTime of forecast'])
+        valueCols:  List with the names of the columns to average
+        catchments: List with the catchment names in the order of the output
+
+    Returns:
+    --------
+        df_avg:     Dataframe with the columns 'Catchment', keys and valueCols, ordered by catchment and then by keys
+    '''
+    catch = pd.Categorical(df['Catchment'], categories=catchments)
+    df_avg = df[valueCols].groupby([pd.Series(catch, index=df.index, name='Catchment')] + [df[k] for k in keys], sort=True, observed=True).mean()
+    df_avg = df_avg.reset_index()
+    df_avg['Catchment'] = df_avg['Catchment'].astype(object)
+    return df_avg
@@ -15,7 +15,16 @@ is located.
 '''
 
 import pandas as pd
-import os, subprocess, glob
+import numpy as np
+import os, glob, pytz
+from sampling import iterTifSamples, stationPixelIndex
+from cubestore import iterStationSamples
+from nctools import readPrecipCube, iterNcSamples
+from gridtools import gridNZTM, targetGrid, gridWeights
+from manifest import loadManifest, saveManifest, changedFiles, recordFile, settingsChanged, fileHash
+from tableio import readTable, writeTable, tableFile, exportCsv
+from instrument import configure, timer, report, startProfile, stopProfile
+from forecastmatrix import newForecastMatrix, fillForecasts, nEntries, toDataFrame
 
 pd.options.display.max_columns = 100
 
@@ -23,10 +32,32 @@ pd.options.display.max_columns = 100
 resultDir = r'C:\Active\Projects\MetService_precip_analysis\Data\station_metservice_comparison'
 #-Directory that contains the MetService converted GTiff products
 tifDir = r'C:\Active\Projects\MetService_precip_analysis\Data\tif_forecasts'
+#-Directory that contains the MetService cube stores ({product}.zarr) written by process_nc.py with outputFormat = 'zarr'
+cubeDir = r'C:\Active\Projects\MetService_precip_analysis\Data\cube_forecasts'
+#-Root directory for the MetService netCDF forecast products
+ncRootDir = r'C:\Active\Projects\MetService_precip_analysis\Data\nc_forecasts'
+#-Directory where process_nc.py caches the NZTM coordinates and interpolation weights of the product grids
+gridCacheDir = r'C:\Active\Projects\MetService_precip_analysis\Data\temp_files\grid_cache'
+#-read the forecasts from the GTiffs ('gtiff'), from the cube store of the product ('zarr'), or directly from the netCDF files ('nc'). The 'nc' option
+#-interpolates the forecasts only at the stations and skips writing the GTiffs.
+inputFormat = 'gtiff'
+#-for 'nc': interpolate at the centre of the 1 km pixel that contains the station (True), which gives the same values as sampling the GTiffs
+#-of process_nc.py, or at the station coordinates (False)
+snapToGrid = True
 #-List with directories that contain
 #Fproducts = ['ECMWF_8km', 'NCEP_4km', 'NCEP_8km', 'UKMO_8km']
 #Fproducts = ['ECMWF_8km', 'NCEP_8km']
 Fproducts = ['UKMO_8km']
+#-only process GTiffs that are new or changed since the previous run and merge them into the existing csv-file (True), or process all GTiffs (False)
+incremental = True
+#-format of the output table: 'csv', or the typed columnar formats 'parquet' or 'arrow' (faster to read for organize_for_plots.py)
+tableFormat = 'csv'
+#-also export the output table to a csv-file if a columnar table format is used
+csvExport = False
+#-JSON log file with the progress and the timers of the hot sections, and the directory for cProfile dumps per product (None disables profiling)
+logFile = os.path.join(resultDir, 'combine_station_forecast_log.jsonl')
+profileDir = None
+configure(logFile=logFile, profileDir=profileDir)
 
 
 from_date = '2018-08-01 00:00'
@@ -43,58 +74,113 @@ statXY_df = pd.read_csv(statXY)
 statTS_df = pd.read_csv(statTS, parse_dates=[1], dayfirst=True)
 #-station IDs
 statIDs = pd.unique(statXY_df.ExtSiteID).tolist()
+#-X and Y coordinates of the stations in the same order as statIDs
+statXY_unique = statXY_df.drop_duplicates(subset='ExtSiteID').set_index('ExtSiteID').loc[statIDs]
+statX = statXY_unique['NZTMX'].to_numpy(dtype=np.float64)
+statY = statXY_unique['NZTMY'].to_numpy(dtype=np.float64)
+statXY_unique = None
+##-Output extent of the Canterbury region and resolution of the grid used by process_nc.py
+xmin = 1323766.5234000002965331 - 5000
+ymin = 5004696.7684000004082918 - 5000
+xmax = 1692368.8068000003695488 + 5000 
+ymax = 5361879.5686999997124076 + 5000
+res = 1000
+nzTimeZones = pytz.country_timezones['nz'][0]
 #-Date range to process
 datetime_range = pd.date_range(pd.Timestamp(from_date), pd.Timestamp(to_date), freq='H')
 
+#-Station values in a (stations x hours) matrix with the same order as statIDs and datetime_range. statFound is False if there is no station
+#-value for that station and timestamp.
+statPos = pd.Series(np.arange(len(statIDs)), index=statIDs)
+statTS_sel = statTS_df.drop_duplicates(subset=['ExtSiteID', 'DateTime'], keep='first')
+statTS_sel = statTS_sel.loc[statTS_sel.ExtSiteID.isin(statIDs) & statTS_sel.DateTime.isin(datetime_range)]
+statRows = statPos.loc[statTS_sel.ExtSiteID].to_numpy()
+statCols = datetime_range.get_indexer(statTS_sel.DateTime)
+statValues = np.full((len(statIDs), len(datetime_range)), np.nan)
+statFound = np.zeros((len(statIDs), len(datetime_range)), dtype=bool)
+statValues[statRows, statCols] = statTS_sel['Value'].to_numpy(dtype=np.float64)
+statFound[statRows, statCols] = True
+statTS_sel = None; statRows = None; statCols = None
+
 #-set the columns of the dataframe to be filled
 base_cols = ['Station precipitation [mm]']
 forecast_cols = [i for i in range(1, 85+1)]
 base_cols.extend(forecast_cols)
+#-settings and station files that determine the output tables; if these differ from the previous run, the tables are rebuilt from all files
+stageSettings = {'from_date': from_date, 'to_date': to_date, 'inputFormat': inputFormat, 'snapToGrid': snapToGrid, 'tableFormat': tableFormat,
+                 'extent': [xmin, ymin, xmax, ymax, res], 'forecastHours': len(forecast_cols), 'statXY': fileHash(statXY), 'statTS': fileHash(statTS)}
 
 
 for fprod in Fproducts:
-    #-create the template for the dataframe to be filled
-    iterables = [statIDs, datetime_range, [fprod]]
-    index = pd.MultiIndex.from_product(iterables, names=['ExtSiteID', 'DateTime of forecast', 'MetService product'])
-    df_final = pd.DataFrame(columns=base_cols, index=index)
-    df_final.reset_index(inplace=True)
-    
+    manifestFile = os.path.join(resultDir, 'manifest_' + fprod + '.json')
+    if inputFormat == 'zarr':
+        #-the station time-series are read from the cube store in one go; incremental processing only applies to the GTiffs
+        ff = []
+        samples = iterStationSamples(os.path.join(cubeDir, fprod + '.zarr'), statX, statY)
+    else:
+        #-Get all Tiff (or netCDF) files for that product and keep only the new or changed files
+        if inputFormat == 'nc':
+            ff = glob.glob(os.path.join(ncRootDir, fprod) + '\\*.nc')
+        else:
+            ff = glob.glob(os.path.join(tifDir, fprod) + '\\*.tif')
+        manifest = loadManifest(manifestFile) if incremental else {}
+        rebuild = settingsChanged(manifest, stageSettings)
+        if rebuild:
+            manifest = {}
+        #-new or changed files, and files of which the output table is missing
+        ff = changedFiles(manifest, ff)
+        if not ff:
+            continue
+        if inputFormat == 'nc':
+            #-linear interpolation weights from the product grid to the stations (triangulated once per product and cached)
+            times, cube, lat, lon = readPrecipCube(ff[0], subdataset='precipitation_amount'); times = None; cube = None
+            srcX, srcY = gridNZTM(lat.ravel(), lon.ravel(), gridCacheDir)
+            geoTrans, xc, yc = targetGrid(xmin, ymin, xmax, ymax, np.ceil((xmax-xmin)/res), np.ceil((ymax-ymin)/res))
+            row, col, valid = stationPixelIndex(geoTrans, xc.shape[0], xc.shape[1], statX, statY)
+            if snapToGrid:
+                tX = xc[row, col]; tY = yc[row, col]
+            else:
+                tX = statX; tY = statY
+            W, inside = gridWeights(srcX, srcY, tX, tY, gridCacheDir, bounds=(xmin,ymin,xmax,ymax))
+            samples = iterNcSamples(ff, W, inside, nzTimeZones, valid=valid)
+        else:
+            samples = iterTifSamples(ff, statX, statY)
     
-    #-Get all Tiff files for that product and loop over those tifs
-    ff = glob.glob(os.path.join(tifDir, fprod) + '\\*.tif')
-    for f in ff:
-        tifFile = f
-        f = os.path.basename(f)
-        fstring = f[:17]
-        fstring = fstring.split('_')
-        hours = int(fstring[0].rstrip('h'))
-        tstamp = pd.Timestamp(fstring[1] + fstring[2])
-        fstring = None
-        #-Loop over the station IDs
-        for ID in statIDs:
-            print('Processing %s ID %s %s fhours %s' %(fprod, ID, tstamp, hours))
-            try:
-                statValue = statTS_df.loc[(statTS_df.ExtSiteID == ID) & (statTS_df.DateTime == tstamp), 'Value'].to_numpy()[0]
-            except:
-                statValue = False
-            #-only proceed if station value can be found for that timestamp
-            if statValue:
-                X = statXY_df.loc[statXY_df.ExtSiteID == ID, 'NZTMX'].to_numpy()[0]
-                Y = statXY_df.loc[statXY_df.ExtSiteID == ID, 'NZTMY'].to_numpy()[0]
-                #-Add station observed precipitation to dataframe
-                df_final.loc[(df_final.ExtSiteID == ID) & (df_final['DateTime of forecast']==tstamp) & (df_final['MetService product']==fprod), 'Station precipitation [mm]'] = statValue
-                #-Get the forecasted precipitation value for the timestamp
-                try:
-                    child = subprocess.Popen('gdallocationinfo ' + tifFile + ' -valonly -geoloc %s %s' %(X,Y), stdout=subprocess.PIPE)
-                    streamdata = child.communicate()[0]
-                    streamdata = float(streamdata.split()[0])
-                    #-Add the forecasted precipitation value for the timestamp and forecast hours
-                    df_final.loc[(df_final.ExtSiteID == ID) & (df_final['DateTime of forecast']==tstamp) & (df_final['MetService product']==fprod), hours] = streamdata
-                except:
-                    pass
+    stage = 'combine_station_forecast ' + fprod
+    profile = startProfile(stage)
+    #-sparse matrix with only the forecasts that exist (integer station, hour and forecast hour codes with float32 values); positions of
+    #-stations and timestamps are looked up through hash-based index lookups instead of boolean masks over the full dataframe
+    matrix = newForecastMatrix(len(statIDs), len(datetime_range), len(forecast_cols))
     
+    #-Loop over the forecasts (forecast hours, timestamp and forecasted precipitation values of all stations) and only add the forecasts of
+    #-stations of which the station value can be found for that timestamp and that are located within the grid. Progress is reported at a
+    #-fixed interval instead of for every forecast.
+    fillForecasts(matrix, samples, datetime_range, statValues, found=statFound, task=stage, total=len(ff) if inputFormat == 'gtiff' else None)
     
-    df_final.dropna(how='all', subset = forecast_cols, inplace=True)            
-    df_final.to_csv(os.path.join(resultDir, fprod + '.csv'), index=False)
+    #-expand the stations and hours that have forecasts to the dataframe layout of the csv-file, with the observed station precipitation
+    with timer('expand', nEntries(matrix), 'forecasts'):
+        df_final = toDataFrame(matrix, statIDs, datetime_range, statValues, fprod, forecast_cols)
+    matrix = None
+    #-merge with the results of the previous runs; values of the new or changed tifs take precedence
+    tableOut = os.path.join(resultDir, fprod)
+    if incremental and inputFormat != 'zarr' and not rebuild and os.path.isfile(tableFile(tableOut, tableFormat)):
+        keys = ['ExtSiteID', 'DateTime of forecast', 'MetService product']
+        df_old = readTable(tableOut, tableFormat, parse_dates=['DateTime of forecast'])
+        df_old.columns = keys + base_cols
+        df_final = df_final.set_index(keys).combine_first(df_old.set_index(keys)).sort_index().reset_index()
+        df_final = df_final[keys + base_cols]
+        df_final[forecast_cols] = df_final[forecast_cols].astype(np.float32)
+        df_old = None
+    with timer('table_write', len(df_final), 'rows'):
+        tableOut = writeTable(df_final, tableOut, tableFormat)
+    if csvExport:
+        exportCsv(os.path.join(resultDir, fprod), tableFormat)
+    #-keep track of the processed tifs (or netCDF files)
+    if inputFormat != 'zarr':
+        for f in ff:
+            recordFile(manifest, f, [tableOut], stageSettings)
+        saveManifest(manifest, manifestFile)
     df_final = None;    
+    stopProfile(profile, stage)
+    report(stage)
     
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+import xarray as xr
+import numpy as np
+import pandas as pd
+import os, time, hashlib
+from sampling import stationPixelIndex
+from instrument import timer
+
+'''
+Forecast cube store. All forecast runs of a product are stored in a single chunked and compressed Zarr store with dimensions
+(run, lead, y, x) instead of one GTiff per run and lead hour. New runs are appended along the run dimension. Chunks hold several runs,
+all lead hours and a small block of pixels, so that the time-series of a station (all runs and leads at one pixel) touches only a few chunks.
+The time at which each run was written is kept with the run, so that readers can tell which runs are new or overwritten (see runSignatures).
+'''
+
+
+def appendRuns(cubeFile, runTimes, validTimes, fields, geotransform, nleads=85, runChunk=8, spatialChunk=32):
+    '''
+    Appends forecast runs to a cube store. The store is created if it does not exist yet. Runs that are already in the store (same run time)
+    are overwritten. The time at which the runs are written is stored in the variable 'written' (seconds since 1970).
+
+    Input:
+    ------
+        cubeFile:     Full path to the Zarr store (*.zarr)
+        runTimes:     List with the (NZ) timestamps of the forecast runs
+        validTimes:   Array with shape (run, lead) with the (NZ) timestamps for which each forecast is valid (NaT where missing)
+        fields:       Array with shape (run, lead, y, x) with the forecasted precipitation per hour
+        geotransform: GDAL geotransform of the grid
+
+    Optional Input:
+    ---------------
+        nleads:       Number of lead hours in the store; runs with fewer lead hours are padded with NaN
+        runChunk:     Number of runs per chunk
+        spatialChunk: Number of rows and columns per chunk
+    '''
+    runTimes = pd.DatetimeIndex(runTimes)
+    validTimes = np.asarray(validTimes, dtype='datetime64[ns]')[:, :nleads]
+    fields = fields[:, :nleads]
+    nruns, n, nrows, ncols = fields.shape
+    existing = pd.DatetimeIndex([])
+    hasWritten = True
+    if os.path.exists(cubeFile):
+        with xr.open_zarr(cubeFile) as ds:
+            existing = pd.DatetimeIndex(ds['run'].values)
+            hasWritten = 'written' in ds
+    if len(existing) and not hasWritten:
+        #-store of an earlier version: the write time of its runs is unknown
+        xr.Dataset({'written': (('run',), np.full(len(existing), np.nan))}).to_zarr(cubeFile, mode='a')
+    #-pad to the number of lead hours in the store
+    if n < nleads:
+        pad = nleads - n
+        fields = np.concatenate([fields, np.full((nruns, pad, nrows, ncols), np.nan, dtype=fields.dtype)], axis=1)
+        validTimes = np.concatenate([validTimes, np.full((nruns, pad), np.datetime64('NaT'), dtype='datetime64[ns]')], axis=1)
+
+    ds = xr.Dataset({'precipitation': (('run', 'lead', 'y', 'x'), fields.astype(np.float32)),
+                     'valid_time': (('run', 'lead'), validTimes), 'written': (('run',), np.full(nruns, time.time()))},
+                    coords={'run': runTimes.values, 'lead': np.arange(1, nleads+1),
+                            'y': geotransform[3] + (np.arange(nrows) + 0.5) * geotransform[5],
+                            'x': geotransform[0] + (np.arange(ncols) + 0.5) * geotransform[1]},
+                    attrs={'crs': 'EPSG:2193', 'geotransform': list(geotransform), 'units': 'mm'})
+
+    if len(existing) == 0:
+        encoding = {'precipitation': {'chunks': (runChunk, nleads, spatialChunk, spatialChunk)}, 'valid_time': {'chunks': (runChunk, nleads)},
+                    'written': {'chunks': (runChunk,)}, 'run': {'units': 'hours since 2000-01-01 00:00:00', 'dtype': 'int64'}}
+        ds.to_zarr(cubeFile, mode='w', encoding=encoding)
+        return
+    #-overwrite runs that are already in the store
+    isOld = runTimes.isin(existing)
+    for i in np.flatnonzero(isOld):
+        j = existing.get_loc(runTimes[i])
+        ds.isel(run=slice(i, i+1)).drop_vars(['run', 'lead', 'y', 'x']).to_zarr(cubeFile, region={'run': slice(j, j+1)})
+    #-append the new runs
+    if (~isOld).any():
+        ds.isel(run=np.flatnonzero(~isOld)).to_zarr(cubeFile, append_dim='run')
+
+def cubeGrid(cubeFile):
+    '''
+    Returns the grid of a cube store.
+
+    Input:
+    ------
+        cubeFile: Full path to the Zarr store (*.zarr)
+
+    Returns:
+    --------
+        [geotransform, shape]: GDAL geotransform and (rows, cols) of the grid
+    '''
+    with xr.open_zarr(cubeFile) as ds:
+        return tuple(ds.attrs['geotransform']), (ds.sizes['y'], ds.sizes['x'])
+
+def runSignatures(cubeFile):
+    '''
+    Returns the runs in a cube store and the time at which each run was written.
+
+    Input:
+    ------
+        cubeFile: Full path to the Zarr store (*.zarr)
+
+    Returns:
+    --------
+        written:  Series indexed by the run timestamps with the write time of each run in seconds since 1970 (NaN for runs of which the write
+                  time is unknown)
+    '''
+    with xr.open_zarr(cubeFile) as ds:
+        runs = pd.DatetimeIndex(ds['run'].values)
+        written = ds['written'].values if 'written' in ds else np.full(len(runs), np.nan)
+    return pd.Series(written, index=runs)
+
+def cubeSignature(cubeFile):
+    '''
+    Returns the sha1 hash (hex string) of the runs in a cube store and their write times, which changes when runs are added or overwritten.
+
+    Input:
+    ------
+        cubeFile: Full path to the Zarr store (*.zarr)
+
+    Returns:
+    --------
+        hash:     Hex string
+    '''
+    written = runSignatures(cubeFile)
+    return hashlib.sha1(written.index.asi8.tobytes() + written.to_numpy(dtype=np.float64).tobytes()).hexdigest()
+
+def readStationSeries(cubeFile, X, Y):
+    '''
+    Reads the forecasts of all runs and lead hours at the station locations from a cube store.
+
+    Input:
+    ------
+        cubeFile: Full path to the Zarr store (*.zarr)
+        X:        Array with NZTMX coordinates of the stations
+        Y:        Array with NZTMY coordinates of the stations
+
+    Returns:
+    --------
+        [runs, leads, validTimes, values]: runs is an array with the run timestamps, leads an array with the lead hours, validTimes an
+                                           array with shape (run, lead), and values an array with shape (run, lead, station). Stations
+                                           outside the grid get NaN.
+    '''
+    with xr.open_zarr(cubeFile) as ds:
+        row, col, valid = stationPixelIndex(ds.attrs['geotransform'], ds.sizes['y'], ds.sizes['x'], X, Y)
+        da = ds['precipitation'].isel(y=xr.DataArray(row, dims='station'), x=xr.DataArray(col, dims='station'))
+        with timer('sampling', ds.sizes['run'] * ds.sizes['lead'] * len(row), 'station-samples'):
+            values = da.transpose('run', 'lead', 'station').values.astype(np.float64)
+        runs = ds['run'].values
+        leads = ds['lead'].values
+        validTimes = ds['valid_time'].values
+    values[:, :, ~valid] = np.nan
+    return runs, leads, validTimes, values
+
+def iterStationSamples(cubeFile, X, Y):
+    '''
+    Iterates over the runs and lead hours in a cube store, in the same way as iterating over the GTiff files of a product.
+
+    Input:
+    ------
+        cubeFile: Full path to the Zarr store (*.zarr)
+        X:        Array with NZTMX coordinates of the stations
+        Y:        Array with NZTMY coordinates of the stations
+
+    Returns:
+    --------
+        Generator that yields [hours, tstamp, values]: the lead hours, the (NZ) timestamp for which the forecast is valid, and an array
+                                                       with the forecasted values at the stations.
+    '''
+    runs, leads, validTimes, values = readStationSeries(cubeFile, X, Y)
+    for r in range(len(runs)):
+        for l in range(len(leads)):
+            if pd.isnull(validTimes[r, l]):
+                continue
+            yield int(leads[l]), pd.Timestamp(validTimes[r, l]), values[r, l, :]
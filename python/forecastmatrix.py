@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+import pandas as pd
+import numpy as np
+from instrument import timer, progress
+
+'''
+Compact storage of the station forecasts of combine_station_forecast.py. Instead of a dense (stations x hours x forecast hours) matrix, of
+which most cells are never filled, only the forecasts that exist are kept as sparse COO entries: integer station, hour and forecast hour
+codes with a float32 value (11 bytes per forecast). The entries are expanded to the wide table layout (one row per station and hour that
+has forecasts, one column per forecast hour) only when the table is written.
+'''
+
+#-number of added samples that are collected before they are concatenated into one block
+blockSize = 1024
+
+
+def newForecastMatrix(nstations, nhours, nleads):
+    '''
+    Returns an empty sparse forecast matrix.
+
+    Input:
+    ------
+        nstations: Number of stations
+        nhours:    Number of hours in the date range
+        nleads:    Number of forecast hours
+
+    Returns:
+    --------
+        matrix:    Dictionary with the shape, the blocks of (station, hour, lead, value) entries and the entries that still need to be added
+                   to a block
+    '''
+    return {'shape': (nstations, nhours, nleads), 'blocks': [], 'pending': []}
+
+def _flush(matrix):
+    '''
+    Concatenates the pending entries of a forecast matrix into one block.
+    '''
+    if matrix['pending']:
+        matrix['blocks'].append(tuple(np.concatenate(a) for a in zip(*matrix['pending'])))
+        matrix['pending'] = []
+
+def addForecasts(matrix, h, lead, stations, values):
+    '''
+    Adds the forecasts of one forecast hour, valid at one hour, for a number of stations. A forecast that is added again for the same
+    station, hour and forecast hour replaces the earlier one.
+
+    Input:
+    ------
+        matrix:   Sparse forecast matrix (see newForecastMatrix)
+        h:        Code (position in the date range) of the hour for which the forecasts are valid
+        lead:     Code (0-based position) of the forecast hour
+        stations: Array with the codes (positions) of the stations
+        values:   Array with the forecasted values of these stations
+    '''
+    n = len(stations)
+    matrix['pending'].append((np.asarray(stations, dtype=np.int32), np.full(n, h, dtype=np.int32), np.full(n, lead, dtype=np.int16),
+                              np.asarray(values, dtype=np.float32)))
+    if len(matrix['pending']) >= blockSize:
+        _flush(matrix)
+
+def fillForecasts(matrix, samples, times, obs, found=None, task=None, total=None):
+    '''
+    Adds the forecasts of station samples to a forecast matrix. Forecasts are only added for the stations that have a station value other than
+    zero for the timestamp, and that have a forecast (not NaN). Samples outside the date range or beyond the number of forecast hours of the
+    matrix are skipped.
+
+    Input:
+    ------
+        matrix:  Sparse forecast matrix (see newForecastMatrix)
+        samples: Iterable with [hours, tstamp, fValues]: the forecast hours, the timestamp and an array with the forecasted values of all
+                 stations (e.g. sampling.iterTifSamples or nctools.iterNcSamples)
+        times:   DatetimeIndex with the hours of the date range (in the order of the hour codes)
+        obs:     Array with shape (stations, hours) with the station precipitation
+
+    Optional Input:
+    ---------------
+        found:   Boolean array with shape (stations, hours) that is True where a station value exists (default is where obs is not NaN)
+        task:    Name of the task of which the progress is reported (None does not report the progress)
+        total:   Total number of samples (for the ETA of the progress)
+
+    Returns:
+    --------
+        n:       Number of samples
+    '''
+    nstations, nhours, nleads = matrix['shape']
+    found = ~np.isnan(obs) if found is None else found
+    n = 0
+    for hours, tstamp, fValues in samples:
+        n += 1
+        if task is not None:
+            progress(task, n, total, tstamp=tstamp, fhours=hours)
+        #-position of the timestamp in the date range (-1 if outside the date range)
+        h = times.get_indexer([tstamp])[0]
+        if h < 0 or hours < 1 or hours > nleads:
+            continue
+        with timer('fill', nstations, 'station-samples'):
+            sel = found[:, h] & (obs[:, h] != 0) & ~np.isnan(fValues)
+            addForecasts(matrix, h, hours - 1, np.flatnonzero(sel), fValues[sel])
+    return n
+
+def nEntries(matrix):
+    '''
+    Returns the number of entries in a forecast matrix (including entries that are replaced later on).
+    '''
+    return sum(len(b[0]) for b in matrix['blocks']) + sum(len(p[0]) for p in matrix['pending'])
+
+def toWide(matrix):
+    '''
+    Expands the entries of a forecast matrix to the rows (station and hour) that have at least one forecast.
+
+    Input:
+    ------
+        matrix: Sparse forecast matrix (see newForecastMatrix)
+
+    Returns:
+    --------
+        [stations, hours, wide]: Arrays with the station and hour codes of the rows, ordered by station and hour, and a float32 array with
+                                 shape (rows, nleads) with the forecasts (NaN where there is no forecast)
+    '''
+    _flush(matrix)
+    nstations, nhours, nleads = matrix['shape']
+    if not matrix['blocks']:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros((0, nleads), dtype=np.float32)
+    st, h, lead, value = (np.concatenate(a) for a in zip(*matrix['blocks']))
+    key = (st.astype(np.int64) * nhours + h) * nleads + lead
+    #-keep the last entry of each station, hour and forecast hour; the unique keys are ordered by station, hour and forecast hour
+    key, last = np.unique(key[::-1], return_index=True)
+    value = value[::-1][last]
+    rowKey, row = np.unique(key // nleads, return_inverse=True)
+    wide = np.full((len(rowKey), nleads), np.nan, dtype=np.float32)
+    wide[row, key % nleads] = value
+    return rowKey // nhours, rowKey % nhours, wide
+
+def toDataFrame(matrix, stationIDs, times, obs, product, leadCols):
+    '''
+    Expands a forecast matrix to the table layout of the csv-file of combine_station_forecast.py: one row per station and hour with at least
+    one forecast, with the station precipitation and a column per forecast hour.
+
+    Input:
+    ------
+        matrix:     Sparse forecast matrix (see newForecastMatrix)
+        stationIDs: List with the station IDs (in the order of the station codes)
+        times:      DatetimeIndex with the hours of the date range (in the order of the hour codes)
+        obs:        Array with shape (stations, hours) with the station precipitation
+        product:    Name of the MetService product
+        leadCols:   List with the names of the forecast hour columns
+
+    Returns:
+    --------
+        df:         Dataframe with the columns 'ExtSiteID', 'DateTime of forecast', 'MetService product', 'Station precipitation [mm]' and
+                    leadCols, ordered by station and time. The forecasts are float32.
+    '''
+    st, h, wide = toWide(matrix)
+    df = pd.DataFrame(wide, columns=leadCols)
+    df.insert(0, 'ExtSiteID', np.asarray(stationIDs, dtype=object)[st])
+    df.insert(1, 'DateTime of forecast', times[h])
+    df.insert(2, 'MetService product', product)
+    df.insert(3, 'Station precipitation [mm]', obs[st, h])
+    return df
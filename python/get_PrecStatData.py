@@ -8,30 +8,60 @@ __email__ = 'wilco.terink@ecan.govt.nz'
 __date__ = 'September 2019'
 ############################################################################################
 
-import pdsql
 import pandas as pd
+import os
+from stationdata import connect, syncStore, iterStore, readSitesXY
+from instrument import configure
 
 '''
-Gets ECan and NIWA precipitation station coordinates and time-series and writes those to csv-files
+Gets ECan and NIWA precipitation station coordinates and time-series and writes those to csv-files. The time-series are first synced to
+a local station store (Parquet): only the periods that are not in the store yet are fetched from the database, in fixed-size chunks.
 '''
 
-
+#-database backend: 'mssql' for the production database, or 'sqlite' / 'duckdb' for a local database with the same tables (offline testing)
+backend = 'mssql'
 server = 'edwprod01'
 database = 'hydro'
- 
+#-database file for the 'sqlite' and 'duckdb' backends
+dbFile = r'C:\Active\Projects\MetService_precip_analysis\Data\Stations\hydro.sqlite'
+
+#-directory of the local station store
+storeDir = r'C:\Active\Projects\MetService_precip_analysis\Data\Stations\station_store'
+#-number of records that are read from the database at once
+chunksize = 500000
+#-hours later than the current time minus this latency are not fetched yet, because not all stations may have delivered them (None fetches
+#-up to to_date; the hours after the last hour in the database are fetched again by the next sync in both cases)
+latency = None
+
+#-JSON log file with the fetched periods
+logFile = os.path.join(storeDir, 'get_PrecStatData_log.jsonl')
+configure(logFile=logFile)
+
+#-dataset types (precipitation) and quality codes to get
+datasetTypes = [38, 15]
+qualityCodes = [600]
 
 from_date = '2018-01-01'
 to_date = '2019-09-12'
 
-sites_df = pdsql.mssql.rd_sql(server, database, 'TSDataNumericHourlySumm', col_names=['ExtSiteID', 'DatasetTypeID'], where_in={'DatasetTypeID': [38, 15]})
+#-output csv-files
+statTS = r'C:\Active\Projects\MetService_precip_analysis\Data\Stations\station_ts.csv'
+statXY = r'C:\Active\Projects\MetService_precip_analysis\Data\Stations\station_xy.csv'
+
+con = connect(backend, server=server, database=database, path=dbFile)
+
+#-fetch the periods that are not in the station store yet
+syncStore(con, storeDir, datasetTypes, qualityCodes, from_date, to_date, chunksize=chunksize, latency=latency)
 
-prec_ts_df = pdsql.mssql.rd_sql(server, database, 'TSDataNumericHourly', col_names=['ExtSiteID', 'DateTime', 'Value'], where_in={'DatasetTypeID': [38, 15],
-                'ExtSiteID': pd.unique(sites_df.ExtSiteID).tolist(), 'QualityCode': [600]})
-prec_ts_df['DateTime'] = pd.to_datetime(prec_ts_df['DateTime']) 
-prec_ts_df = prec_ts_df.loc[(prec_ts_df.DateTime>=pd.Timestamp(from_date)) & (prec_ts_df.DateTime<=pd.Timestamp(to_date))]
-prec_ts_df.to_csv(r'C:\Active\Projects\MetService_precip_analysis\Data\Stations\station_ts.csv', index=False)
+#-write the time-series of the period to csv, batch by batch
+sites = {}
+with open(statTS, 'w', newline='') as f:
+    f.write('ExtSiteID,DateTime,Value\n')
+    for chunk in iterStore(storeDir, datasetTypes, qualityCodes, from_date, to_date):
+        chunk.to_csv(f, index=False, header=False)
+        sites.update(dict.fromkeys(pd.unique(chunk.ExtSiteID)))
 
 #-Get the locations of the sites and write to csv
-sites_xy =  pdsql.mssql.rd_sql(server, database, 'ExternalSite', col_names=['ExtSiteID', 'NZTMX', 'NZTMY'], where_in={'ExtSiteID': list(pd.unique(prec_ts_df.ExtSiteID))})
-sites_xy.drop_duplicates(inplace=True)
-sites_xy.to_csv(r'C:\Active\Projects\MetService_precip_analysis\Data\Stations\station_xy.csv', index=False)
+sites_xy = readSitesXY(con, list(sites))
+sites_xy.to_csv(statXY, index=False)
+con.close()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+import numpy as np
+import os, hashlib
+from osgeo import gdal
+from osgeo import osr
+from scipy.spatial import Delaunay
+from scipy import sparse
+from instrument import timer
+
+'''
+Tools for the MetService forecast grids: bulk reprojection of the grid coordinates, linear (Delaunay) interpolation weights to regrid
+the forecasts onto the 1 km Canterbury grid, and an on-disk cache per product grid, so that work that only depends on the grid is done once.
+'''
+
+
+def reprojectArrays(src_epsg, dst_epsg, x, y):
+    '''
+    Reproject arrays of coordinates x and y from EPSG defined by src_epsg to EPSG defined by dst_epsg. The coordinate transformation is
+    built once and all coordinates are transformed in one call.
+
+    Input:
+    ------
+        src_epsg: EPSG number of source coordinates
+        dst_epsg: EPSG number of target coordinates
+        x:        Array with x-coordinates of source coordinates (longitude for geographic coordinate systems)
+        y:        Array with y-coordinates of source coordinates (latitude for geographic coordinate systems)
+
+    Returns:
+    --------
+        [X,Y]:    Arrays with x and y coordinates in target coordinate system
+    '''
+    source = osr.SpatialReference()
+    source.ImportFromEPSG(src_epsg)
+    target = osr.SpatialReference()
+    target.ImportFromEPSG(dst_epsg)
+    #-GDAL 3 uses the authority axis order (lat, lon) for EPSG:4326; keep x=lon, y=lat (traditional GIS order)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        target.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    transform = osr.CoordinateTransformation(source, target)
+    x = np.asarray(x, dtype=np.float64).ravel()
+    y = np.asarray(y, dtype=np.float64).ravel()
+    points = np.array(transform.TransformPoints(np.column_stack([x, y]).tolist()), dtype=np.float64)
+    if len(points) == 0:
+        return np.empty(0), np.empty(0)
+    return points[:,0], points[:,1]
+
+def gridHash(lat, lon):
+    '''
+    Returns a hash (hex string) that identifies a forecast grid by its latitude and longitude coordinates.
+
+    Input:
+    ------
+        lat: Array with latitudes of the grid cells
+        lon: Array with longitudes of the grid cells
+
+    Returns:
+    --------
+        hash: Hex string
+    '''
+    lat = np.ascontiguousarray(lat, dtype=np.float64)
+    lon = np.ascontiguousarray(lon, dtype=np.float64)
+    h = hashlib.sha1()
+    h.update(str(lat.shape).encode())
+    h.update(lat.tobytes())
+    h.update(lon.tobytes())
+    return h.hexdigest()
+
+def gridNZTM(lat, lon, cacheDir):
+    '''
+    Returns the NZTMX and NZTMY coordinates of a grid with latitude and longitude coordinates. The result is stored in cacheDir, keyed by
+    the hash of the lat/lon coordinates, so that reruns and other files on the same grid do not need to reproject again.
+
+    Input:
+    ------
+        lat:      Array with latitudes of the grid cells
+        lon:      Array with longitudes of the grid cells
+        cacheDir: Directory where the reprojected coordinates are cached
+
+    Returns:
+    --------
+        [X,Y]:    Arrays with NZTMX and NZTMY coordinates
+    '''
+    cacheFile = os.path.join(cacheDir, 'nztm_' + gridHash(lat, lon) + '.npz')
+    if os.path.isfile(cacheFile):
+        with np.load(cacheFile) as cache:
+            return cache['X'], cache['Y']
+    X, Y = reprojectArrays(4326, 2193, lon, lat)
+    if not os.path.exists(cacheDir):
+        os.makedirs(cacheDir)
+    np.savez(cacheFile, X=X, Y=Y)
+    return X, Y
+
+def targetGrid(xmin, ymin, xmax, ymax, cols, rows):
+    '''
+    Returns the geotransform and the cell centre coordinates of a north-up target grid.
+
+    Input:
+    ------
+        xmin, ymin, xmax, ymax: Extent of the target grid
+        cols:                   Number of columns
+        rows:                   Number of rows
+
+    Returns:
+    --------
+        [geotransform, xc, yc]: GDAL geotransform, and arrays with shape (rows, cols) with the x and y coordinates of the cell centres
+    '''
+    cols = int(cols); rows = int(rows)
+    dx = (xmax - xmin) / cols
+    dy = (ymax - ymin) / rows
+    geotransform = (xmin, dx, 0.0, ymax, 0.0, -dy)
+    xc, yc = np.meshgrid(xmin + (np.arange(cols) + 0.5) * dx, ymax - (np.arange(rows) + 0.5) * dy)
+    return geotransform, xc, yc
+
+def linearWeights(X, Y, xc, yc, bounds=None):
+    '''
+    Triangulates the source points (Delaunay) and calculates for each target cell the indices of the three vertices of the triangle
+    that contains it and the barycentric weights. This gives the same linear interpolation as gdal.Grid(algorithm='linear').
+
+    Input:
+    ------
+        X:      Array with x-coordinates of the source points
+        Y:      Array with y-coordinates of the source points
+        xc:     Array with x-coordinates of the target cells
+        yc:     Array with y-coordinates of the target cells
+
+    Optional Input:
+    ---------------
+        bounds: (xmin, ymin, xmax, ymax) tuple; only source points within these bounds are used (same as spatFilter of gdal.Grid).
+
+    Returns:
+    --------
+        [vertices, weights]: Arrays with shape (nr. of target cells, 3) with the source point indices and the weights. Rows of target cells
+                             outside the triangulation have weight 0.
+    '''
+    X = np.asarray(X, dtype=np.float64).ravel()
+    Y = np.asarray(Y, dtype=np.float64).ravel()
+    use = np.isfinite(X) & np.isfinite(Y)
+    if bounds is not None:
+        use &= (X >= bounds[0]) & (Y >= bounds[1]) & (X <= bounds[2]) & (Y <= bounds[3])
+    srcIdx = np.flatnonzero(use)
+    points = np.column_stack([X[srcIdx], Y[srcIdx]])
+    targets = np.column_stack([np.ravel(xc), np.ravel(yc)])
+
+    tri = Delaunay(points)
+    simplex = tri.find_simplex(targets)
+    inside = simplex >= 0
+    #-barycentric coordinates of the target cells within their triangle
+    T = tri.transform[simplex[inside]]
+    b = np.einsum('ijk,ik->ij', T[:,:2,:], targets[inside] - T[:,2,:])
+    vertices = np.zeros((len(targets), 3), dtype=np.int64)
+    weights = np.zeros((len(targets), 3), dtype=np.float64)
+    vertices[inside] = srcIdx[tri.simplices[simplex[inside]]]
+    weights[inside] = np.column_stack([b, 1 - b.sum(axis=1)])
+    return vertices, weights
+
+def weightMatrix(vertices, weights, nsource):
+    '''
+    Converts vertex indices and weights into a sparse (nr. of target cells x nr. of source points) interpolation matrix.
+
+    Input:
+    ------
+        vertices: Array with shape (nr. of target cells, 3) with source point indices
+        weights:  Array with shape (nr. of target cells, 3) with the barycentric weights
+        nsource:  Number of source points
+
+    Returns:
+    --------
+        W: scipy.sparse CSR matrix
+    '''
+    ntarget = len(vertices)
+    rowIdx = np.repeat(np.arange(ntarget), 3)
+    W = sparse.csr_matrix((weights.ravel(), (rowIdx, vertices.ravel())), shape=(ntarget, nsource))
+    W.eliminate_zeros()
+    return W
+
+def gridWeights(X, Y, xc, yc, cacheDir, bounds=None):
+    '''
+    Returns the sparse linear interpolation matrix from the source points to the target cells, and a boolean array that is True for target
+    cells inside the triangulation. The vertex indices and weights are cached in cacheDir, keyed by the hash of the source and target
+    coordinates, so that the triangulation is done only once per product.
+
+    Input:
+    ------
+        X:        Array with x-coordinates of the source points
+        Y:        Array with y-coordinates of the source points
+        xc:       Array with x-coordinates of the target cells
+        yc:       Array with y-coordinates of the target cells
+        cacheDir: Directory where the interpolation weights are cached
+
+    Optional Input:
+    ---------------
+        bounds:   (xmin, ymin, xmax, ymax) tuple; only source points within these bounds are used.
+
+    Returns:
+    --------
+        [W, inside]: scipy.sparse CSR matrix, and boolean array with the length of the number of target cells
+    '''
+    key = gridHash(X, Y) + '_' + gridHash(yc, xc)
+    if bounds is not None:
+        key = key + '_' + hashlib.sha1(np.asarray(bounds, dtype=np.float64).tobytes()).hexdigest()[:8]
+    cacheFile = os.path.join(cacheDir, 'weights_' + hashlib.sha1(key.encode()).hexdigest() + '.npz')
+    if os.path.isfile(cacheFile):
+        with np.load(cacheFile) as cache:
+            vertices = cache['vertices']; weights = cache['weights']
+    else:
+        vertices, weights = linearWeights(X, Y, xc, yc, bounds=bounds)
+        if not os.path.exists(cacheDir):
+            os.makedirs(cacheDir)
+        np.savez(cacheFile, vertices=vertices, weights=weights)
+    inside = weights.any(axis=1)
+    return weightMatrix(vertices, weights, np.size(X)), inside
+
+def interpolate(W, inside, field, shape, nodata=0.0):
+    '''
+    Interpolates a field of source point values onto the target grid with one sparse matrix-vector product.
+
+    Input:
+    ------
+        W:      Sparse interpolation matrix (from gridWeights)
+        inside: Boolean array that is True for target cells inside the triangulation
+        field:  Array with the values at the source points (any shape, in the same order as the source coordinates)
+        shape:  (rows, cols) of the target grid
+
+    Optional Input:
+    ---------------
+        nodata: Value for target cells outside the triangulation (default 0, as gdal.Grid linear)
+
+    Returns:
+    --------
+        grid:   Array with the interpolated values with shape (rows, cols)
+    '''
+    with timer('regrid', 1, 'fields'):
+        grid = W.dot(np.asarray(field, dtype=np.float64).ravel())
+        grid[~inside] = nodata
+        return grid.reshape(shape)
+
+def writeGTiff(tifOut, arr, geotransform, epsg=2193):
+    '''
+    Writes a 2-D array to a single band Float64 GTiff.
+
+    Input:
+    ------
+        tifOut:       Full path of the GTiff to write
+        arr:          2-D array with shape (rows, cols)
+        geotransform: GDAL geotransform of the grid
+
+    Optional Input:
+    ---------------
+        epsg:         EPSG number of the coordinate system (default 2193, NZTM)
+    '''
+    with timer('gtiff_write', 1, 'files'):
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(epsg)
+        ds = gdal.GetDriverByName('GTiff').Create(tifOut, arr.shape[1], arr.shape[0], 1, gdal.GDT_Float64)
+        ds.SetGeoTransform(geotransform)
+        ds.SetProjection(srs.ExportToWkt())
+        ds.GetRasterBand(1).WriteArray(arr)
+        ds.FlushCache()
+        ds = None
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+import os, sys, json, time, threading
+from contextlib import contextmanager
+
+'''
+Instrumentation of the hot sections of the pipeline (netCDF open, de-accumulation, regridding, GTiff write, sampling, accumulation and
+statistics). Each section keeps a timer and counters (number of calls and processed items, e.g. fields or station samples). Progress is
+reported at a fixed time interval with the throughput and an ETA, instead of a line per iteration. Events and section summaries are written
+as one JSON record per line to a log file; a stage can optionally be profiled with cProfile (the .prof files can be opened with pstats,
+snakeviz, or compared with py-spy output).
+'''
+
+#-timers and counters per section: {name: {'calls': ..., 'seconds': ..., 'items': ..., 'unit': ...}}
+_sections = {}
+#-settings (see configure)
+_config = {'logFile': None, 'interval': 10., 'profileDir': None, 'echo': True}
+#-time of the last progress report per task
+_lastProgress = {}
+#-the sections can be timed from several threads (e.g. the stages of pipeline.py)
+_lock = threading.Lock()
+
+
+def configure(logFile=None, interval=10., profileDir=None, echo=True):
+    '''
+    Sets where and how often the instrumentation reports.
+
+    Optional Input:
+    ---------------
+        logFile:    Full path of the JSON log file (one record per line); None only prints to the console
+        interval:   Minimum number of seconds between two progress reports of the same task
+        profileDir: Directory where the cProfile dumps of the profiled stages are written; None disables profiling
+        echo:       Also print the progress reports and summaries to the console
+    '''
+    _config.update({'logFile': logFile, 'interval': interval, 'profileDir': profileDir, 'echo': echo})
+    if logFile and os.path.dirname(logFile) and not os.path.exists(os.path.dirname(logFile)):
+        os.makedirs(os.path.dirname(logFile))
+
+def peakRSS():
+    '''
+    Returns the peak resident memory of the current process in MB, or None if it cannot be determined.
+    '''
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        #-bytes on macOS, kB on Linux
+        return rss / 1024.**2 if sys.platform == 'darwin' else rss / 1024.
+    except ImportError:
+        pass
+    try:
+        import psutil
+        mem = psutil.Process().memory_info()
+        return getattr(mem, 'peak_wset', mem.rss) / 1024.**2
+    except ImportError:
+        return None
+
+def log(event, **fields):
+    '''
+    Writes an event as a JSON record to the log file.
+
+    Input:
+    ------
+        event:  Name of the event
+        fields: Fields of the record
+    '''
+    record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'event': event, 'pid': os.getpid()}
+    record.update(fields)
+    if _config['logFile']:
+        with open(_config['logFile'], 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+    return record
+
+@contextmanager
+def timer(name, items=0, unit='items'):
+    '''
+    Times a section and adds the processed items to its counters.
+
+    Input:
+    ------
+        name:  Name of the section (e.g. 'regrid')
+
+    Optional Input:
+    ---------------
+        items: Number of items that are processed in this call (e.g. fields or station samples)
+        unit:  Name of the items, used in the reports (e.g. 'fields')
+    '''
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - t0
+        with _lock:
+            s = _sections.setdefault(name, {'calls': 0, 'seconds': 0., 'items': 0, 'unit': unit})
+            s['calls'] += 1
+            s['seconds'] += seconds
+            s['items'] += items
+
+def count(name, items=1, unit='items'):
+    '''
+    Adds items to the counters of a section without timing it.
+
+    Input:
+    ------
+        name:  Name of the section
+
+    Optional Input:
+    ---------------
+        items: Number of items
+        unit:  Name of the items
+    '''
+    with _lock:
+        s = _sections.setdefault(name, {'calls': 0, 'seconds': 0., 'items': 0, 'unit': unit})
+        s['items'] += items
+
+def progress(task, done, total=None, started=None, **fields):
+    '''
+    Reports the progress of a task, at most once per interval (see configure), with the throughput and the ETA. The last item is always
+    reported.
+
+    Input:
+    ------
+        task:    Name of the task (e.g. 'combine UKMO_8km')
+        done:    Number of items that are done
+
+    Optional Input:
+    ---------------
+        total:   Total number of items (needed for the ETA)
+        started: time.perf_counter() at the start of the task; by default the time of the first report
+        fields:  Extra fields of the record (e.g. the current timestamp)
+    '''
+    now = time.perf_counter()
+    first = _lastProgress.setdefault(task, {'started': started if started is not None else now, 'reported': None})
+    last = first['reported']
+    if last is not None and now - last < _config['interval'] and (total is None or done < total):
+        return
+    first['reported'] = now
+    elapsed = now - first['started']
+    rate = done / elapsed if elapsed > 0 else None
+    eta = (total - done) / rate if (total is not None and rate) else None
+    record = log('progress', task=task, done=done, total=total, elapsed=round(elapsed, 1), rate=rate, eta=None if eta is None else round(eta, 1),
+                 peak_rss_mb=peakRSS(), **fields)
+    if _config['echo']:
+        msg = '%s: %s%s items' %(task, done, '' if total is None else '/%s' %total)
+        if rate:
+            msg += ', %.1f items/s' %rate
+        if eta is not None:
+            msg += ', ETA %.0f s' %eta
+        print(msg)
+    return record
+
+def collect(reset=True):
+    '''
+    Returns the timers and counters of all sections, e.g. to send them from a worker process to the main process.
+
+    Optional Input:
+    ---------------
+        reset: Reset the timers and counters after collecting them
+
+    Returns:
+    --------
+        sections: Dictionary with the timers and counters per section
+    '''
+    sections = {name: dict(s) for name, s in _sections.items()}
+    if reset:
+        _sections.clear()
+    return sections
+
+def merge(sections):
+    '''
+    Adds timers and counters (e.g. collected in a worker process) to those of this process.
+
+    Input:
+    ------
+        sections: Dictionary with the timers and counters per section (see collect)
+    '''
+    for name, s in sections.items():
+        t = _sections.setdefault(name, {'calls': 0, 'seconds': 0., 'items': 0, 'unit': s.get('unit', 'items')})
+        t['calls'] += s['calls']; t['seconds'] += s['seconds']; t['items'] += s['items']
+
+def report(stage, reset=True):
+    '''
+    Writes a summary record per section with the number of calls, the time, the number of items and the throughput, and a record with the
+    peak memory of the stage.
+
+    Input:
+    ------
+        stage: Name of the stage (e.g. 'process_nc UKMO_8km')
+
+    Optional Input:
+    ---------------
+        reset: Reset the timers and counters after the report
+
+    Returns:
+    --------
+        records: List with the summary records
+    '''
+    records = []
+    for name, s in sorted(_sections.items(), key=lambda x: -x[1]['seconds']):
+        rate = s['items'] / s['seconds'] if s['seconds'] > 0 and s['items'] else None
+        records.append(log('section', stage=stage, section=name, calls=s['calls'], seconds=round(s['seconds'], 3), items=s['items'], unit=s['unit'],
+                           rate=rate))
+        if _config['echo']:
+            print('%-30s %-16s %8d calls %10.2f s %12d %s%s' %(stage, name, s['calls'], s['seconds'], s['items'], s['unit'],
+                                                               '' if rate is None else ' (%.1f %s/s)' %(rate, s['unit'])))
+    records.append(log('stage', stage=stage, peak_rss_mb=peakRSS()))
+    if reset:
+        _sections.clear()
+    return records
+
+def startProfile(stage):
+    '''
+    Starts profiling a stage with cProfile if a profile directory is configured.
+
+    Input:
+    ------
+        stage:   Name of the stage
+
+    Returns:
+    --------
+        profile: cProfile.Profile object, or None if profiling is disabled
+    '''
+    if not _config['profileDir']:
+        return None
+    import cProfile
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+def stopProfile(profile, stage):
+    '''
+    Stops profiling a stage and writes the statistics to <profileDir>/<stage>.prof.
+
+    Input:
+    ------
+        profile: cProfile.Profile object returned by startProfile (None does nothing)
+        stage:   Name of the stage; used as file name of the dump
+    '''
+    if profile is None:
+        return
+    profile.disable()
+    if not os.path.exists(_config['profileDir']):
+        os.makedirs(_config['profileDir'])
+    profFile = os.path.join(_config['profileDir'], stage.replace(' ', '_') + '.prof')
+    profile.dump_stats(profFile)
+    log('profile', stage=stage, file=profFile)
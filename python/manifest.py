@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+import os, json, hashlib
+
+'''
+Manifest of processed input files for incremental processing. For each input file the manifest stores the path, size, modification time,
+content hash, the output files that were produced from it and a hash of the settings of the stage. A stage then only needs to process files
+that are new or that have changed, that were processed with other settings, or of which an output file no longer exists.
+'''
+
+
+def fileHash(path, blocksize=1024*1024):
+    '''
+    Returns the sha1 hash (hex string) of the content of a file.
+
+    Input:
+    ------
+        path:      Full path to the file
+
+    Optional Input:
+    ---------------
+        blocksize: Number of bytes that are read at once
+
+    Returns:
+    --------
+        hash: Hex string
+    '''
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        block = f.read(blocksize)
+        while block:
+            h.update(block)
+            block = f.read(blocksize)
+    return h.hexdigest()
+
+def fileSignature(path):
+    '''
+    Returns the size, modification time and content hash of a file.
+
+    Input:
+    ------
+        path: Full path to the file
+
+    Returns:
+    --------
+        signature: Dictionary with keys 'size', 'mtime' and 'hash'
+    '''
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime': st.st_mtime, 'hash': fileHash(path)}
+
+def loadManifest(manifestFile):
+    '''
+    Reads a manifest file. Returns an empty manifest if the file does not exist yet.
+
+    Input:
+    ------
+        manifestFile: Full path to the manifest (*.json)
+
+    Returns:
+    --------
+        manifest: Dictionary with the input file paths as keys
+    '''
+    if not os.path.isfile(manifestFile):
+        return {}
+    with open(manifestFile) as f:
+        return json.load(f)
+
+def saveManifest(manifest, manifestFile):
+    '''
+    Writes a manifest to file. The manifest is first written to a temporary file that then replaces the old manifest, so an
+    interrupted run cannot leave a corrupt manifest behind.
+
+    Input:
+    ------
+        manifest:     Dictionary with the input file paths as keys
+        manifestFile: Full path to the manifest (*.json)
+    '''
+    tmpFile = manifestFile + '.tmp'
+    with open(tmpFile, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmpFile, manifestFile)
+
+def settingsHash(settings):
+    '''
+    Returns the sha1 hash (hex string) of the settings of a stage. Values that are not JSON serializable (e.g. timestamps) are hashed as
+    their string representation.
+
+    Input:
+    ------
+        settings: Dictionary with the settings that determine the outputs of the stage
+
+    Returns:
+    --------
+        hash: Hex string
+    '''
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+def settingsChanged(manifest, settings):
+    '''
+    Checks whether any file in the manifest was processed with other settings than the current ones.
+
+    Input:
+    ------
+        manifest: Dictionary with the input file paths as keys
+        settings: Dictionary with the current settings of the stage
+
+    Returns:
+    --------
+        changed: True if the settings of a recorded file differ, False otherwise (also for an empty manifest)
+    '''
+    h = settingsHash(settings)
+    return any(entry.get('settings') != h for entry in manifest.values())
+
+def isChanged(manifest, path, settings=None):
+    '''
+    Checks whether a file is new or has changed since it was recorded in the manifest, whether it was processed with other settings, or
+    whether one of its recorded output files is missing. The content hash is only calculated if the size or modification time differ from
+    the manifest.
+
+    Input:
+    ------
+        manifest: Dictionary with the input file paths as keys
+        path:     Full path to the file
+
+    Optional Input:
+    ---------------
+        settings: Dictionary with the current settings of the stage (None skips the settings check)
+
+    Returns:
+    --------
+        changed: True if the file is new or changed, or needs to be processed again, False otherwise
+    '''
+    entry = manifest.get(path)
+    if entry is None:
+        return True
+    if settings is not None and entry.get('settings') != settingsHash(settings):
+        return True
+    if not all(os.path.exists(o) for o in entry.get('outputs', [])):
+        return True
+    st = os.stat(path)
+    if st.st_size == entry['size'] and st.st_mtime == entry['mtime']:
+        return False
+    if st.st_size != entry['size']:
+        return True
+    return fileHash(path) != entry['hash']
+
+def changedFiles(manifest, files, settings=None):
+    '''
+    Returns the files that are new or have changed since they were recorded in the manifest (see isChanged).
+
+    Input:
+    ------
+        manifest: Dictionary with the input file paths as keys
+        files:    List with full paths to the input files
+
+    Optional Input:
+    ---------------
+        settings: Dictionary with the current settings of the stage (None skips the settings check)
+
+    Returns:
+    --------
+        files:    List with the new or changed files
+    '''
+    return [f for f in files if isChanged(manifest, f, settings)]
+
+def recordFile(manifest, path, outputs=None, settings=None):
+    '''
+    Records a processed input file, the output files that were produced from it and the settings of the stage in the manifest.
+
+    Input:
+    ------
+        manifest: Dictionary with the input file paths as keys
+        path:     Full path to the processed input file
+
+    Optional Input:
+    ---------------
+        outputs:  List with full paths of the output files
+        settings: Dictionary with the settings of the stage
+    '''
+    entry = fileSignature(path)
+    entry['outputs'] = list(outputs) if outputs else []
+    if settings is not None:
+        entry['settings'] = settingsHash(settings)
+    manifest[path] = entry
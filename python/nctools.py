@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+import xarray as xr
+import numpy as np
+from instrument import timer, log
+from timeutils import utcToLocal
+
+'''
+Array-native reading of the MetService netCDF files. The precipitation cube is kept as a NumPy array (time, south_north, west_east)
+instead of being flattened into a long dataframe.
+'''
+
+
+def readPrecipCube(ncF, subdataset='precipitation_amount', chunks=None):
+    '''
+    Reads the accumulated precipitation cube of a MetService netCDF file.
+
+    Input:
+    ------
+        ncF:        Full path to NetCDF file (*.nc).
+
+    Optional Input:
+    ---------------
+        subdataset: Name (str) of the accumulated precipitation variable.
+        chunks:     Dictionary with the chunk size per dimension (e.g. {'time': 1}). If given the cube is returned as a lazy dask array
+                    of which only the chunks that are used are read (out-of-core mode); the file stays open until the cube is released.
+
+    Returns:
+    --------
+        [times, cube, lat, lon]: times is an array with the (UTC) timestamps, cube is an array with shape (time, south_north, west_east),
+                                 and lat and lon are arrays with shape (south_north, west_east).
+    '''
+    if chunks:
+        with timer('nc_open', 1, 'files'):
+            da = xr.open_dataset(ncF, chunks=chunks)[subdataset].transpose('time', 'south_north', 'west_east')
+            cube = da.data
+            lat = np.broadcast_to(da['latitude'].values, cube.shape[1:])
+            lon = np.broadcast_to(da['longitude'].values, cube.shape[1:])
+        return da['time'].values, cube, lat, lon
+    with timer('nc_open', 1, 'files'), xr.open_dataset(ncF) as dataset:
+        da = dataset[subdataset].transpose('time', 'south_north', 'west_east')
+        times = da['time'].values
+        cube = da.values
+        lat = np.broadcast_to(da['latitude'].values, cube.shape[1:])
+        lon = np.broadcast_to(da['longitude'].values, cube.shape[1:])
+    return times, cube, lat, lon
+
+def deaccumulate(cube):
+    '''
+    Converts a cube with accumulated precipitation into precipitation per time step by taking the difference along the time axis.
+    Field k of the result is the precipitation between time k and time k+1 of the input cube.
+
+    Input:
+    ------
+        cube: Array with accumulated precipitation with time as first axis (a lazy dask array gives a lazy result).
+
+    Returns:
+    --------
+        prec: Array with precipitation per time step with one time step less than cube.
+    '''
+    with timer('deaccumulate', max(len(cube) - 1, 0), 'fields'):
+        return np.diff(cube, axis=0)
+
+def iterNcCubes(ncFiles, timeZone, subdataset='precipitation_amount'):
+    '''
+    Iterates over MetService netCDF files and returns the hourly precipitation cube of each forecast run.
+
+    Input:
+    ------
+        ncFiles:    List with full paths to the NetCDF files (*.nc)
+        timeZone:   Name of the local time zone (e.g. 'Pacific/Auckland')
+
+    Optional Input:
+    ---------------
+        subdataset: Name (str) of the accumulated precipitation variable
+
+    Returns:
+    --------
+        Generator that yields [ncF, forecastTimes, prec]: the file name, a DatetimeIndex with the (NZ) timestamps of the file (the first one is
+                                                          the start of the run), and an array with shape (time-1, south_north, west_east) with
+                                                          the precipitation per forecast hour. Files that cannot be read are skipped
+                                                          and written to the log file (event 'unreadable_file') with the error.
+    '''
+    for ncF in ncFiles:
+        try:
+            times, cube, lat, lon = readPrecipCube(ncF, subdataset=subdataset)
+        except Exception as e:
+            log('unreadable_file', file=ncF, error=repr(e))
+            continue
+        prec = deaccumulate(cube); cube = None
+        yield ncF, utcToLocal(times, timeZone), prec
+
+def sampleRuns(cubes, W, inside, valid=None, nodata=0.0):
+    '''
+    Evaluates the hourly precipitation of forecast runs at the station locations. All forecast hours of a run are interpolated with one
+    sparse matrix product.
+
+    Input:
+    ------
+        cubes:    Iterable with [ncF, forecastTimes, prec] of the forecast runs (see iterNcCubes)
+        W:        Sparse interpolation matrix (nr. of stations x nr. of grid cells)
+        inside:   Boolean array that is True for stations inside the triangulation
+
+    Optional Input:
+    ---------------
+        valid:    Boolean array that is False for stations outside the output grid; these stations get NaN
+        nodata:   Value for stations outside the triangulation (default 0, as gdal.Grid linear)
+
+    Returns:
+    --------
+        Generator that yields [ncF, forecastTimes, values]: the file name, the (NZ) timestamps of the file, and an array with shape
+                                                            (stations, forecast hours) with the forecasted values at the stations.
+    '''
+    for ncF, forecastTimes, prec in cubes:
+        #-(stations x forecast hours)
+        with timer('sampling', W.shape[0] * len(prec), 'station-samples'):
+            values = np.asarray(W.dot(prec.reshape(len(prec), -1).T.astype(np.float64)))
+        prec = None
+        values[~inside, :] = nodata
+        if valid is not None:
+            values[~valid, :] = np.nan
+        yield ncF, forecastTimes, values
+
+def iterNcSamples(ncFiles, W, inside, timeZone, valid=None, nodata=0.0, subdataset='precipitation_amount'):
+    '''
+    Iterates over MetService netCDF files and evaluates the hourly precipitation directly at the station locations, without regridding
+    the full field. The interpolation matrix W is the same linear (Delaunay) interpolation as gdal.Grid(algorithm='linear'), but with the
+    stations as target points (see gridtools.gridWeights). All forecast hours of a file are interpolated with one sparse matrix product.
+
+    Input:
+    ------
+        ncFiles:    List with full paths to the NetCDF files (*.nc)
+        W:          Sparse interpolation matrix (nr. of stations x nr. of grid cells)
+        inside:     Boolean array that is True for stations inside the triangulation
+        timeZone:   Name of the local time zone (e.g. 'Pacific/Auckland')
+
+    Optional Input:
+    ---------------
+        valid:      Boolean array that is False for stations outside the output grid; these stations get NaN
+        nodata:     Value for stations outside the triangulation (default 0, as gdal.Grid linear)
+        subdataset: Name (str) of the accumulated precipitation variable
+
+    Returns:
+    --------
+        Generator that yields [hours, tstamp, values]: the forecast hours, the (NZ) timestamp for which the forecast is valid, and an array
+                                                       with the forecasted values at the stations. Files that cannot be read are skipped.
+    '''
+    for ncF, forecastTimes, values in sampleRuns(iterNcCubes(ncFiles, timeZone, subdataset=subdataset), W, inside, valid=valid, nodata=nodata):
+        for i in range(1, len(forecastTimes)):
+            yield i, forecastTimes[i], values[:, i-1]
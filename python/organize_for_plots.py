@@ -24,11 +24,18 @@ Plots to make:
 '''
 
 import pandas as pd
-import numpy as np
 import geopandas as gpd
-from gistools import vector
-import os
-import statsmodels.api as sm
+import os, shutil
+from manifest import loadManifest, saveManifest, isChanged, recordFile
+from tableio import readTable, writeTable, tableFile, exportCsv, readTableLazy, writeTableParts
+from accumulate import accumulateWindows
+from verification import groupSums, statsFromSums, percentError
+from catchments import catchmentMembership, joinCatchments, catchmentAverage, shapefileHash
+from instrument import configure, timer, report, startProfile, stopProfile
+from cubestore import cubeGrid, cubeSignature
+from zonal import catchmentWeights, cubeZonalMeans
+from outofcore import startScheduler, iterPartitions, lazyPercentError, lazyCatchmentAverage, lazyAccumulate, lazySums
+from bootstrap import bootstrapCI
 
 pd.options.display.max_columns = 100
 
@@ -38,14 +45,53 @@ resultDir = r'C:\Active\Projects\MetService_precip_analysis\Data\station_metserv
 #Fproducts = ['ECMWF_8km', 'NCEP_4km', 'NCEP_8km', 'UKMO_8km']
 #Fproducts = ['ECMWF_8km', 'NCEP_8km']
 Fproducts = ['NCEP_8km']
+#-only organize the products of which the csv-file from combine_station_forecast.py is new or changed since the previous run (True), or all products (False)
+incremental = True
+manifestFile = os.path.join(resultDir, 'manifest_organize.json')
+#-format of the tables that are read and written: 'csv', or the typed columnar formats 'parquet' or 'arrow' (faster to read, memory-mappable)
+tableFormat = 'csv'
+#-also export the output tables to csv-files for plotting if a columnar table format is used
+csvExport = True
+#-JSON log file with the timers of the hot sections, and the directory for cProfile dumps per part (None disables profiling)
+logFile = os.path.join(resultDir, 'organize_for_plots_log.jsonl')
+profileDir = None
+configure(logFile=logFile, profileDir=profileDir)
+#-Out-of-core mode for multi-year archives: the tables are read as partitioned lazy (dask) dataframes and organized partition by partition,
+#-so that a table does not need to fit in memory. The scheduler ('threads', 'processes', 'synchronous' or 'distributed'), the number of workers,
+#-the memory limit per worker (only enforced by the distributed scheduler; e.g. 4 x 3GB on a 16 GB node) and the csv partition size can be set.
+#-In this mode the rows of the per-station tables are ordered within each partition instead of over the whole table.
+outOfCore = False
+scheduler = 'threads'
+nWorkers = 4
+memoryLimit = '3GB'
+blocksize = '64MB'
 
 #-Period to analyse for
 from_date = '2018-08-01 00:00'
 to_date = '2019-09-12 23:00'
+#-list with hours over which to accumulate (PART 2)
+accum_hours = [1, 3, 6, 12, 24]
 
 #-Shapefils that determine station locations and catchments
 catchment_shp = r'C:\Active\Projects\MetService_precip_analysis\Data\GIS\Catchments_NZTM_major_10kmbuffer.shp'
 stations_shp = r'C:\Active\Projects\MetService_precip_analysis\Data\GIS\station_xy.shp'
+#-Directory where the station to catchment membership table is cached
+cacheDir = os.path.join(resultDir, 'cache')
+#-Also calculate the catchment-mean forecasts from the full 1 km forecast grid and compare them with the catchment average of the stations.
+#-Requires the cube stores ({product}.zarr) of process_nc.py with outputFormat = 'zarr'. The catchments are rasterized once onto the grid as a
+#-sparse matrix with the covered fraction of each cell (cached in cacheDir), and the catchment means of a run are one sparse matrix product.
+#-The catchment means of each run are also cached in cacheDir, so that only the runs that were added to a store since the previous run are
+#-calculated.
+gridMeans = False
+cubeDir = r'C:\Active\Projects\MetService_precip_analysis\Data\cube_forecasts'
+#-Bootstrap confidence intervals of the R-squared, RMSE and bias, added as lower and upper columns to the statistics tables. The rows of each
+#-forecast hour, accumulation window (and catchment) are resampled nBoot times; the resamples of all groups are drawn in batches and the
+#-statistics are calculated from their sums in closed form (see bootstrap.py), in bootWorkers processes. The seed makes the intervals reproducible.
+bootstrap = False
+nBoot = 1000
+bootAlpha = 0.05
+bootSeed = 20191001
+bootWorkers = 4
 
 #-read catchment shapefile into dataframe
 catchment_gdf = gpd.read_file(catchment_shp)
@@ -53,245 +99,213 @@ unique_catchments = pd.unique(catchment_gdf['CATCH_NAME']).tolist()
 #-read stations shapefile into dataframe
 stations_gdf = gpd.read_file(stations_shp)
 unique_stations = pd.unique(stations_gdf['ExtSiteID']).tolist()
+#-stations that are located within each catchment (one spatial join, cached as long as the shapefiles do not change)
+membership = catchmentMembership(stations_shp, catchment_shp, cacheDir)
+#-start the dask scheduler for the out-of-core mode
+client = startScheduler(scheduler, nWorkers, memoryLimit, tempDir=cacheDir) if outOfCore else None
+
+#-settings and shapefiles that determine the output tables; a product is organized again if these differ from the previous run
+stageSettings = {'from_date': from_date, 'to_date': to_date, 'accum_hours': accum_hours, 'tableFormat': tableFormat, 'gridMeans': gridMeans,
+                 'bootstrap': bootstrap, 'nBoot': nBoot, 'bootAlpha': bootAlpha, 'bootSeed': bootSeed,
+                 'catchments': shapefileHash(catchment_shp), 'stations': shapefileHash(stations_shp)}
+#-with gridMeans the runs in the cube store of each product are also recorded, so that a product is organized again when runs are added
+productSettings = {fprod: dict(stageSettings, cube=cubeSignature(os.path.join(cubeDir, fprod + '.zarr')) if gridMeans else None) for fprod in Fproducts}
+#-skip the products that have not changed since the previous run and of which all output tables still exist
+manifest = loadManifest(manifestFile) if incremental else {}
+Fproducts = [fprod for fprod in Fproducts if isChanged(manifest, tableFile(os.path.join(resultDir, fprod), tableFormat), productSettings[fprod])]
+
+
+#-filter on the period to analyse (pushed down into the reader for the columnar table formats)
+dateFilter = [('DateTime of forecast', '>=', pd.Timestamp(from_date)), ('DateTime of forecast', '<=', pd.Timestamp(to_date))]
 
 
 ##-PART 1 BELOW IS FOR FORMATTING THE DATA INTO FORMAT SUITABLE FOR BOXPLOTS AND LOOKS AT INDIVIDUAL PERCENTUAL ERRORS (I.E. NOT ACCUMULATED SUMS)
  
 #-define some columns that will be used throughout the remainder of the 
-proc_cols = [str(i)+'_proc' for i in range(1,85+1)]
-df_proc = pd.DataFrame(columns=proc_cols)
 cols = [str(i) for i in range(1, 85+1)]
    
+profile = startProfile('organize_for_plots PART 1')
 for fprod in Fproducts:
-    df = pd.read_csv(os.path.join(resultDir, fprod + '.csv'), parse_dates=[1], dayfirst=True)
-    df = df.loc[(df['DateTime of forecast']>=pd.Timestamp(from_date)) & (df['DateTime of forecast']<=pd.Timestamp(to_date))]
-       
-    df['Month'] = df['DateTime of forecast'].dt.month
-        
-    ###-copy of df for procentual difference of all stations (plots 1) and 2)).
-    df_canterbury = df.copy()
-    #-Add columns to calculate procentual difference
-    df_canterbury = pd.concat([df_canterbury, df_proc], axis=1)
-    #-Calculate percentual difference
-    for h in range(1, 85+1):
-        df_canterbury[str(h) + '_proc'] = ((df_canterbury[str(h)] - df_canterbury['Station precipitation [mm]'])/df_canterbury['Station precipitation [mm]'])*100
-    #-drop columns that are not needed
-    df_canterbury.drop(cols, axis=1, inplace=True)
-    #-rename the columns
-    for h in range(1, 85+1):
-        df_canterbury.rename(columns={str(h) + '_proc': h}, inplace=True)
-    df_canterbury.to_csv(os.path.join(resultDir, 'all_stations_canterbury_' + fprod + '.csv'), index=False)
-    df_canterbury = None
-        
-    #-empty final dataframes to fill for the catchment scale
-    df_catchment_final = pd.DataFrame(columns=['Catchment', 'ExtSiteID', 'DateTime of forecast', 'MetService product', 'Station precipitation [mm]', 'Month'])
-    df_catchment_final = pd.concat([df_catchment_final, pd.DataFrame(columns=[i for i in range(1, 85+1)])], axis=1)
-    df_catchment_avg_final = pd.DataFrame(columns=['Catchment', 'DateTime of forecast', 'MetService product', 'Catchment precipitation [mm]', 'Month'])
-    df_catchment_avg_final = pd.concat([df_catchment_avg_final, pd.DataFrame(columns=[i for i in range(1, 85+1)])], axis=1)
-        
-        
-    ###-now per catchment
-    for catch in unique_catchments:
-        print('Processing %s' %catch)
-        #-Select only the geopandas dataframe of the catchment of interest
-        sel_catch = catchment_gdf.loc[catchment_gdf['CATCH_NAME']==catch]
-        #-Select the stations that can be found within this catchment
-        sel_stats = vector.sel_sites_poly(stations_gdf, sel_catch)
-        #-Select only the precipitation data for the stations part of that catchment
-        df_catchment = df.loc[df.ExtSiteID.isin(sel_stats.ExtSiteID.tolist())]
-        df_catchment.insert(0, 'Catchment', catch)
-        #-Create a copy of the catchment df that contains the stations to be used for averaging
-        df_catchment_avg = df_catchment.copy()
-        df_catchment_avg.drop('ExtSiteID', axis=1, inplace=True)
-        #-Average precipitation station and forecast values
-        df_catchment_avg = df_catchment_avg.groupby('DateTime of forecast').mean()
-        df_catchment_avg.reset_index(inplace=True)
-        df_catchment_avg.insert(1, 'MetService product', fprod)            
-        df_catchment_avg.insert(0, 'Catchment', catch)
+    if outOfCore:
+        df = readTableLazy(os.path.join(resultDir, fprod), tableFormat, parse_dates=['DateTime of forecast'], filters=dateFilter, blocksize=blocksize)
+        df['Month'] = df['DateTime of forecast'].dt.month
+        keepCols = [c for c in df.columns if c not in cols]
+        #-procentual differences of all stations and of the stations per catchment, written partition by partition
+        with timer('percent_error'):
+            writeTableParts(iterPartitions(lazyPercentError(df, cols, keepCols), nWorkers), os.path.join(resultDir, 'all_stations_canterbury_' + fprod), tableFormat)
+        with timer('catchments'):
+            writeTableParts(iterPartitions(lazyPercentError(df, cols, keepCols, membership), nWorkers), os.path.join(resultDir, 'all_stations_catchments_' + fprod),
+                            tableFormat)
+            #-Average precipitation station and forecast values per catchment from the sums and counts per partition
+            df_catchment_avg = lazyCatchmentAverage(df[['ExtSiteID', 'DateTime of forecast', 'Station precipitation [mm]', 'Month'] + cols], ['DateTime of forecast'],
+                                                    ['Station precipitation [mm]'] + cols + ['Month'], unique_catchments, membership)
+    else:
+        df = readTable(os.path.join(resultDir, fprod), tableFormat, parse_dates=['DateTime of forecast'], filters=dateFilter)
+           
+        df['Month'] = df['DateTime of forecast'].dt.month
+            
+        ###-procentual difference of all stations (plots 1) and 2)), for all forecast hours at once. The forecast hours are the column names.
+        with timer('percent_error', len(df), 'rows'):
+            df_canterbury = percentError(df, cols, [c for c in df.columns if c not in cols])
+        writeTable(df_canterbury, os.path.join(resultDir, 'all_stations_canterbury_' + fprod), tableFormat)
             
-        #-Add columns for calculating percentual difference for individual stations
-        df_catchment = pd.concat([df_catchment, df_proc], axis=1)
-        #-Calculate percentual difference
-        for h in range(1, 85+1):
-            df_catchment[str(h) + '_proc'] = ((df_catchment[str(h)] - df_catchment['Station precipitation [mm]'])/df_catchment['Station precipitation [mm]'])*100
-        #-drop columns that are not needed
-        df_catchment.drop(cols, axis=1, inplace=True)
-        #-rename the columns
-        for h in range(1, 85+1):
-            df_catchment.rename(columns={str(h) + '_proc': h}, inplace=True)
-        #-concat to the final dataframe
-        df_catchment_final = pd.concat([df_catchment_final, df_catchment], axis=0); df_catchment = None
-                
-        #-Add columns for calculating percentual difference for catchment average
-        df_catchment_avg = pd.concat([df_catchment_avg, df_proc], axis=1)
-        #-Calculate percentual difference
-        for h in range(1, 85+1):
-            df_catchment_avg[str(h) + '_proc'] = ((df_catchment_avg[str(h)] - df_catchment_avg['Station precipitation [mm]'])/df_catchment_avg['Station precipitation [mm]'])*100
-        #-drop columns that are not needed
-        df_catchment_avg.drop(cols, axis=1, inplace=True)
-        #-rename the columns
-        for h in range(1, 85+1):
-            df_catchment_avg.rename(columns={str(h) + '_proc': h}, inplace=True)
-        df_catchment_avg.rename(columns={'Station precipitation [mm]': 'Catchment precipitation [mm]'}, inplace=True)
-        #-concat to the final dataframe
-        df_catchment_avg_final = pd.concat([df_catchment_avg_final, df_catchment_avg], axis=0); df_catchment_avg = None
+        ###-now per catchment: the procentual differences of the stations of all catchments (a station can be part of more than one catchment)
+        with timer('catchments', len(df), 'rows'):
+            df_catchment_final = joinCatchments(df_canterbury, membership)
+            df_canterbury = None
+            #-Average precipitation station and forecast values per catchment
+            df_catchment_avg = catchmentAverage(joinCatchments(df[['ExtSiteID', 'DateTime of forecast', 'Station precipitation [mm]', 'Month'] + cols], membership),
+                                                ['DateTime of forecast'], ['Station precipitation [mm]'] + cols + ['Month'], unique_catchments)
+        writeTable(df_catchment_final, os.path.join(resultDir, 'all_stations_catchments_' + fprod), tableFormat)
+        df_catchment_final = None
+    df_catchment_avg.insert(2, 'MetService product', fprod)
+    #-procentual difference for the catchment averages
+    with timer('percent_error', len(df_catchment_avg), 'rows'):
+        df_catchment_avg_final = percentError(df_catchment_avg, cols, ['Catchment', 'DateTime of forecast', 'MetService product', 'Station precipitation [mm]', 'Month'])
+    df_catchment_avg_final.rename(columns={'Station precipitation [mm]': 'Catchment precipitation [mm]'}, inplace=True)
+    if gridMeans:
+        #-catchment-mean forecasts of the grid for the timestamps that have a catchment average of the stations
+        cubeFile = os.path.join(cubeDir, fprod + '.zarr')
+        geoTrans, shape = cubeGrid(cubeFile)
+        Wz, zoneNames, coverage = catchmentWeights(catchment_shp, geoTrans, shape, cacheDir)
+        with timer('grid_means'):
+            df_grid = cubeZonalMeans(cubeFile, Wz, zoneNames, fprod, from_date, to_date, cacheDir=cacheDir)
+        gridCols = [c for c in df_grid.columns if c not in ['Catchment', 'DateTime of forecast', 'MetService product']]
+        df_grid = df_grid.merge(df_catchment_avg[['Catchment', 'DateTime of forecast', 'Station precipitation [mm]']], on=['Catchment', 'DateTime of forecast'])
+        df_grid['Month'] = df_grid['DateTime of forecast'].dt.month
+        df_grid = df_grid[['Catchment', 'DateTime of forecast', 'MetService product', 'Station precipitation [mm]', 'Month'] + gridCols]
+        with timer('percent_error', len(df_grid), 'rows'):
+            df_grid_final = percentError(df_grid, gridCols, ['Catchment', 'DateTime of forecast', 'MetService product', 'Station precipitation [mm]', 'Month'])
+        df_grid.rename(columns={'Station precipitation [mm]': 'Catchment precipitation [mm]'}, inplace=True)
+        df_grid_final.rename(columns={'Station precipitation [mm]': 'Catchment precipitation [mm]'}, inplace=True)
+        writeTable(df_grid, os.path.join(resultDir, 'catchments_grid_mean_' + fprod), tableFormat)
+        writeTable(df_grid_final, os.path.join(resultDir, 'catchments_grid_avg_' + fprod), tableFormat)
+        df_grid = None; df_grid_final = None
+    df_catchment_avg = None
             
-    df_catchment_final.to_csv(os.path.join(resultDir, 'all_stations_catchments_' + fprod + '.csv'), index=False)
-    df_catchment_avg_final.to_csv(os.path.join(resultDir, 'catchments_avg_' + fprod + '.csv'), index=False)
+    writeTable(df_catchment_avg_final, os.path.join(resultDir, 'catchments_avg_' + fprod), tableFormat)
        
     df = None;
-    df_catchment_final = None;
     df_catchment_avg_final = None;
+stopProfile(profile, 'organize_for_plots PART 1')
+report('organize_for_plots PART 1')
      
 ##-PART 2 BELOW IS FOR LOOKING AT CUMULATIVE SUMS FOR BOTH STATIONS AND FORECASTS
  
 cols = [str(i) for i in range(1, 24+1)]  #-only consider forecasts up to 24 hours ahead
-df_final_template = pd.DataFrame(columns=['DateTime of forecast', 'Forecasted hours', 'Accum. hours', 'ExtSiteID', 'MetService product', 'Accum. station precipitation [mm]', 'Accum. forecasted precipitation [mm]', 'Hcount'])
- 
-#-list with hours over which to accumulate
-accum_hours = [1, 3, 6, 12, 24]
  
+profile = startProfile('organize_for_plots PART 2')
 for fprod in Fproducts:
-    df_canterbury = df_final_template.copy()
-    df = pd.read_csv(os.path.join(resultDir, fprod + '.csv'), parse_dates=[1], dayfirst=True)
-    df = df.loc[(df['DateTime of forecast']>=pd.Timestamp(from_date)) & (df['DateTime of forecast']<=pd.Timestamp(to_date))]
-    df_fcols = df.iloc[:,0:4]
-    for fhours in cols:
-        df_fhours = df[[fhours]]
-        df_merged = pd.concat([df_fcols, df_fhours], axis=1)
-        df_merged.dropna(how='any', inplace=True)
-        #-Add column with ones to be used later to know how many hours with data were really aggregated over the interval
-        df_merged['Hcount'] = 1
-        for st in unique_stations:
-            print('Processing %s fhours:%s ExtSiteID:%s' %(fprod, fhours, st))
-            df_sel = df_merged.loc[df_merged.ExtSiteID == st]
-            df_sel.set_index('DateTime of forecast', inplace=True)
-            for ah in accum_hours:
-                #-accumulate to the hours ah
-                df_accum = df_sel.resample(str(ah)+'H', label='right').sum()
-                df_accum.loc[df_accum.ExtSiteID==0] = np.nan
-                df_accum.dropna(inplace=True)
-                df_accum.drop('ExtSiteID', axis=1, inplace=True)
-                df_accum.reset_index(inplace=True)
-                #-re-organize dataframe to concat hereafter
-                df_temp = df_final_template.copy()
-                df_temp['DateTime of forecast'] = df_accum['DateTime of forecast']
-                df_temp['Forecasted hours'] = fhours
-                df_temp['Accum. hours'] = ah
-                df_temp['ExtSiteID'] = st
-                df_temp['MetService product'] = fprod
-                df_temp['Accum. station precipitation [mm]'] = df_accum['Station precipitation [mm]']
-                df_temp['Accum. forecasted precipitation [mm]'] = df_accum[fhours]
-                df_temp['Hcount'] = df_accum['Hcount']
-                #-concat to final dataframe                
-                df_canterbury = pd.concat([df_canterbury, df_temp], axis=0)
-                #-clear variables
-                df_accum = None; df_temp = None
-            #-clear variables    
-            df_sel = None
-        #-clear variables
-        df_fhours = None; df_merged = None    
-    #-write to csv file
-    temp_df = df_canterbury['DateTime of forecast'].dt.month
-    df_canterbury.insert(1, 'Month', temp_df)
-    df_canterbury.to_csv(os.path.join(resultDir, 'cumsum_all_stations_canterbury_' + fprod + '.csv'), index=False)
-    df_canterbury.drop('Month', axis=1, inplace=True)
-    #-rename station column to catchment precipitation for the next catchment averages
-    df_canterbury.rename(columns={'Accum. station precipitation [mm]': 'Accum. catchment precipitation [mm]'}, inplace=True)
-    #-empty final dataframe for the catchment averages.
-    df_catchment_avg_final = pd.DataFrame(columns=['Catchment', 'DateTime of forecast', 'MetService product', 'Forecasted hours', 'Accum. hours', 'Accum. catchment precipitation [mm]', 'Accum. forecasted precipitation [mm]', 'Hcount'])
-    #-now create the averages per catchment
-    for catch in unique_catchments:
-        print('Processing %s' %catch)
-        #-Select only the geopandas dataframe of the catchment of interest
-        sel_catch = catchment_gdf.loc[catchment_gdf['CATCH_NAME']==catch]
-        #-Select the stations that can be found within this catchment
-        sel_stats = vector.sel_sites_poly(stations_gdf, sel_catch)
-        #-Select only the precipitation data for the stations part of that catchment
-        df_catchment = df_canterbury.loc[df_canterbury.ExtSiteID.isin(sel_stats.ExtSiteID.tolist())]
-        df_catchment.insert(0, 'Catchment', catch)
-        #-Create a copy of the catchment df that contains the stations to be used for averaging
-        df_catchment_avg = df_catchment.copy()
-        df_catchment_avg.drop('ExtSiteID', axis=1, inplace=True)
-        #-Average precipitation station and forecast values
-        df_catchment_avg = df_catchment_avg.groupby(['DateTime of forecast', 'Forecasted hours', 'Accum. hours']).mean()
-        df_catchment_avg.reset_index(inplace=True)
-        df_catchment_avg.insert(1, 'MetService product', fprod)            
-        df_catchment_avg.insert(0, 'Catchment', catch)
-        #-concat with final dataframe
-        df_catchment_avg_final = pd.concat([df_catchment_avg_final, df_catchment_avg], axis=0)
-        df_catchment = None; df_catchment_avg = None;
+    if outOfCore:
+        df = readTableLazy(os.path.join(resultDir, fprod), tableFormat, columns=['ExtSiteID', 'DateTime of forecast', 'MetService product', 'Station precipitation [mm]'] + cols,
+                           parse_dates=['DateTime of forecast'], filters=dateFilter, blocksize=blocksize)
+        #-accumulate per partition after shuffling the rows of each station into one partition (staged on disk), and write partition by partition
+        stageDir = os.path.join(cacheDir, 'stage_' + fprod)
+        with timer('accumulation'):
+            df_canterbury = lazyAccumulate(df, unique_stations, cols, accum_hours, fprod, stageDir)
+            df_canterbury['Month'] = df_canterbury['DateTime of forecast'].dt.month
+            df_canterbury = df_canterbury[['DateTime of forecast', 'Month'] + [c for c in df_canterbury.columns if c not in ['DateTime of forecast', 'Month']]]
+            writeTableParts(iterPartitions(df_canterbury, nWorkers), os.path.join(resultDir, 'cumsum_all_stations_canterbury_' + fprod), tableFormat)
+        shutil.rmtree(stageDir, ignore_errors=True)
+        #-averages per catchment from the sums and counts per partition of the accumulated table
+        df = readTableLazy(os.path.join(resultDir, 'cumsum_all_stations_canterbury_' + fprod), tableFormat, columns=['ExtSiteID', 'DateTime of forecast',
+                           'Forecasted hours', 'Accum. hours', 'Accum. station precipitation [mm]', 'Accum. forecasted precipitation [mm]', 'Hcount'],
+                           parse_dates=['DateTime of forecast'], blocksize=blocksize)
+        df = df.rename(columns={'Accum. station precipitation [mm]': 'Accum. catchment precipitation [mm]'})
+        with timer('catchments'):
+            df_catchment_avg_final = lazyCatchmentAverage(df, ['DateTime of forecast', 'Forecasted hours', 'Accum. hours'], ['Accum. catchment precipitation [mm]',
+                                                          'Accum. forecasted precipitation [mm]', 'Hcount'], unique_catchments, membership)
+    else:
+        #-only read the forecast hours that are needed
+        df = readTable(os.path.join(resultDir, fprod), tableFormat, columns=['ExtSiteID', 'DateTime of forecast', 'MetService product', 'Station precipitation [mm]'] + cols,
+                       parse_dates=['DateTime of forecast'], filters=dateFilter)
+        #-accumulate station and forecasted precipitation for all forecast hours, stations and accumulation hours in one grouped pass. Hcount is the
+        #-number of hours with data that were really aggregated over the interval.
+        with timer('accumulation', len(df), 'rows'):
+            df_canterbury = accumulateWindows(df, unique_stations, cols, accum_hours, fprod)
+        #-write to csv file
+        temp_df = df_canterbury['DateTime of forecast'].dt.month
+        df_canterbury.insert(1, 'Month', temp_df)
+        writeTable(df_canterbury, os.path.join(resultDir, 'cumsum_all_stations_canterbury_' + fprod), tableFormat)
+        df_canterbury.drop('Month', axis=1, inplace=True)
+        #-rename station column to catchment precipitation for the next catchment averages
+        df_canterbury.rename(columns={'Accum. station precipitation [mm]': 'Accum. catchment precipitation [mm]'}, inplace=True)
+        #-now create the averages per catchment in one groupby
+        with timer('catchments', len(df_canterbury), 'rows'):
+            df_catchment_avg_final = catchmentAverage(joinCatchments(df_canterbury, membership), ['DateTime of forecast', 'Forecasted hours', 'Accum. hours'],
+                                                      ['Accum. catchment precipitation [mm]', 'Accum. forecasted precipitation [mm]', 'Hcount'], unique_catchments)
+    df = None
+    df_catchment_avg_final.insert(2, 'MetService product', fprod)
+    df_catchment_avg_final = df_catchment_avg_final[['Catchment', 'DateTime of forecast', 'MetService product', 'Forecasted hours', 'Accum. hours',
+                                                     'Accum. catchment precipitation [mm]', 'Accum. forecasted precipitation [mm]', 'Hcount']]
+    df_canterbury = None
     #-write catchment averages to csv file
     temp_df = df_catchment_avg_final['DateTime of forecast'].dt.month
     df_catchment_avg_final.insert(2, 'Month', temp_df)
-    df_catchment_avg_final.to_csv(os.path.join(resultDir, 'cumsum_catchments_avg_' + fprod + '.csv'), index=False)
+    writeTable(df_catchment_avg_final, os.path.join(resultDir, 'cumsum_catchments_avg_' + fprod), tableFormat)
+stopProfile(profile, 'organize_for_plots PART 2')
+report('organize_for_plots PART 2')
  
  
-#-Calculate the statistics
+#-Calculate the statistics. The sufficient statistics (n, sums of x, y, x^2, y^2, xy and Hcount) of all groups are calculated in one groupby pass
+#-and written to a table as well, so that they can be merged with the sums of new forecast runs (verification.mergeSums) later on.
+statCols = ['R-squared [-]', 'RMSE [mm]', 'Bias [%]', 'Nr. of observations']
+profile = startProfile('organize_for_plots statistics')
 for fprod in Fproducts:
-    df_canterbury_stats = pd.DataFrame(columns=['Forecasted hours', 'Accum. hours', 'R-squared [-]', 'RMSE [mm]', 'Bias [%]', 'Nr. of observations'])
-    df = pd.read_csv(os.path.join(resultDir, 'cumsum_all_stations_canterbury_' + fprod + '.csv'), parse_dates=[0], dayfirst=True)
-    for fhours in range(1,24+1):
-        for ah in accum_hours:
-            df_sel = df.loc[(df['Forecasted hours']==fhours) & (df['Accum. hours']==ah)]
-            hcount = df_sel['Hcount'].mean()
-            x = df_sel[['Accum. station precipitation [mm]']]
-            y = df_sel[['Accum. forecasted precipitation [mm]']]
-            
-            #-calculate the bias
-            fbias = ((y.mean().to_numpy()[0] - x.mean().to_numpy()[0]) / x.mean().to_numpy()[0])*100
-            
-            x = sm.add_constant(x)  #-needed for intercept
-                
-            #-linear fit
-            model = sm.OLS(y, x).fit()
-            #-Calculate some stats
-            rmse_val = np.sqrt(  np.mean(   (y.to_numpy()[:,0] - x.to_numpy()[:,1])**2   )  ) / hcount
-            R2 = model.rsquared_adj
-              
-            nrObs = len(y)
-            #-Put the statistics in the dataframe
-            df_stats = pd.DataFrame(data={'Forecasted hours': [fhours], 'Accum. hours': [ah], 'R-squared [-]': [R2], 'RMSE [mm]': [rmse_val], 'Bias [%]': [fbias], 'Nr. of observations': [nrObs]})
-            #-concat with final dataframe
-            df_canterbury_stats = pd.concat([df_canterbury_stats, df_stats], axis=0)
-            df_stats = None; df_sel = None;
-        
-    df_canterbury_stats.to_csv(os.path.join(resultDir, 'cumsum_statistics_all_stations_canterbury_' + fprod + '.csv'), index=False)
-    df_canterbury_stats = None; df = None;
+    statsColumns = ['Forecasted hours', 'Accum. hours', 'Accum. station precipitation [mm]', 'Accum. forecasted precipitation [mm]', 'Hcount']
+    if outOfCore:
+        #-sums per partition, merged
+        with timer('statistics'):
+            sums = lazySums(readTableLazy(os.path.join(resultDir, 'cumsum_all_stations_canterbury_' + fprod), tableFormat, columns=statsColumns, blocksize=blocksize),
+                            ['Forecasted hours', 'Accum. hours'], 'Accum. station precipitation [mm]', 'Accum. forecasted precipitation [mm]')
+    else:
+        df = readTable(os.path.join(resultDir, 'cumsum_all_stations_canterbury_' + fprod), tableFormat, columns=statsColumns)
+        with timer('statistics', len(df), 'rows'):
+            sums = groupSums(df, ['Forecasted hours', 'Accum. hours'], 'Accum. station precipitation [mm]', 'Accum. forecasted precipitation [mm]')
+    writeTable(sums.reset_index(), os.path.join(resultDir, 'cumsum_sums_all_stations_canterbury_' + fprod), tableFormat)
+    df_canterbury_stats = statsFromSums(sums).reset_index()[['Forecasted hours', 'Accum. hours'] + statCols]
+    if bootstrap:
+        #-the resampling needs the rows in memory; in the out-of-core mode only the columns of the statistics are read
+        if outOfCore:
+            df = readTable(os.path.join(resultDir, 'cumsum_all_stations_canterbury_' + fprod), tableFormat, columns=statsColumns)
+        with timer('bootstrap', len(df) * nBoot, 'resampled rows'):
+            ci = bootstrapCI(df, ['Forecasted hours', 'Accum. hours'], 'Accum. station precipitation [mm]', 'Accum. forecasted precipitation [mm]', nBoot=nBoot,
+                             alpha=bootAlpha, seed=bootSeed, nWorkers=bootWorkers)
+        df_canterbury_stats = df_canterbury_stats.merge(ci.reset_index(), on=['Forecasted hours', 'Accum. hours'], how='left')
+    df = None
+    writeTable(df_canterbury_stats, os.path.join(resultDir, 'cumsum_statistics_all_stations_canterbury_' + fprod), tableFormat)
+    df_canterbury_stats = None; sums = None;
         
     #-Now for all the catchments
-    df = pd.read_csv(os.path.join(resultDir, 'cumsum_catchments_avg_' + fprod + '.csv'), parse_dates=[0], dayfirst=True)
-    df_catchment_stats = pd.DataFrame(columns=['Catchment', 'Forecasted hours', 'Accum. hours', 'R-squared [-]', 'RMSE [mm]', 'Bias [%]', 'Nr. of observations'])
-    for catch in unique_catchments:
-        print('Processing %s' %catch)
-        for fhours in range(1,24+1):
-            for ah in accum_hours:
-                df_sel = df.loc[(df['Catchment']==catch) & (df['Forecasted hours']==fhours) & (df['Accum. hours']==ah)]
-                try:
-                    hcount = df_sel['Hcount'].mean()
-                    x = df_sel[['Accum. catchment precipitation [mm]']]
-                    y = df_sel[['Accum. forecasted precipitation [mm]']]
-                    
-                    #-calculate the bias
-                    fbias = ((y.mean().to_numpy()[0] - x.mean().to_numpy()[0]) / x.mean().to_numpy()[0])*100
-                    
-                    x = sm.add_constant(x)  #-needed for intercept
-                    #-linear fit
-                    model = sm.OLS(y, x).fit()
-                    #-Calculate some stats
-                    rmse_val = np.sqrt(  np.mean(   (y.to_numpy()[:,0] - x.to_numpy()[:,1])**2   )  ) / hcount
-                    R2 = model.rsquared_adj
-                    nrObs = len(y)
-                    flag = True
-                except:
-                    flag = False
-                if flag:
-                    #-Put the statistics in the dataframe
-                    df_stats = pd.DataFrame(data={'Catchment': [catch], 'Forecasted hours': [fhours], 'Accum. hours': [ah], 'R-squared [-]': [R2], 'RMSE [mm]': [rmse_val], 'Bias [%]': [fbias], 'Nr. of observations': [nrObs]})
-                    #-concat with final dataframe
-                    df_catchment_stats = pd.concat([df_catchment_stats, df_stats], axis=0)
-                df_stats = None; df_sel = None;
-        
-    df_catchment_stats.to_csv(os.path.join(resultDir, 'cumsum_statistics_catchments_avg_' + fprod + '.csv'), index=False)
-    df = None; df_catchment_stats = None;
-       
+    df = readTable(os.path.join(resultDir, 'cumsum_catchments_avg_' + fprod), tableFormat, columns=['Catchment', 'Forecasted hours', 'Accum. hours',
+                   'Accum. catchment precipitation [mm]', 'Accum. forecasted precipitation [mm]', 'Hcount'])
+    with timer('statistics', len(df), 'rows'):
+        sums = groupSums(df, ['Catchment', 'Forecasted hours', 'Accum. hours'], 'Accum. catchment precipitation [mm]', 'Accum. forecasted precipitation [mm]')
+    #-order the catchments as in the catchment shapefile (the catchment averages are small, so they are read in memory in the out-of-core mode as well)
+    sums = sums.reindex(pd.Index(unique_catchments, name='Catchment'), level='Catchment')
+    writeTable(sums.reset_index(), os.path.join(resultDir, 'cumsum_sums_catchments_avg_' + fprod), tableFormat)
+    df_catchment_stats = statsFromSums(sums).reset_index()[['Catchment', 'Forecasted hours', 'Accum. hours'] + statCols]
+    if bootstrap:
+        with timer('bootstrap', len(df) * nBoot, 'resampled rows'):
+            ci = bootstrapCI(df, ['Catchment', 'Forecasted hours', 'Accum. hours'], 'Accum. catchment precipitation [mm]', 'Accum. forecasted precipitation [mm]',
+                             nBoot=nBoot, alpha=bootAlpha, seed=bootSeed, nWorkers=bootWorkers)
+        df_catchment_stats = df_catchment_stats.merge(ci.reset_index(), on=['Catchment', 'Forecasted hours', 'Accum. hours'], how='left')
+    df = None
+    writeTable(df_catchment_stats, os.path.join(resultDir, 'cumsum_statistics_catchments_avg_' + fprod), tableFormat)
+    df_catchment_stats = None; sums = None;
+stopProfile(profile, 'organize_for_plots statistics')
+report('organize_for_plots statistics')
+
+#-keep track of the organized products and the files that were produced from them
+for fprod in Fproducts:
+    outputs = [os.path.join(resultDir, prefix + fprod) for prefix in ['all_stations_canterbury_', 'all_stations_catchments_', 'catchments_avg_', 'cumsum_all_stations_canterbury_',
+               'cumsum_catchments_avg_', 'cumsum_sums_all_stations_canterbury_', 'cumsum_sums_catchments_avg_', 'cumsum_statistics_all_stations_canterbury_',
+               'cumsum_statistics_catchments_avg_'] + (['catchments_grid_mean_', 'catchments_grid_avg_'] if gridMeans else [])]
+    #-csv export for plotting
+    if csvExport and tableFormat != 'csv':
+        for f in outputs:
+            exportCsv(f, tableFormat)
+    recordFile(manifest, tableFile(os.path.join(resultDir, fprod), tableFormat), [tableFile(f, tableFormat) for f in outputs], productSettings[fprod])
+saveManifest(manifest, manifestFile)
+if client is not None:
+    client.close()
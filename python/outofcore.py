@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+import pandas as pd
+from accumulate import accumulateWindows
+from verification import groupSums, mergeSums, percentError
+from catchments import joinCatchments
+
+'''
+Out-of-core (dask) versions of the organize steps for archives that do not fit in memory (e.g. multiple years of all products). The station
+comparison tables are read as partitioned lazy dataframes (see tableio.readTableLazy) and each step is done per partition: the percentual
+errors and the accumulation windows are written partition by partition, and the catchment averages and the verification statistics are
+combined from small partial sums per partition. Only one partition per worker is in memory at a time.
+'''
+
+
+def startScheduler(scheduler='threads', nWorkers=4, memoryLimit='3GB', tempDir=None):
+    '''
+    Sets the dask scheduler that executes the lazy dataframes and arrays.
+
+    Optional Input:
+    ---------------
+        scheduler:   'threads', 'processes' or 'synchronous' (local schedulers), or 'distributed' (local cluster with a memory limit per worker)
+        nWorkers:    Number of workers (threads or processes)
+        memoryLimit: Memory limit per worker (only used for the distributed scheduler, e.g. '3GB'); a worker that exceeds it spills partitions
+                     to disk and is restarted before the node runs out of memory. For the local schedulers the memory use is bounded by the
+                     number of workers times the partition size.
+        tempDir:     Directory used by dask to spill to disk (default is the system temp directory)
+
+    Returns:
+    --------
+        client:      dask.distributed Client for the distributed scheduler (close it when done), otherwise None
+    '''
+    import dask
+    if tempDir:
+        dask.config.set({'temporary_directory': tempDir})
+    if scheduler == 'distributed':
+        from dask.distributed import Client, LocalCluster
+        cluster = LocalCluster(n_workers=nWorkers, threads_per_worker=1, memory_limit=memoryLimit, local_directory=tempDir)
+        return Client(cluster)
+    if scheduler not in ['threads', 'processes', 'synchronous']:
+        raise ValueError('Unknown dask scheduler: %s' %scheduler)
+    dask.config.set({'scheduler': scheduler, 'num_workers': nWorkers})
+    return None
+
+def iterPartitions(ddf, nParallel=1):
+    '''
+    Computes the partitions of a lazy dataframe in order, nParallel partitions at a time, e.g. to write them one after another to a table
+    (see tableio.writeTableParts).
+
+    Input:
+    ------
+        ddf:       Dask dataframe
+
+    Optional Input:
+    ---------------
+        nParallel: Number of partitions that are computed at once (and are in memory at the same time)
+
+    Returns:
+    --------
+        Generator with a pandas dataframe per partition
+    '''
+    import dask
+    parts = ddf.to_delayed()
+    for i in range(0, len(parts), nParallel):
+        for df in dask.compute(*parts[i:i+nParallel]):
+            yield df
+
+def _mapPartitions(func, ddf, *args):
+    '''
+    Applies a function to each partition of a lazy dataframe with the current scheduler and returns the (small) results as a list.
+    '''
+    import dask
+    return list(dask.compute(*[dask.delayed(func)(part, *args) for part in ddf.to_delayed()]))
+
+def lazyPercentError(ddf, leads, keepCols, membership=None):
+    '''
+    Lazy percentual errors per station (see verification.percentError), optionally joined with the catchments of the stations.
+
+    Input:
+    ------
+        ddf:        Dask dataframe with the station comparison table
+        leads:      List with the names of the forecast hour columns
+        keepCols:   List with the columns to keep
+
+    Optional Input:
+    ---------------
+        membership: Membership table (see catchments.catchmentMembership); if given the rows are repeated for each catchment of the station
+
+    Returns:
+    --------
+        Dask dataframe with the percentual errors per partition
+    '''
+    if membership is None:
+        return ddf.map_partitions(percentError, leads, keepCols)
+    return ddf.map_partitions(_percentErrorCatchments, leads, keepCols, membership)
+
+def _percentErrorCatchments(df, leads, keepCols, membership):
+    '''
+    Percentual errors of one partition, joined with the catchments of the stations.
+    '''
+    return joinCatchments(percentError(df, leads, keepCols), membership)
+
+def _partialMeans(df, keys, valueCols, membership):
+    '''
+    Sums and counts of the values per catchment and keys of one partition.
+    '''
+    df = joinCatchments(df, membership)
+    grouped = df.groupby(['Catchment'] + keys, observed=True)[valueCols]
+    return grouped.sum(), grouped.count()
+
+def lazyCatchmentAverage(ddf, keys, valueCols, catchments, membership):
+    '''
+    Averages the station values per catchment and keys (see catchments.catchmentAverage) from the sums and counts per partition. The result
+    is small (one row per catchment and key) and is returned as a pandas dataframe.
+
+    Input:
+    ------
+        ddf:        Dask dataframe with the station values and an 'ExtSiteID' column
+        keys:       List with the columns to group on besides the catchment (e.g. ['DateTime of forecast'])
+        valueCols:  List with the columns to average
+        catchments: List with the catchment names in the output order
+        membership: Membership table (see catchments.catchmentMembership)
+
+    Returns:
+    --------
+        df_avg:     Pandas dataframe with the catchment, the keys and the averaged values, ordered by catchment and keys
+    '''
+    partial = _mapPartitions(_partialMeans, ddf, keys, valueCols, membership)
+    levels = list(range(len(keys) + 1))
+    sums = pd.concat([s for s, c in partial]).groupby(level=levels).sum()
+    counts = pd.concat([c for s, c in partial]).groupby(level=levels).sum()
+    df_avg = (sums / counts.where(counts > 0)).reset_index()
+    #-order the catchments as in the catchment shapefile
+    df_avg['Catchment'] = pd.Categorical(df_avg['Catchment'], categories=catchments)
+    df_avg = df_avg.loc[df_avg['Catchment'].notna()].sort_values(['Catchment'] + keys, kind='stable')
+    df_avg['Catchment'] = df_avg['Catchment'].astype(object)
+    return df_avg.reset_index(drop=True)
+
+def lazyAccumulate(ddf, stations, leads, accumHours, product, stageDir, idCol='ExtSiteID'):
+    '''
+    Lazy accumulation windows (see accumulate.accumulateWindows). The rows are first shuffled so that all rows of a station end up in the
+    same partition, and the shuffled partitions are staged to Parquet files on disk; each staged partition is then accumulated on its own.
+
+    Input:
+    ------
+        ddf:        Dask dataframe with the station precipitation and the forecast hour columns
+        stations:   List with the station IDs to include
+        leads:      List with the names of the forecast hour columns
+        accumHours: List with accumulation windows in hours
+        product:    Name of the MetService product
+        stageDir:   Directory where the shuffled partitions are staged (overwritten; can be removed when the result has been computed)
+
+    Optional Input:
+    ---------------
+        idCol:      Name of the station ID column
+
+    Returns:
+    --------
+        Dask dataframe with the accumulated precipitation; within a partition ordered by forecast hour, station, window and time
+    '''
+    import dask.dataframe as dd
+    ddf.loc[ddf[idCol].isin(list(stations))].shuffle(on=idCol).to_parquet(stageDir, write_index=False, overwrite=True)
+    ddf = dd.read_parquet(stageDir)
+    meta = accumulateWindows(ddf._meta, stations, leads, accumHours, product)
+    return ddf.map_partitions(accumulateWindows, stations, leads, accumHours, product, meta=meta)
+
+def lazySums(ddf, keys, xCol, yCol, countCol='Hcount'):
+    '''
+    Sufficient statistics per group (see verification.groupSums) calculated per partition and merged.
+
+    Input:
+    ------
+        ddf:      Dask dataframe
+        keys:     List with the columns to group on
+        xCol:     Name of the observation column
+        yCol:     Name of the forecast column
+
+    Optional Input:
+    ---------------
+        countCol: Name of the column with the number of aggregated hours
+
+    Returns:
+    --------
+        sums:     Pandas dataframe with the sums per group (index are the keys)
+    '''
+    sums = None
+    for partSums in _mapPartitions(groupSums, ddf, keys, xCol, yCol, countCol):
+        sums = mergeSums(sums, partSums)
+    return sums.sort_index()
@@ -0,0 +1,626 @@
+#!/usr/bin/env python
+
+import pandas as pd
+import numpy as np
+import os, glob, pickle, threading, queue, pytz
+from sampling import stationPixelIndex
+from nctools import readPrecipCube, iterNcCubes, sampleRuns
+from gridtools import gridNZTM, targetGrid, gridWeights
+from manifest import loadManifest, saveManifest, changedFiles, recordFile
+from tableio import writeTable
+from catchments import catchmentMembership
+from verification import sumCols, statsFromSums
+from instrument import configure, timer, progress, report, log, startProfile, stopProfile, collect, merge
+from timeutils import ncRunTime, utcToLocal
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+'''
+Streaming pipeline runner: netCDF -> station forecasts -> accumulation windows -> verification statistics, without intermediate files.
+Each forecast run flows through the stages as a generator pipeline; decoding and sampling run in their own threads and are connected with
+bounded queues, so at most a few forecast runs are in memory at once.
+
+The hourly forecasts are added to the open accumulation windows (per forecast hour, accumulation window and station). A window is closed as
+soon as no later run can add to it anymore (runs arrive in chronological order), and its station and catchment sums are added to the
+sufficient statistics (see verification.py). The statistics tables are updated after every run. As in combine_station_forecast.py and
+organize_for_plots.py, only hours with a non-zero station value and a forecasted value are accumulated.
+
+Optional persistence taps write the station forecasts of each run (npz) and the statistics tables. With incremental processing the
+window state is saved, so that newly arrived runs are added without processing the history again. The windows that are still open are
+included in the statistics tables as provisional sums, so the tables are up to date after every run. The state is rebuilt from all runs
+if a new or changed run is not later than the last run of the state, or if the stations, catchments, forecast hours or accumulation
+windows changed.
+'''
+
+
+def threaded(iterable, maxsize=2):
+    '''
+    Runs a generator in a background thread and passes its items through a bounded queue. The thread blocks when the queue is full, so the
+    producer is never more than maxsize items ahead of the consumer. Exceptions in the producer are raised in the consumer.
+
+    Input:
+    ------
+        iterable: Iterable (e.g. a generator) to run in the background
+
+    Optional Input:
+    ---------------
+        maxsize:  Maximum number of items in the queue
+
+    Returns:
+    --------
+        Generator that yields the items of iterable
+    '''
+    q = queue.Queue(maxsize=maxsize)
+    done = object()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        q.put(('item', item), timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            q.put(('done', done))
+        except BaseException as e:
+            q.put(('error', e))
+
+    t = threading.Thread(target=produce, daemon=True)
+    t.start()
+    try:
+        while True:
+            kind, item = q.get()
+            if kind == 'done':
+                break
+            if kind == 'error':
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+def tap(iterable, func):
+    '''
+    Persistence tap: calls func for each item and passes the item on unchanged.
+
+    Input:
+    ------
+        iterable: Iterable with the items of a stage
+        func:     Function that is called with each item (e.g. to write it to disk)
+
+    Returns:
+    --------
+        Generator that yields the items of iterable
+    '''
+    for item in iterable:
+        func(item)
+        yield item
+
+def observationMatrix(statTS_df, statIDs, datetime_range):
+    '''
+    Returns the station values in a (stations x hours) matrix. As in combine_station_forecast.py, missing and zero station values are NaN.
+
+    Input:
+    ------
+        statTS_df:      Dataframe with the columns 'ExtSiteID', 'DateTime' and 'Value'
+        statIDs:        List with station IDs (rows of the matrix)
+        datetime_range: DatetimeIndex with hourly timestamps (columns of the matrix)
+
+    Returns:
+    --------
+        obs: Array with shape (stations, hours)
+    '''
+    statTS_sel = statTS_df.drop_duplicates(subset=['ExtSiteID', 'DateTime'], keep='first')
+    rows = pd.Index(statIDs).get_indexer(statTS_sel['ExtSiteID'])
+    cols = datetime_range.get_indexer(statTS_sel['DateTime'])
+    sel = (rows >= 0) & (cols >= 0)
+    obs = np.full((len(statIDs), len(datetime_range)), np.nan)
+    obs[rows[sel], cols[sel]] = statTS_sel['Value'].to_numpy(dtype=np.float64)[sel]
+    obs[obs == 0] = np.nan
+    return obs
+
+def stateKeys(statIDs, catchments, leads, accumHours):
+    '''
+    Returns the keys that determine the layout of a window state: the station IDs (rows of the windows), the catchments, the number of
+    forecast hours and the accumulation windows. A saved state can only be continued if its keys are the same.
+    '''
+    return {'statIDs': [str(s) for s in statIDs], 'catchments': list(catchments), 'leads': int(leads), 'accumHours': [int(a) for a in accumHours]}
+
+def newWindowState(nstations, leads, accumHours, ncatchments=0):
+    '''
+    Returns an empty state for the streaming accumulation.
+
+    Input:
+    ------
+        nstations:   Number of stations
+        leads:       Number of forecast hours to accumulate (forecast hours 1 to leads)
+        accumHours:  List with accumulation windows in hours; each must be a divisor of 24
+
+    Optional Input:
+    ---------------
+        ncatchments: Number of catchments
+
+    Returns:
+    --------
+        state: Dictionary with the open windows, the station sums with shape (leads, windows, 7) and the catchment sums with shape
+               (catchments, leads, windows, 7). The last axis holds the sufficient statistics in the order of verification.sumCols.
+    '''
+    for ah in accumHours:
+        if 24 % ah:
+            raise ValueError('Accumulation window of %s hours is not a divisor of 24' %ah)
+    return {'nstations': nstations, 'leads': leads, 'accumHours': list(accumHours), 'lastRun': None, 'windows': {},
+            'stationSums': np.zeros((leads, len(accumHours), len(sumCols))),
+            'catchmentSums': np.zeros((ncatchments, leads, len(accumHours), len(sumCols)))}
+
+def _addSums(sums, x, y, h):
+    sums[..., 0] += np.ones_like(x).sum(axis=-1)
+    sums[..., 1] += x.sum(axis=-1)
+    sums[..., 2] += y.sum(axis=-1)
+    sums[..., 3] += (x * x).sum(axis=-1)
+    sums[..., 4] += (y * y).sum(axis=-1)
+    sums[..., 5] += (x * y).sum(axis=-1)
+    sums[..., 6] += h.sum(axis=-1)
+
+def closeWindows(state, M, validTimes=None, stationMask=None):
+    '''
+    Closes the open windows that can not receive hourly values anymore and adds them to the sufficient statistics. A window of forecast
+    hour l is closed if its right edge is not later than the valid time of forecast hour l of the next run.
+
+    Input:
+    ------
+        state:       State of the streaming accumulation (see newWindowState)
+        M:           Array with shape (catchments, stations) that is 1 if a station is part of a catchment
+
+    Optional Input:
+    ---------------
+        validTimes:  DatetimeIndex with the valid times of forecast hours 1, 2, ... of the next run. If None, all windows are closed.
+        stationMask: Boolean array that is True for the stations to include in the station statistics (default all)
+    '''
+    windows = state['windows']
+    if validTimes is not None:
+        edges = validTimes.asi8[:state['leads']]
+    for key in list(windows.keys()):
+        l, a, label = key
+        if validTimes is not None and (l >= len(edges) or label > edges[l]):
+            continue
+        obsSum, fcSum, count = windows.pop(key)
+        has = count > 0
+        #-stations
+        sel = has if stationMask is None else has & stationMask
+        _addSums(state['stationSums'][l, a], obsSum[sel], fcSum[sel], count[sel])
+        #-catchment averages over the stations with data
+        if len(M):
+            n = M.dot(has.astype(np.float64))
+            ok = n > 0
+            if ok.any():
+                x = M.dot(np.where(has, obsSum, 0.))[ok] / n[ok]
+                y = M.dot(np.where(has, fcSum, 0.))[ok] / n[ok]
+                h = M.dot(count)[ok] / n[ok]
+                s = state['catchmentSums'][ok, l, a]
+                s[:, 0] += 1; s[:, 1] += x; s[:, 2] += y; s[:, 3] += x * x; s[:, 4] += y * y; s[:, 5] += x * y; s[:, 6] += h
+                state['catchmentSums'][ok, l, a] = s
+
+def addRun(state, forecastTimes, values, obs, M, stationMask=None):
+    '''
+    Adds the hourly forecasts of a run to the open windows, after closing the windows that this run (and later runs) can not add to anymore.
+
+    Input:
+    ------
+        state:         State of the streaming accumulation (see newWindowState)
+        forecastTimes: DatetimeIndex with the (NZ) timestamps of the run; the first one is the start of the run
+        values:        Array with shape (stations, forecast hours) with the forecasted precipitation
+        obs:           Array with shape (stations, forecast hours) with the station precipitation at the valid times (NaN if missing)
+        M:             Array with shape (catchments, stations) that is 1 if a station is part of a catchment
+
+    Optional Input:
+    ---------------
+        stationMask:   Boolean array that is True for the stations to include in the station statistics (default all)
+
+    Returns:
+    --------
+        added: False if the run is not later than the last run that was added (the run is skipped), True otherwise
+    '''
+    runTime = forecastTimes[0]
+    if state['lastRun'] is not None and runTime <= state['lastRun']:
+        log('skipped_run', run=runTime, last_run=state['lastRun'])
+        return False
+    validTimes = forecastTimes[1:]
+    closeWindows(state, M, validTimes, stationMask=stationMask)
+    nleads = min(state['leads'], values.shape[1])
+    for a, ah in enumerate(state['accumHours']):
+        labels = (validTimes[:nleads].floor(str(ah) + 'h') + pd.Timedelta(hours=ah)).asi8
+        for l in range(nleads):
+            ok = ~np.isnan(values[:, l]) & ~np.isnan(obs[:, l])
+            if not ok.any():
+                continue
+            key = (l, a, int(labels[l]))
+            w = state['windows'].get(key)
+            if w is None:
+                w = state['windows'][key] = (np.zeros(state['nstations']), np.zeros(state['nstations']), np.zeros(state['nstations']))
+            w[0][ok] += obs[ok, l]
+            w[1][ok] += values[ok, l]
+            w[2][ok] += 1
+    state['lastRun'] = runTime
+    return True
+
+def provisionalState(state, M, stationMask=None):
+    '''
+    Returns a copy of a window state in which the open windows are closed, so that the sums include the (provisional) sums of the windows
+    that later runs can still add to. The state itself is not changed.
+
+    Input:
+    ------
+        state:       State of the streaming accumulation (see newWindowState)
+        M:           Array with shape (catchments, stations) that is 1 if a station is part of a catchment
+
+    Optional Input:
+    ---------------
+        stationMask: Boolean array that is True for the stations to include in the station statistics (default all)
+
+    Returns:
+    --------
+        state:       Copy of the state without open windows
+    '''
+    provisional = dict(state)
+    provisional['windows'] = dict(state['windows'])
+    provisional['stationSums'] = state['stationSums'].copy()
+    provisional['catchmentSums'] = state['catchmentSums'].copy()
+    closeWindows(provisional, M, stationMask=stationMask)
+    return provisional
+
+def stateSums(state, accumHours, catchments):
+    '''
+    Returns the sufficient statistics of the closed windows in the layout of verification.groupSums.
+
+    Input:
+    ------
+        state:      State of the streaming accumulation (see newWindowState)
+        accumHours: List with accumulation windows in hours
+        catchments: List with catchment names in the order of the rows of M
+
+    Returns:
+    --------
+        [sums, catchSums]: Dataframes indexed by ('Forecasted hours', 'Accum. hours') and ('Catchment', 'Forecasted hours', 'Accum. hours')
+    '''
+    leads = np.arange(1, state['leads']+1)
+    index = pd.MultiIndex.from_product([leads, accumHours], names=['Forecasted hours', 'Accum. hours'])
+    sums = pd.DataFrame(state['stationSums'].reshape(-1, len(sumCols)), columns=sumCols, index=index)
+    sums = sums.loc[sums['n'] > 0]
+    sums['n'] = sums['n'].astype(np.int64)
+    index = pd.MultiIndex.from_product([catchments, leads, accumHours], names=['Catchment', 'Forecasted hours', 'Accum. hours'])
+    catchSums = pd.DataFrame(state['catchmentSums'].reshape(-1, len(sumCols)), columns=sumCols, index=index)
+    catchSums = catchSums.loc[catchSums['n'] > 0]
+    catchSums['n'] = catchSums['n'].astype(np.int64)
+    return sums, catchSums
+
+def writeStats(state, accumHours, catchments, resultDir, fprod, tableFormat='csv', M=None, stationMask=None):
+    '''
+    Writes the sufficient statistics and the verification statistics of the closed windows, with the same table names and layout as
+    organize_for_plots.py. If M is given, the open windows are included as provisional sums (see provisionalState).
+
+    Input:
+    ------
+        state:       State of the streaming accumulation (see newWindowState)
+        accumHours:  List with accumulation windows in hours
+        catchments:  List with catchment names in the order of the rows of M
+        resultDir:   Directory where the tables are written
+        fprod:       Name of the MetService product
+
+    Optional Input:
+    ---------------
+        tableFormat: Table format ('csv', 'parquet' or 'arrow')
+        M:           Array with shape (catchments, stations) that is 1 if a station is part of a catchment
+        stationMask: Boolean array that is True for the stations to include in the station statistics (default all)
+    '''
+    statCols = ['R-squared [-]', 'RMSE [mm]', 'Bias [%]', 'Nr. of observations']
+    if M is not None:
+        state = provisionalState(state, M, stationMask)
+    sums, catchSums = stateSums(state, accumHours, catchments)
+    writeTable(sums.reset_index(), os.path.join(resultDir, 'cumsum_sums_all_stations_canterbury_' + fprod), tableFormat)
+    writeTable(statsFromSums(sums).reset_index()[['Forecasted hours', 'Accum. hours'] + statCols],
+               os.path.join(resultDir, 'cumsum_statistics_all_stations_canterbury_' + fprod), tableFormat)
+    writeTable(catchSums.reset_index(), os.path.join(resultDir, 'cumsum_sums_catchments_avg_' + fprod), tableFormat)
+    writeTable(statsFromSums(catchSums).reset_index()[['Catchment', 'Forecasted hours', 'Accum. hours'] + statCols],
+               os.path.join(resultDir, 'cumsum_statistics_catchments_avg_' + fprod), tableFormat)
+
+
+
+def writeProductStats(sums, resultDir, tableFormat='csv'):
+    '''
+    Writes the sufficient statistics and the verification statistics of several products to product-dimensioned tables (with a
+    'MetService product' column), so that the products can be compared without joining the tables of each product.
+
+    Input:
+    ------
+        sums:        Dictionary with per product a tuple with the station and catchment sums (see stateSums)
+        resultDir:   Directory where the tables are written
+
+    Optional Input:
+    ---------------
+        tableFormat: Table format ('csv', 'parquet' or 'arrow')
+    '''
+    if not sums:
+        return
+    statCols = ['R-squared [-]', 'RMSE [mm]', 'Bias [%]', 'Nr. of observations']
+    products = list(sums.keys())
+    for i, (name, keys) in enumerate([('all_stations_canterbury', ['Forecasted hours', 'Accum. hours']),
+                                      ('catchments_avg', ['Catchment', 'Forecasted hours', 'Accum. hours'])]):
+        s = pd.concat([sums[fprod][i] for fprod in products], keys=products, names=['MetService product'])
+        writeTable(s.reset_index(), os.path.join(resultDir, 'cumsum_sums_' + name + '_all_products'), tableFormat)
+        writeTable(statsFromSums(s).reset_index()[['MetService product'] + keys + statCols],
+                   os.path.join(resultDir, 'cumsum_statistics_' + name + '_all_products'), tableFormat)
+
+def shareArray(arr):
+    '''
+    Copies an array into shared memory, so that worker processes can read it without a copy of their own.
+
+    Input:
+    ------
+        arr:  NumPy array
+
+    Returns:
+    --------
+        [shm, spec]: SharedMemory object (keep a reference while the workers run, and close and unlink it afterwards), and a tuple
+                     (name, shape, dtype) to attach to the array in a worker (see attachArray)
+    '''
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+def attachArray(spec):
+    '''
+    Attaches to an array in shared memory (see shareArray). The array is read-only.
+
+    Input:
+    ------
+        spec: Tuple (name, shape, dtype) returned by shareArray
+
+    Returns:
+    --------
+        [shm, arr]: SharedMemory object (keep a reference as long as the array is used) and the array
+    '''
+    from multiprocessing import shared_memory
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    arr.flags.writeable = False
+    return shm, arr
+
+#-data that is shared by all products (stations, observations, catchments) and the settings; set by initWorker
+_worker = {}
+
+def initWorker(shared, settings):
+    '''
+    Initializes the process (or a worker process) that runs the products with the data that all products share and the settings. The
+    observation matrix can be passed as a shared memory spec (key 'obsShared', see shareArray) instead of as an array (key 'obs').
+
+    Input:
+    ------
+        shared:   Dictionary with 'statIDs', 'obs' (or 'obsShared'), 'stationMask', 'M', 'catchments', 'tX', 'tY', 'valid' and 'datetime_range'
+        settings: Dictionary with the settings of the pipeline (directories, forecast hours, accumulation windows, etc.)
+    '''
+    _worker.clear()
+    _worker.update(settings)
+    _worker.update(shared)
+    if 'obsShared' in shared:
+        _worker['obsShm'], _worker['obs'] = attachArray(shared['obsShared'])
+
+def runProduct(fprod):
+    '''
+    Runs the streaming pipeline for the new or changed netCDF files of one product, with the shared data and settings set by initWorker.
+    The statistics tables of the product are written as well.
+
+    Input:
+    ------
+        fprod: Name of the MetService product
+
+    Returns:
+    --------
+        [fprod, sums, sections]: sums is a tuple with the station and catchment sums including the provisional sums of the open windows
+                                 (see stateSums and provisionalState), or None if the product has no runs;
+                                 sections are the timers and counters of a worker process (see instrument.collect), or None in the main
+                                 process
+    '''
+    w = _worker
+    statKeys = pd.Index([str(s) for s in w['statIDs']])
+    manifestFile = os.path.join(w['resultDir'], 'manifest_pipeline_' + fprod + '.json')
+    stateFile = os.path.join(w['resultDir'], 'pipeline_state_' + fprod + '.pkl')
+    #-runs are processed in chronological order (the file names start with the run time)
+    allFiles = sorted(glob.glob(os.path.join(w['ncRootDir'], fprod, '*.nc')))
+    manifest = loadManifest(manifestFile) if w['incremental'] else {}
+    ff = changedFiles(manifest, allFiles)
+    keys = stateKeys(w['statIDs'], w['catchments'], w['leads'], w['accumHours'])
+    state = None
+    if w['incremental'] and os.path.isfile(stateFile):
+        with open(stateFile, 'rb') as f:
+            state = pickle.load(f)
+        if state.get('keys') != keys:
+            #-other stations, catchments, forecast hours or windows: the saved sums do not fit anymore
+            log('rebuild_state', product=fprod, reason='settings')
+            state = None
+        elif ff and state['lastRun'] is not None and utcToLocal([ncRunTime(f) for f in ff], w['timeZone']).min() <= state['lastRun']:
+            #-a late or changed run can not be added to windows that are already closed
+            log('rebuild_state', product=fprod, reason='late_run', last_run=state['lastRun'])
+            state = None
+        if state is None:
+            manifest = {}
+            ff = allFiles
+    if not ff:
+        #-nothing new: the statistics of the saved state are still included in the product-dimensioned tables
+        sums = None if state is None else stateSums(provisionalState(state, w['M'], w['stationMask']), w['accumHours'], w['catchments'])
+        return fprod, sums, collect() if w['inWorker'] else None
+    if state is None:
+        state = newWindowState(len(w['statIDs']), w['leads'], w['accumHours'], len(w['catchments']))
+        state['keys'] = keys
+
+    #-linear interpolation weights from the product grid to the stations (triangulated once per product and cached)
+    times, cube, lat, lon = readPrecipCube(ff[0], subdataset='precipitation_amount'); times = None; cube = None
+    srcX, srcY = gridNZTM(lat.ravel(), lon.ravel(), w['gridCacheDir'])
+    W, inside = gridWeights(srcX, srcY, w['tX'], w['tY'], w['gridCacheDir'], bounds=w['bounds'])
+
+    #-decode -> sample, each in its own thread with a bounded queue
+    runs = threaded(sampleRuns(threaded(iterNcCubes(ff, w['timeZone']), w['queueSize']), W, inside, valid=w['valid']), w['queueSize'])
+    tapDir = w['tapDir']
+    if tapDir is not None:
+        if not os.path.exists(tapDir):
+            os.makedirs(tapDir)
+        runs = tap(runs, lambda r: np.savez(os.path.join(tapDir, fprod + '_' + os.path.splitext(os.path.basename(r[0]))[0] + '.npz'),
+                                            ExtSiteID=np.asarray(statKeys), forecastTimes=r[1].values, values=r[2]))
+    stage = 'pipeline ' + fprod
+    #-cProfile can only profile one product at a time
+    profile = startProfile(stage) if w['profile'] else None
+    n = 0
+    obs = w['obs']; datetime_range = w['datetime_range']
+    for ncF, forecastTimes, values in runs:
+        #-station values at the valid times of the forecast hours
+        h = datetime_range.get_indexer(forecastTimes[1:])
+        runObs = np.where(h >= 0, obs[:, np.maximum(h, 0)], np.nan)
+        with timer('accumulation', values.size, 'station-samples'):
+            added = addRun(state, forecastTimes, values, runObs, w['M'], stationMask=w['stationMask'])
+        if not added:
+            #-the runs are in chronological order, so this is a second file with the same run
+            raise ValueError('Run %s of %s is not later than the previous run %s' %(forecastTimes[0], ncF, state['lastRun']))
+        recordFile(manifest, ncF)
+        n += 1
+        progress(stage, n, len(ff), run=forecastTimes[0])
+        if w['statsEvery'] and n % w['statsEvery'] == 0:
+            with timer('statistics', 1, 'updates'):
+                writeStats(state, w['accumHours'], w['catchments'], w['resultDir'], fprod, w['tableFormat'], M=w['M'], stationMask=w['stationMask'])
+    if not w['incremental']:
+        #-no later runs will follow: close the remaining windows
+        closeWindows(state, w['M'], stationMask=w['stationMask'])
+    writeStats(state, w['accumHours'], w['catchments'], w['resultDir'], fprod, w['tableFormat'], M=w['M'], stationMask=w['stationMask'])
+    if w['incremental']:
+        with open(stateFile + '.tmp', 'wb') as f:
+            pickle.dump(state, f)
+        os.replace(stateFile + '.tmp', stateFile)
+        saveManifest(manifest, manifestFile)
+    stopProfile(profile, stage)
+    if w['profile']:
+        report(stage)
+    return fprod, stateSums(provisionalState(state, w['M'], w['stationMask']), w['accumHours'], w['catchments']), collect() if w['inWorker'] else None
+
+
+if __name__ == '__main__':
+
+    #-Directory where result files should be saved
+    resultDir = r'C:\Active\Projects\MetService_precip_analysis\Data\station_metservice_comparison'
+    #-Root directory for the MetService netCDF forecast products
+    ncRootDir = r'C:\Active\Projects\MetService_precip_analysis\Data\nc_forecasts'
+    #-Directory where the NZTM coordinates and interpolation weights of the product grids are cached
+    gridCacheDir = r'C:\Active\Projects\MetService_precip_analysis\Data\temp_files\grid_cache'
+    #-List with products to process
+    Fproducts = ['ECMWF_8km', 'NCEP_4km', 'NCEP_8km', 'UKMO_8km']
+    #-number of products that are processed concurrently (1 processes them one after another), and whether they run in threads ('threads') or
+    #-in worker processes ('processes'). The stations, observations and catchments are loaded once and shared read-only by all products (the
+    #-worker processes read the observation matrix from shared memory). The statistics of all products are also written to tables with a
+    #-'MetService product' column (cumsum_*_all_products).
+    productWorkers = 4
+    executor = 'threads'
+    #-interpolate at the centre of the 1 km pixel that contains the station (True), as process_nc.py + combine_station_forecast.py, or at the
+    #-station coordinates (False)
+    snapToGrid = True
+    #-only process the netCDF files that are new or changed since the previous run, and continue from the saved window state (True), or
+    #-process all netCDF files (False)
+    incremental = True
+    #-number of forecast runs that can wait in the queue between two stages
+    queueSize = 2
+    #-write the statistics tables after every n runs (0 is only at the end)
+    statsEvery = 1
+    #-format of the output tables: 'csv', 'parquet' or 'arrow'
+    tableFormat = 'csv'
+    #-persistence tap: write the station forecasts of each run to an npz-file in tapDir (None to disable)
+    tapDir = None
+    #-JSON log file with the progress and the timers of the hot sections, and the directory for cProfile dumps per product (None disables profiling)
+    logFile = os.path.join(resultDir, 'pipeline_log.jsonl')
+    profileDir = None
+    configure(logFile=logFile, profileDir=profileDir)
+
+    from_date = '2018-08-01 00:00'
+    to_date = '2019-09-12 23:00'
+
+    #-Station files
+    statXY = r'C:\Active\Projects\MetService_precip_analysis\Data\Stations\station_xy.csv'
+    statTS = r'C:\Active\Projects\MetService_precip_analysis\Data\Stations\station_ts.csv'
+    #-Shapefiles that determine station locations and catchments
+    catchment_shp = r'C:\Active\Projects\MetService_precip_analysis\Data\GIS\Catchments_NZTM_major_10kmbuffer.shp'
+    stations_shp = r'C:\Active\Projects\MetService_precip_analysis\Data\GIS\station_xy.shp'
+    cacheDir = os.path.join(resultDir, 'cache')
+
+    #-forecast hours and accumulation windows as in organize_for_plots.py
+    leads = 24
+    accum_hours = [1, 3, 6, 12, 24]
+
+    ##-Output extent of the Canterbury region and resolution of the grid used by process_nc.py
+    xmin = 1323766.5234000002965331 - 5000
+    ymin = 5004696.7684000004082918 - 5000
+    xmax = 1692368.8068000003695488 + 5000
+    ymax = 5361879.5686999997124076 + 5000
+    res = 1000
+    nzTimeZones = pytz.country_timezones['nz'][0]
+    datetime_range = pd.date_range(pd.Timestamp(from_date), pd.Timestamp(to_date), freq='h')
+
+    #-stations, their observations and their catchments
+    statXY_df = pd.read_csv(statXY)
+    statIDs = pd.unique(statXY_df.ExtSiteID).tolist()
+    statXY_unique = statXY_df.drop_duplicates(subset='ExtSiteID').set_index('ExtSiteID').loc[statIDs]
+    statX = statXY_unique['NZTMX'].to_numpy(dtype=np.float64)
+    statY = statXY_unique['NZTMY'].to_numpy(dtype=np.float64)
+    statXY_unique = None
+    obs = observationMatrix(pd.read_csv(statTS, parse_dates=[1], dayfirst=True), statIDs, datetime_range)
+    import geopandas as gpd
+    #-as in organize_for_plots.py the station statistics only include the stations in the station shapefile
+    statKeys = pd.Index([str(s) for s in statIDs])
+    stationMask = statKeys.isin([str(s) for s in gpd.read_file(stations_shp)['ExtSiteID']])
+    membership = catchmentMembership(stations_shp, catchment_shp, cacheDir)
+    catchments = pd.unique(membership['Catchment']).tolist()
+    M = np.zeros((len(catchments), len(statIDs)))
+    pos = statKeys.get_indexer(membership['ExtSiteID'].astype(str))
+    M[pd.Index(catchments).get_indexer(membership['Catchment'])[pos >= 0], pos[pos >= 0]] = 1
+
+    geoTrans, xc, yc = targetGrid(xmin, ymin, xmax, ymax, np.ceil((xmax-xmin)/res), np.ceil((ymax-ymin)/res))
+    row, col, valid = stationPixelIndex(geoTrans, xc.shape[0], xc.shape[1], statX, statY)
+    if snapToGrid:
+        tX = xc[row, col]; tY = yc[row, col]
+    else:
+        tX = statX; tY = statY
+
+    #-data that is shared by all products, and the settings of the pipeline
+    shared = {'statIDs': statIDs, 'obs': obs, 'stationMask': stationMask, 'M': M, 'catchments': catchments, 'tX': tX, 'tY': tY, 'valid': valid,
+              'datetime_range': datetime_range}
+    concurrent = productWorkers > 1 and len(Fproducts) > 1
+    settings = {'resultDir': resultDir, 'ncRootDir': ncRootDir, 'gridCacheDir': gridCacheDir, 'bounds': (xmin,ymin,xmax,ymax), 'timeZone': nzTimeZones,
+                'incremental': incremental, 'queueSize': queueSize, 'statsEvery': statsEvery, 'tableFormat': tableFormat, 'tapDir': tapDir,
+                'leads': leads, 'accumHours': accum_hours, 'profile': not concurrent, 'inWorker': False}
+    shm = None; pool = None
+    productSums = {}
+    try:
+        if concurrent and executor == 'processes':
+            #-the observation matrix is put in shared memory once instead of being copied to each worker
+            shm, shared['obsShared'] = shareArray(obs)
+            shared.pop('obs')
+            pool = ProcessPoolExecutor(max_workers=productWorkers, initializer=initWorker, initargs=(shared, dict(settings, inWorker=True)))
+            results = pool.map(runProduct, Fproducts)
+        else:
+            initWorker(shared, settings)
+            pool = ThreadPoolExecutor(max_workers=productWorkers) if concurrent else None
+            results = pool.map(runProduct, Fproducts) if concurrent else map(runProduct, Fproducts)
+        for fprod, sums, sections in results:
+            if sections:
+                merge(sections)
+            if sums is not None:
+                productSums[fprod] = sums
+    finally:
+        #-also when a product fails: stop the workers and remove the shared memory segment
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        if shm is not None:
+            shm.close(); shm.unlink()
+    #-statistics of all products in one product-dimensioned table
+    writeProductStats(productSums, resultDir, tableFormat)
+    if concurrent:
+        report('pipeline all products')
+
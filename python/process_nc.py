@@ -12,44 +12,21 @@ __date__ = 'October 2019'
 import xarray as xr
 import numpy as np
 import pandas as pd
-import os, pytz, glob
+import os, pytz, glob, traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from osgeo import gdal
-from osgeo import osr
-from osgeo import ogr
+from gridtools import gridNZTM, targetGrid, gridWeights, interpolate, writeGTiff
+from nctools import readPrecipCube, deaccumulate
+from timeutils import utcToLocal, ncRunTime, tifName
+from manifest import loadManifest, saveManifest, changedFiles, recordFile
+from cubestore import appendRuns
+from instrument import configure, timer, progress, collect, merge, report, startProfile, stopProfile
 
 '''
 Reads MetService netCDF files and converts them into GTiff files 
 '''
 
 
-def reproject(src_epsg, dst_epsg, x, y):
-    '''
-    Reproject coordinates x and y from EPSG defined by src_epsg to EPSG defined by dst_epsg
-    Returns the coordinates x and y in the dst_epsg projection
-    
-    Input:
-    ------
-        src_epsg: EPSG number of source coordinates
-        dst_epsg: EPSG number of target coordinates
-        x:        x-coordinate of source coordinates
-        y:        y-coordinate of source coordinates
-        
-    Returns:
-    --------
-        [x,y]:    x and y coordinate in target coordinate system
-    '''
-    source = osr.SpatialReference()
-    source.ImportFromEPSG(src_epsg)
-     
-    target = osr.SpatialReference()
-    target.ImportFromEPSG(dst_epsg)
-     
-    transform = osr.CoordinateTransformation(source, target)
-    point = ogr.Geometry(ogr.wkbPoint)
-    point.AddPoint(x,y)
-    point.Transform(transform)
-    return point.GetX(), point.GetY()
-    
 def ncToDataFrame(ncF, subdataset=None, dropcols=None):
     '''
     Converts a NetCDF file to a pandas dataframe and returns that dataframe.
@@ -77,6 +54,162 @@ def ncToDataFrame(ncF, subdataset=None, dropcols=None):
         
     return dataset
 
+#-settings of the product that is converted by this (worker) process; set by initWorker
+_worker = {}
+
+def initWorker(settings):
+    '''
+    Initializes a worker process with the settings of the product to convert. If the csv + prec.vrt + gdal.Grid route is used, the worker
+    gets its own scratch directory with its own csv-file and vrt-file, so that workers do not overwrite each other's temporary files.
+    
+    Input:
+    ------
+        settings: Dictionary with the product settings (tif directory, NZTM coordinates, interpolation weights, target grid, etc.)
+    '''
+    _worker.clear()
+    _worker.update(settings)
+    if settings['chunks']:
+        #-the netCDF files are already converted in parallel by the worker processes, so the lazy cubes are computed in the worker itself
+        import dask
+        dask.config.set({'scheduler': 'synchronous'})
+    if not settings['arrayMode']:
+        scratchDir = os.path.join(settings['tempDir'], 'worker_%s' %os.getpid())
+        if not os.path.exists(scratchDir):
+            os.makedirs(scratchDir)
+        _worker['csvFile'] = os.path.join(scratchDir, 'prec.csv')
+        _worker['vrtFile'] = os.path.join(scratchDir, 'prec.vrt')
+        #-point the vrt template to the csv-file of this worker
+        with open(settings['vrtFile']) as f:
+            vrt = f.read()
+        start = vrt.index('<SrcDataSource>') + len('<SrcDataSource>')
+        end = vrt.index('</SrcDataSource>')
+        with open(_worker['vrtFile'], 'w') as f:
+            f.write(vrt[:start] + _worker['csvFile'] + vrt[end:])
+    
+def convertNcFile(ncF):
+    '''
+    Converts one MetService netCDF file into GTiff files, one for each forecast hour. Uses the settings set by initWorker.
+    
+    Input:
+    ------
+        ncF:    Full path to NetCDF file (*.nc).
+    
+    Returns:
+    --------
+        [ncF, outputs, error, run]: outputs is a list with the GTiff files that were written, error is None if the file was converted
+                                    successfully, otherwise a string with the error message. If the cube store is used as output then
+                                    run is a tuple with the run time, valid times and the regridded fields (lead, y, x) that still need
+                                    to be appended to the store, otherwise run is None.
+    '''
+    outputs = []
+    try:
+        w = _worker
+        #-Get the UTC of the nc filename and convert to a datestime of NZ time zone
+        fileTime = utcToLocal([ncRunTime(ncF)], w['timeZone'])[0]
+        if w['arrayMode']:
+            #-Read the accumulated precipitation cube and calculate precipitation per hour from the difference along the time axis
+            times, cube, lat, lon = readPrecipCube(ncF, subdataset='precipitation_amount', chunks=w['chunks'])
+            prec = deaccumulate(cube); cube = None; lat = None; lon = None
+            #-Convert UTC to NZ timezone once for all timestamps of the file
+            forecastTimes = utcToLocal(times, w['timeZone'])
+            #-Regrid all forecast hours and return them to be appended to the cube store
+            if w['outputFormat'] == 'zarr':
+                fields = np.stack([interpolate(w['W'], w['inside'], prec[i-1], w['shape']) for i in range(1, len(times))]).astype(np.float32)
+                prec = None
+                return ncF, [w['cubeFile']], None, (fileTime, forecastTimes[1:].values, fields)
+            #-Loop over the timestamps (forecasts) within the netcdf file; the GTiff names of all forecast hours are formatted at once
+            tifNames = tifName(range(1, len(times)), forecastTimes[1:], fileTime)
+            for i in range(1, len(times)):
+                #-Interpolate to the Canterbury grid and write to GTiff
+                tifOut = os.path.join(w['tifDir'], tifNames[i-1])
+                writeGTiff(tifOut, interpolate(w['W'], w['inside'], prec[i-1], w['shape']), w['geoTrans'])
+                outputs.append(tifOut)
+            prec = None
+            return ncF, outputs, None, None
+        #-Get dataframe from netcdf
+        df = ncToDataFrame(ncF, subdataset='precipitation_amount', dropcols=['south_north', 'west_east'])
+        #-Array of unique timestamps, and the NZ time of each of them (converted once for the whole file)
+        Tunique = pd.unique(df['time'])
+        Tlocal = utcToLocal(Tunique, w['timeZone'])
+        #-Loop over the timestamps (forecasts) within the netcdf file.
+        i = 0
+        for t in Tunique:
+            if i>0:
+                df_short = df.copy()
+                df2 = df_short.loc[df_short['time'] == Tunique[i]]
+                df1 = df_short.loc[df_short['time'] == Tunique[i-1]]
+                df_short = None
+                prec = df2['precipitation_amount'].values - df1['precipitation_amount'].values  #-calculate precipitation from difference
+                df_final = df2.copy(); df1 = None; df2 = None
+                df_final['precipitation_amount'] = prec; prec = None
+                #-Replace lat lon fields with NZTMX and NZTMY as calculated before
+                df_final.rename(columns={'latitude': 'NZTMY', 'longitude': 'NZTMX', 'precipitation_amount':'prec'}, inplace=True)
+                df_final['NZTMX'] = w['X']
+                df_final['NZTMY'] = w['Y']
+                #-Get NZ time of the forecast
+                forecastTime = Tlocal[i]
+                df_final.drop('time', axis=1, inplace=True)
+                #-Write to csv before converting to GTiff
+                df_final.to_csv(w['csvFile'], index=False)
+                df_final = None
+                #-Convert csv to GTiff
+                tifOut = os.path.join(w['tifDir'], tifName([i], [forecastTime], fileTime)[0])
+                with timer('regrid', 1, 'fields'):
+                    z = gdal.Grid(tifOut, w['vrtFile'], width = w['shape'][1], height=w['shape'][0], algorithm='linear',format='GTiff', outputSRS='EPSG:2193', 
+                               spatFilter=w['bounds'], zfield='prec')
+                    z=None
+                outputs.append(tifOut)
+            i+=1
+        return ncF, outputs, None, None
+    except Exception as e:
+        return ncF, outputs, ''.join(traceback.format_exception_only(type(e), e)).strip(), None
+
+def convertAndCollect(ncF):
+    '''
+    Converts one MetService netCDF file (see convertNcFile) and collects the timers and counters of the worker, so that they can be merged
+    into those of the main process.
+    
+    Input:
+    ------
+        ncF:    Full path to NetCDF file (*.nc).
+    
+    Returns:
+    --------
+        [ncF, outputs, error, run, sections]: as convertNcFile, plus the timers and counters of the conversion (see instrument.collect)
+    '''
+    return convertNcFile(ncF) + (collect(),)
+
+
+def flushRuns(cubeFile, runBuffer, runFiles, manifest, geotransform, runChunk, settings=None):
+    '''
+    Appends buffered forecast runs to the cube store of a product, records the netCDF files in the manifest and empties the buffers.
+    
+    Input:
+    ------
+        cubeFile:     Full path to the cube store (*.zarr)
+        runBuffer:    List with (run time, valid times, fields) tuples as returned by convertNcFile
+        runFiles:     List with the netCDF files of the runs in runBuffer
+        manifest:     Manifest of the converted netCDF files
+        geotransform: GDAL geotransform of the target grid
+        runChunk:     Number of runs per chunk of the cube store
+
+    Optional Input:
+    ---------------
+        settings:     Dictionary with the settings of the stage that are recorded in the manifest
+    '''
+    if not os.path.exists(os.path.dirname(cubeFile)):
+        os.makedirs(os.path.dirname(cubeFile))
+    nleads = max(run[2].shape[0] for run in runBuffer)
+    validTimes = np.full((len(runBuffer), nleads), np.datetime64('NaT'), dtype='datetime64[ns]')
+    fields = np.full((len(runBuffer), nleads) + runBuffer[0][2].shape[1:], np.nan, dtype=np.float32)
+    for k, run in enumerate(runBuffer):
+        validTimes[k, :len(run[1])] = run[1]
+        fields[k, :run[2].shape[0]] = run[2]
+    with timer('cube_write', len(runBuffer), 'runs'):
+        appendRuns(cubeFile, [run[0] for run in runBuffer], validTimes, fields, geotransform, runChunk=runChunk)
+    for ncF in runFiles:
+        recordFile(manifest, ncF, [cubeFile], settings=settings)
+    del runBuffer[:]; del runFiles[:]
 
 
 ###-working directory
@@ -87,8 +220,25 @@ ncRootDir = r'C:\Active\Projects\MetService_precip_analysis\Data\nc_forecasts'
 tempDir = r'C:\Active\Projects\MetService_precip_analysis\Data\temp_files'
 #-directory where the netCDF to converted GTiff files of the different products will be saved
 tifDir = r'C:\Active\Projects\MetService_precip_analysis\Data\tif_forecasts'
+#-output format: 'gtiff' writes one GTiff per run and forecast hour, 'zarr' appends the runs to a single chunked cube store per product (requires arrayMode)
+outputFormat = 'gtiff'
+#-directory where the cube stores ({product}.zarr) are saved, and the number of runs that are written to the store at once (one chunk along the run dimension)
+cubeDir = r'C:\Active\Projects\MetService_precip_analysis\Data\cube_forecasts'
+runChunk = 8
 #-file to log errors
 logFile = 'errors.log' 
+#-JSON log file with the progress and the timers of the hot sections, and the directory for cProfile dumps per product (None disables profiling;
+#-only the main process is profiled)
+instrumentLog = os.path.join(workDir, 'process_nc_log.jsonl')
+profileDir = None
+#-only convert netCDF files that are new or changed since the previous run (True), or convert all files (False)
+incremental = True
+#-name of the manifest file (saved in the GTiff folder of each product) that keeps track of the converted netCDF files
+manifestFile = 'manifest.json'
+#-number of worker processes used to convert the netCDF files (1 converts the files serially in this process)
+nrWorkers = 4
+#-directory where the NZTM coordinates and interpolation weights of the product grids are cached
+gridCacheDir = os.path.join(tempDir, 'grid_cache')
 
 #-List with directories that contain
 #Fproducts = ['ECMWF_8km', 'NCEP_4km', 'NCEP_8km', 'UKMO_8km']
@@ -98,6 +248,14 @@ Fproducts = ['UKMO_8km']
 vrtFile = r'C:\Active\Eclipse_workspace\MetService_precip_forecasts\python\prec.vrt'
 csvFile = r'C:\Active\Projects\MetService_precip_analysis\Data\temp_files\prec.csv'
 
+#-Keep the precipitation cube as an array, de-accumulate with one difference along the time axis, and regrid with cached interpolation weights (True),
+#-or use the dataframe per timestep and the csv + prec.vrt + gdal.Grid round trip (False)
+arrayMode = True
+#-Out-of-core mode for long archives (requires arrayMode): the netCDF cubes are opened as lazy dask arrays with the chunks below, so only the
+#-fields of the forecast hour that is regridded are in memory instead of the whole cube of a run
+outOfCore = False
+ncChunks = {'time': 1}
+
 
 ##-Output extent settings for the Canterbury region
 xmin = 1323766.5234000002965331; xmin = xmin - 5000
@@ -108,86 +266,99 @@ ymax = 5361879.5686999997124076; ymax = ymax + 5000
 res = 1000
 rows = np.ceil((ymax-ymin)/res)
 cols = np.ceil((xmax-xmin)/res)
+#-Geotransform and cell centres of the Canterbury target grid
+geoTrans, xc, yc = targetGrid(xmin, ymin, xmax, ymax, cols, rows)
 
 ##-Time zone settings
 nzTimeZones = pytz.country_timezones['nz']
 nzTimeZones = nzTimeZones[0]
 
-for fProduct in Fproducts:
-    ncDir = os.path.join(ncRootDir, fProduct)
-    #-get list of *.nc files in the directory of the forecast product
-    ncFiles = glob.glob(ncDir + '\*.nc')
-    fProdTifDir = os.path.join(tifDir, fProduct)
-    
-    #-create GTiff folder of that forecast product if it does not exist yet
-    if not os.path.exists(fProdTifDir):
-        os.mkdir(fProdTifDir)
+#-settings that determine the outputs; files that were converted with other settings are converted again in the incremental mode
+stageSettings = {'arrayMode': arrayMode, 'outputFormat': outputFormat, 'extent': [xmin, ymin, xmax, ymax, res], 'timeZone': nzTimeZones,
+                 'ncChunks': ncChunks if outOfCore else None, 'cubeDir': cubeDir if outputFormat == 'zarr' else None}
+
+if __name__ == '__main__':
+    if outputFormat == 'zarr' and not arrayMode:
+        raise ValueError('The zarr output format requires arrayMode = True')
+    if outOfCore and not arrayMode:
+        raise ValueError('The out-of-core mode requires arrayMode = True')
+    configure(logFile=instrumentLog, profileDir=profileDir)
+    for fProduct in Fproducts:
+        ncDir = os.path.join(ncRootDir, fProduct)
+        #-get list of *.nc files in the directory of the forecast product
+        ncFiles = glob.glob(ncDir + '\*.nc')
+        fProdTifDir = os.path.join(tifDir, fProduct)
         
-    #-open logfile for writing errors during processing
-    errorLog = open(os.path.join(fProdTifDir, logFile), 'w')        
-    
-    #-Get the dataframe of one nc file to extract lat lon and convert to NZTMX and NZTMY
-    ncF = ncFiles[0]
-    df = ncToDataFrame(ncF, subdataset='precipitation_amount', dropcols=['south_north', 'west_east'])
-    df_short = df.copy(); df=None;
-    t = pd.unique(df_short['time'])
-    df_short = df_short.loc[df_short['time']==t[0]]
-    #-Convert lat lon to NZTMY and NZTMX
-    X = []
-    Y = []
-    for i in df_short.iterrows():
-        [x,y] = reproject(4326, 2193, float(i[1]['longitude']), float(i[1]['latitude']))
-        X.append(x)
-        Y.append(y)
-    df_short = None
-    
-    #-Loop over all the netCDF files in the folder and create GTiffs for each forecast time in that product
-    for ncF in ncFiles:
-        try:
-            #-Get dataframe from netcdf
+        #-create GTiff folder of that forecast product if it does not exist yet
+        if not os.path.exists(fProdTifDir):
+            os.mkdir(fProdTifDir)
+            
+        #-only keep the files that are new or changed since the previous run
+        manifest = loadManifest(os.path.join(fProdTifDir, manifestFile)) if incremental else {}
+        todoFiles = changedFiles(manifest, ncFiles, stageSettings)
+        if not todoFiles:
+            continue
+            
+        #-open logfile for appending errors during processing (the files that failed in earlier runs are kept)
+        errorLog = open(os.path.join(fProdTifDir, logFile), 'a')        
+        stage = 'process_nc ' + fProduct
+        profile = startProfile(stage)
+        
+        #-Get the dataframe of one nc file to extract lat lon and convert to NZTMX and NZTMY
+        ncF = ncFiles[0]
+        if outOfCore:
+            #-only read the coordinates, not the cube
+            t, cube, lat, lon = readPrecipCube(ncF, subdataset='precipitation_amount', chunks=ncChunks)
+            X, Y = gridNZTM(lat.ravel(), lon.ravel(), gridCacheDir)
+            cube = None; lat = None; lon = None
+        else:
             df = ncToDataFrame(ncF, subdataset='precipitation_amount', dropcols=['south_north', 'west_east'])
-            #-Array of unique timestamps
-            Tunique = pd.unique(df['time'])
-            #-Loop over the timestamps (forecasts) within the netcdf file.
-            i = 0
-            for t in Tunique:
-                if i>0:
-                    df_short = df.copy()
-                    df2 = df_short.loc[df_short['time'] == Tunique[i]]
-                    df1 = df_short.loc[df_short['time'] == Tunique[i-1]]
-                    df_short = None
-                    prec = df2['precipitation_amount'].values - df1['precipitation_amount'].values  #-calculate precipitation from difference
-                    df_final = df2.copy(); df1 = None; df2 = None
-                    df_final['precipitation_amount'] = prec; prec = None
-                    #-Replace lat lon fields with NZTMX and NZTMY as calculated before
-                    df_final.rename(columns={'latitude': 'NZTMY', 'longitude': 'NZTMX', 'precipitation_amount':'prec'}, inplace=True)
-                    df_final['NZTMX'] = X
-                    df_final['NZTMY'] = Y
-                    #-Convert UTC to NZ timezone
-                    df_final['time'] = df_final['time'].dt.tz_localize('utc')
-                    df_final['time'] = df_final['time'].dt.tz_convert(nzTimeZones)
-                    df_final['time'] = df_final['time'].dt.tz_localize(None)
-                    #-Get NZ time of the forecast
-                    forecastTime = df_final.iloc[0,0]
-                    df_final.drop('time', axis=1, inplace=True)
-                    #-Write to csv before converting to GTiff
-                    df_final.to_csv(csvFile, index=False)
-                    df_final = None
-                    #-Get the UTC of the nc filename and convert to a datestime of NZ time zone
-                    ncFileStr = ncF[-13:].split('.nc')[0]
-                    year = int(ncFileStr[:4])
-                    month = int(ncFileStr[4:6])
-                    day = int(ncFileStr[6:8])
-                    hour = int(ncFileStr[8:10])
-                    fileTime = pd.Timestamp(year=year, month=month, day=day, hour=hour, tz='utc').tz_convert(nzTimeZones)
-                    fileTime = fileTime.tz_localize(None)
-                    #-Convert csv to GTiff
-                    tifOut = os.path.join(fProdTifDir, str(i) + 'h_' + forecastTime.strftime('%Y%m%d_%H%M') + '_' + fileTime.strftime('%Y%m%d_%H%M')  + '.tif')
-                    z = gdal.Grid(tifOut, vrtFile, width = cols, height=rows, algorithm='linear',format='GTiff', outputSRS='EPSG:2193', 
-                               spatFilter=(xmin,ymin,xmax,ymax), zfield='prec')
-                    z=None
-                i+=1
-                
-        except:
-            errorLog.write('%s could not be processed because of unknown file format\n' %ncF)
-    errorLog.close()
+            df_short = df.copy(); df=None;
+            t = pd.unique(df_short['time'])
+            df_short = df_short.loc[df_short['time']==t[0]]
+            #-Convert lat lon to NZTMY and NZTMX (cached per product grid)
+            X, Y = gridNZTM(df_short['latitude'].to_numpy(), df_short['longitude'].to_numpy(), gridCacheDir)
+            df_short = None
+        #-Triangulate once per product and get the linear interpolation weights to the Canterbury grid
+        W = None; inside = None
+        if arrayMode:
+            W, inside = gridWeights(X, Y, xc, yc, gridCacheDir, bounds=(xmin,ymin,xmax,ymax))
+        
+        #-Settings that are shared with the worker processes
+        settings = {'tifDir': fProdTifDir, 'tempDir': tempDir, 'vrtFile': vrtFile, 'arrayMode': arrayMode, 'timeZone': nzTimeZones, 'X': X, 'Y': Y, 'W': W,
+                    'inside': inside, 'geoTrans': geoTrans, 'shape': xc.shape, 'bounds': (xmin,ymin,xmax,ymax),
+                    'outputFormat': outputFormat, 'cubeFile': os.path.join(cubeDir, fProduct + '.zarr'), 'chunks': ncChunks if outOfCore else None}
+        
+        #-Convert all the netCDF files in the folder and create GTiffs for each forecast time in that product
+        if nrWorkers > 1:
+            executor = ProcessPoolExecutor(max_workers=nrWorkers, initializer=initWorker, initargs=(settings,))
+            futures = [executor.submit(convertAndCollect, ncF) for ncF in todoFiles]
+            results = (future.result() for future in as_completed(futures))
+        else:
+            executor = None
+            initWorker(settings)
+            results = (convertAndCollect(ncF) for ncF in todoFiles)
+        #-runs that still need to be appended to the cube store
+        runBuffer = []; runFiles = []
+        for n, (ncF, outputs, error, run, sections) in enumerate(results):
+            merge(sections)
+            progress(stage, n+1, len(todoFiles))
+            if error:
+                errorLog.write('%s could not be processed: %s\n' %(ncF, error))
+                continue
+            if run is None:
+                recordFile(manifest, ncF, outputs, settings=stageSettings)
+                continue
+            runBuffer.append(run); runFiles.append(ncF)
+            #-append a full chunk of runs at once to avoid rewriting partially filled chunks
+            if len(runBuffer) == runChunk:
+                flushRuns(settings['cubeFile'], runBuffer, runFiles, manifest, geoTrans, runChunk, stageSettings)
+        #-append the remaining runs
+        if runBuffer:
+            flushRuns(settings['cubeFile'], runBuffer, runFiles, manifest, geoTrans, runChunk, stageSettings)
+        if executor:
+            executor.shutdown()
+        errorLog.close()
+        saveManifest(manifest, os.path.join(fProdTifDir, manifestFile))
+        stopProfile(profile, stage)
+        report(stage)
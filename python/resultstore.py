@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+
+import pandas as pd
+import numpy as np
+import os, json, threading, warnings
+from collections import OrderedDict
+from tableio import readTable, tableFile
+from verification import groupSums, statsFromSums
+
+'''
+Query API over the tables of organize_for_plots.py for the dashboards. A table (one per product) is read once, indexed on its catchment, station,
+month, forecast hour and accumulation window columns (sorted MultiIndex, so a selection is a binary search instead of a scan) and kept in
+an LRU cache. The results of the boxplot and statistics queries are kept in a second LRU cache. Each query checks the size and
+modification time of the tables it uses, so tables that are written again by organize_for_plots.py (or pipeline.py) are read again and
+the cached results of these tables are dropped. The queries can also be served as JSON over a local HTTP endpoint (see serve).
+'''
+
+#-maximum number of indexed tables and of query results that are kept in memory
+maxTables = 16
+maxResults = 512
+
+#-index columns of the tables per table name prefix
+tableKeys = {'all_stations_canterbury': ['ExtSiteID', 'Month'],
+             'all_stations_catchments': ['Catchment', 'ExtSiteID', 'Month'],
+             'catchments_avg': ['Catchment', 'Month'],
+             'catchments_grid_avg': ['Catchment', 'Month'],
+             'cumsum_all_stations_canterbury': ['ExtSiteID', 'Month', 'Forecasted hours', 'Accum. hours'],
+             'cumsum_catchments_avg': ['Catchment', 'Month', 'Forecasted hours', 'Accum. hours'],
+             'cumsum_statistics_all_stations_canterbury': ['Forecasted hours', 'Accum. hours'],
+             'cumsum_statistics_catchments_avg': ['Catchment', 'Forecasted hours', 'Accum. hours']}
+
+#-tables with the percentual errors per source of the boxplots
+errorTables = {'stations': 'all_stations_canterbury', 'catchments': 'catchments_avg', 'grid': 'catchments_grid_avg'}
+
+#-{path: (signature, indexed dataframe)} and {(path, query, arguments): (signature, result)}
+_tables = OrderedDict()
+_results = OrderedDict()
+_lock = threading.Lock()
+
+
+def tableSignature(path):
+    '''
+    Returns the size and modification time of a table, or None if the table does not exist.
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+def invalidate(path=None):
+    '''
+    Removes a table and its query results from the caches, or all tables and results if path is None.
+
+    Optional Input:
+    ---------------
+        path: Full path of the table (including the extension)
+    '''
+    with _lock:
+        if path is None:
+            _tables.clear(); _results.clear()
+            return
+        _tables.pop(path, None)
+        for key in [k for k in _results if k[0] == path]:
+            del _results[key]
+
+def loadTable(resultDir, name, product, fmt='csv'):
+    '''
+    Returns a table of organize_for_plots.py indexed on its key columns (see tableKeys). The indexed table is taken from the cache if the
+    table did not change since it was read.
+
+    Input:
+    ------
+        resultDir: Directory with the tables
+        name:      Name of the table without the product (e.g. 'cumsum_statistics_catchments_avg')
+        product:   Name of the MetService product
+
+    Optional Input:
+    ---------------
+        fmt:       Table format ('csv', 'parquet' or 'arrow')
+
+    Returns:
+    --------
+        [path, signature, df]: Full path and signature of the table, and the indexed dataframe (sorted MultiIndex, float32 forecast hour
+                               columns; the station IDs are strings)
+    '''
+    path = tableFile(os.path.join(resultDir, name + '_' + product), fmt)
+    signature = tableSignature(path)
+    if signature is None:
+        raise FileNotFoundError('Table does not exist: %s' %path)
+    with _lock:
+        cached = _tables.get(path)
+        if cached is not None and cached[0] == signature:
+            _tables.move_to_end(path)
+            return path, signature, cached[1]
+    #-new or changed table: drop the results of the old table and read it again
+    invalidate(path)
+    df = readTable(os.path.splitext(path)[0], fmt)
+    keys = [k for k in tableKeys[name] if k in df.columns]
+    if 'ExtSiteID' in keys:
+        df['ExtSiteID'] = df['ExtSiteID'].astype(str)
+    leads = [c for c in df.columns if c.isdigit()]
+    if leads:
+        df[leads] = df[leads].astype(np.float32)
+    df = df.set_index(keys).sort_index()
+    with _lock:
+        _tables[path] = (signature, df)
+        while len(_tables) > maxTables:
+            _tables.popitem(last=False)
+    return path, signature, df
+
+def _cached(path, signature, query, args, func):
+    '''
+    Returns the result of a query from the result cache, or calculates it with func and adds it to the cache.
+    '''
+    key = (path, query, args)
+    with _lock:
+        cached = _results.get(key)
+        if cached is not None and cached[0] == signature:
+            _results.move_to_end(key)
+            return cached[1]
+    result = func()
+    with _lock:
+        _results[key] = (signature, result)
+        while len(_results) > maxResults:
+            _results.popitem(last=False)
+    return result
+
+def _isList(value):
+    '''
+    Returns True if a query argument is a list (or other sequence) of values instead of a single value.
+    '''
+    return not isinstance(value, str) and np.ndim(value) > 0
+
+def _selector(value, cast):
+    '''
+    Returns the index selector of a query argument: all values for None, otherwise a list with the value(s).
+    '''
+    if value is None:
+        return slice(None)
+    if _isList(value):
+        return [cast(v) for v in value]
+    return [cast(value)]
+
+def selectRows(df, **values):
+    '''
+    Selects the rows of an indexed table (see loadTable) on its index levels.
+
+    Input:
+    ------
+        df:     Indexed dataframe
+        values: Value or list with values per index level name (e.g. Catchment='Waimakariri', Month=[6, 7, 8]); levels that are not given
+                (or None) are not filtered
+
+    Returns:
+    --------
+        df:     Dataframe with the selected rows
+    '''
+    casts = {'ExtSiteID': str, 'Catchment': str, 'Month': int, 'Forecasted hours': int, 'Accum. hours': int}
+    names = list(df.index.names)
+    sel = []
+    for i, n in enumerate(names):
+        s = _selector(values.get(n), casts.get(n, lambda v: v))
+        if not isinstance(s, slice):
+            #-values that are not in the table are left out (the levels of the cached table are the values that occur)
+            level = df.index.levels[i] if len(names) > 1 else df.index
+            s = [v for v in s if v in level]
+            if not s:
+                return df.iloc[:0]
+        sel.append(s)
+    if all(isinstance(s, slice) for s in sel):
+        return df
+    try:
+        return df.loc[tuple(sel) if len(names) > 1 else sel[0], :]
+    except KeyError:
+        #-each value occurs in its level, but none of their combinations occurs in the table
+        return df.iloc[:0]
+
+def _key(value):
+    '''
+    Returns a hashable cache key of a query argument.
+    '''
+    if _isList(value):
+        return tuple(str(v) for v in value)
+    return None if value is None else str(value)
+
+def boxplotStats(values):
+    '''
+    Calculates the boxplot statistics of each column of an array at once, in the layout of matplotlib's Axes.bxp.
+
+    Input:
+    ------
+        values: Array with shape (samples, boxes); NaN values are ignored
+
+    Returns:
+    --------
+        stats:  Dataframe with a row per box and the columns 'n', 'mean', 'whislo', 'q1', 'med', 'q3' and 'whishi'. The whiskers are the
+                most extreme values within 1.5 times the interquartile range from the box.
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        q1, med, q3 = np.nanpercentile(values, [25, 50, 75], axis=0) if len(values) else np.full((3, values.shape[1]), np.nan)
+        iqr = q3 - q1
+        whislo = np.nanmin(np.where(values >= q1 - 1.5 * iqr, values, np.nan), axis=0) if len(values) else q1
+        whishi = np.nanmax(np.where(values <= q3 + 1.5 * iqr, values, np.nan), axis=0) if len(values) else q3
+        mean = np.nanmean(values, axis=0) if len(values) else q1
+    return pd.DataFrame({'n': np.sum(~np.isnan(values), axis=0), 'mean': mean, 'whislo': whislo, 'q1': q1, 'med': med, 'q3': q3, 'whishi': whishi})
+
+def queryBoxplot(resultDir, product, source='stations', catchment=None, station=None, month=None, leads=None, fmt='csv'):
+    '''
+    Returns the boxplot statistics of the percentual errors per forecast hour (plots 1) to 3) of organize_for_plots.py).
+
+    Input:
+    ------
+        resultDir: Directory with the tables of organize_for_plots.py
+        product:   Name of the MetService product
+
+    Optional Input:
+    ---------------
+        source:    'stations' for the errors of the stations (of a catchment if catchment is given), 'catchments' for the errors of the
+                   catchment averages of the stations, or 'grid' for the errors of the catchment-mean forecasts of the grid
+        catchment: Catchment name or list with catchment names
+        station:   Station ID or list with station IDs (only for source 'stations')
+        month:     Month (1-12) or list with months
+        leads:     List with forecast hours (default is all forecast hours of the table)
+        fmt:       Table format ('csv', 'parquet' or 'arrow')
+
+    Returns:
+    --------
+        stats:     Dataframe indexed by 'Forecasted hours' with the boxplot statistics (see boxplotStats)
+    '''
+    if source not in errorTables:
+        raise ValueError('Unknown source: %s' %source)
+    name = errorTables[source]
+    if source == 'stations' and catchment is not None:
+        name = 'all_stations_catchments'
+    path, signature, df = loadTable(resultDir, name, product, fmt)
+    args = (_key(catchment), _key(station), _key(month), _key(leads))
+
+    def calculate():
+        sel = selectRows(df, Catchment=catchment, ExtSiteID=station, Month=month)
+        leadCols = [c for c in df.columns if c.isdigit()] if leads is None else [str(int(l)) for l in leads if str(int(l)) in df.columns]
+        stats = boxplotStats(sel[leadCols].to_numpy())
+        stats.index = pd.Index([int(c) for c in leadCols], name='Forecasted hours')
+        return stats
+    return _cached(path, signature, 'boxplot', args, calculate)
+
+def queryStatistics(resultDir, product, catchment=None, station=None, month=None, leads=None, windows=None, fmt='csv'):
+    '''
+    Returns the R-squared, RMSE, bias and number of observations per forecast hour and accumulation window (plots 4) and 5) of
+    organize_for_plots.py). Without a station or month the statistics are taken from the statistics tables; otherwise they are calculated
+    from the accumulated precipitation of the selected rows (see verification.groupSums).
+
+    Input:
+    ------
+        resultDir: Directory with the tables of organize_for_plots.py
+        product:   Name of the MetService product
+
+    Optional Input:
+    ---------------
+        catchment: Catchment name or list with catchment names (statistics of the catchment averages)
+        station:   Station ID or list with station IDs (statistics of these stations together; ignored if a catchment is given)
+        month:     Month (1-12) or list with months
+        leads:     List with forecast hours (default is all forecast hours)
+        windows:   Accumulation window in hours or list with windows (default is all windows)
+        fmt:       Table format ('csv', 'parquet' or 'arrow')
+
+    Returns:
+    --------
+        stats:     Dataframe with the index columns ('Catchment' if a catchment is given, 'Forecasted hours' and 'Accum. hours') and the columns
+                   'R-squared [-]', 'RMSE [mm]', 'Bias [%]' and 'Nr. of observations' (and the lower and upper bootstrap confidence bounds
+                   of the first three if the statistics tables have them)
+    '''
+    statCols = ['R-squared [-]', 'RMSE [mm]', 'Bias [%]', 'Nr. of observations']
+    level = 'catchments_avg' if catchment is not None else 'all_stations_canterbury'
+    if month is None and (station is None or catchment is not None):
+        name = 'cumsum_statistics_' + level
+    else:
+        name = 'cumsum_' + level
+    path, signature, df = loadTable(resultDir, name, product, fmt)
+    args = (_key(catchment), _key(station), _key(month), _key(leads), _key(windows))
+
+    def calculate():
+        sel = selectRows(df, Catchment=catchment, ExtSiteID=station, Month=month, **{'Forecasted hours': leads, 'Accum. hours': windows})
+        if name.startswith('cumsum_statistics_'):
+            #-including the bootstrap confidence bounds if organize_for_plots.py calculated them
+            return sel.reset_index()
+        keys = (['Catchment'] if catchment is not None else []) + ['Forecasted hours', 'Accum. hours']
+        xCol = 'Accum. catchment precipitation [mm]' if catchment is not None else 'Accum. station precipitation [mm]'
+        sel = sel.reset_index()
+        if len(sel) == 0:
+            return pd.DataFrame(columns=keys + statCols)
+        return statsFromSums(groupSums(sel, keys, xCol, 'Accum. forecasted precipitation [mm]')).reset_index()[keys + statCols]
+    return _cached(path, signature, 'statistics', args, calculate)
+
+def _parseList(value, cast=str):
+    '''
+    Parses a query string argument with a list of values ('a,b') or a range of integers ('1-24'). Returns None if the argument is not given.
+    '''
+    if value is None or value == '':
+        return None
+    items = []
+    for part in value.split(','):
+        if cast is int and '-' in part.strip('-'):
+            first, last = part.split('-', 1)
+            items.extend(range(int(first), int(last) + 1))
+        else:
+            items.append(cast(part))
+    return items
+
+def serve(resultDir, fmt='csv', host='127.0.0.1', port=8050):
+    '''
+    Serves the queries as JSON over a local HTTP endpoint until interrupted. The endpoints are
+
+        /boxplot?product=NCEP_8km&source=catchments&catchment=Waimakariri&month=6,7,8&leads=1-24
+        /statistics?product=NCEP_8km&catchment=Waimakariri&leads=1-24&windows=6
+
+    and return a list with a record per row. Lists are comma separated; integer ranges are given as first-last.
+
+    Input:
+    ------
+        resultDir: Directory with the tables of organize_for_plots.py
+
+    Optional Input:
+    ---------------
+        fmt:       Table format ('csv', 'parquet' or 'arrow')
+        host:      Host name or address to listen on (only local by default)
+        port:      Port to listen on
+    '''
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlparse, parse_qs
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            q = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            try:
+                if 'product' not in q:
+                    raise ValueError('The product argument is required')
+                common = {'catchment': _parseList(q.get('catchment')), 'month': _parseList(q.get('month'), int),
+                          'leads': _parseList(q.get('leads'), int), 'fmt': fmt}
+                if url.path == '/boxplot':
+                    df = queryBoxplot(resultDir, q['product'], q.get('source', 'stations'), station=_parseList(q.get('station')), **common).reset_index()
+                elif url.path == '/statistics':
+                    df = queryStatistics(resultDir, q['product'], station=_parseList(q.get('station')), windows=_parseList(q.get('windows'), int), **common)
+                else:
+                    self.send_error(404, 'Unknown endpoint')
+                    return
+                status, body = 200, df.to_json(orient='records')
+            except FileNotFoundError as e:
+                status, body = 404, json.dumps({'error': str(e)})
+            except (ValueError, KeyError) as e:
+                status, body = 400, json.dumps({'error': str(e)})
+            body = body.encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    #-Directory with the tables of organize_for_plots.py
+    resultDir = r'C:\Active\Projects\MetService_precip_analysis\Data\station_metservice_comparison'
+    #-format of the tables: 'csv', 'parquet' or 'arrow'
+    tableFormat = 'csv'
+    #-address and port of the local HTTP endpoint
+    host = '127.0.0.1'
+    port = 8050
+
+    serve(resultDir, tableFormat, host, port)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+import numpy as np
+from osgeo import gdal
+from instrument import timer
+from timeutils import parseTifNames
+
+'''
+Samples GTiff rasters at station locations in-process. All stations are converted to pixel indices in one vectorized step, and the
+values of all stations are read with one array fancy-index. This replaces spawning one gdallocationinfo process per raster and station.
+'''
+
+#-cache with station pixel indices per product grid (geotransform, shape and station coordinates)
+_pixelIndexCache = {}
+
+
+def stationPixelIndex(geotransform, nrows, ncols, X, Y):
+    '''
+    Converts arrays of NZTMX and NZTMY station coordinates to row and column indices of a raster grid. The pixel that contains a
+    coordinate is selected in the same way as gdallocationinfo -geoloc does (floor of the inverse geotransform). Indices are cached
+    per product grid, so they are only calculated once for a set of stations.
+
+    Input:
+    ------
+        geotransform: GDAL geotransform of the raster (6 elements)
+        nrows:        Number of rows of the raster
+        ncols:        Number of columns of the raster
+        X:            Array with NZTMX coordinates of the stations
+        Y:            Array with NZTMY coordinates of the stations
+
+    Returns:
+    --------
+        [row, col, valid]: Arrays with row indices, column indices, and a boolean array that is False for stations outside the raster
+    '''
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    key = (tuple(geotransform), int(nrows), int(ncols), X.tobytes(), Y.tobytes())
+    try:
+        return _pixelIndexCache[key]
+    except KeyError:
+        pass
+
+    #-inverse of the affine geotransform
+    g0, g1, g2, g3, g4, g5 = geotransform
+    det = g1 * g5 - g2 * g4
+    dx = X - g0
+    dy = Y - g3
+    pixel = np.floor((g5 * dx - g2 * dy) / det).astype(np.int64)
+    line = np.floor((-g4 * dx + g1 * dy) / det).astype(np.int64)
+    valid = (pixel >= 0) & (pixel < ncols) & (line >= 0) & (line < nrows)
+    #-set indices of stations outside the grid to 0 so that they can still be used for indexing
+    row = np.where(valid, line, 0)
+    col = np.where(valid, pixel, 0)
+    _pixelIndexCache[key] = (row, col, valid)
+    return row, col, valid
+
+def sampleRaster(tifFile, X, Y, band=1):
+    '''
+    Opens a raster once and reads the values at all station locations.
+
+    Input:
+    ------
+        tifFile: Full path to the raster file (*.tif)
+        X:       Array with NZTMX coordinates of the stations
+        Y:       Array with NZTMY coordinates of the stations
+
+    Optional Input:
+    ---------------
+        band:    Band number to sample (default is 1)
+
+    Returns:
+    --------
+        values: Array with the raster values at the stations. Stations that are outside the raster get NaN.
+    '''
+    with timer('sampling', len(X), 'station-samples'):
+        ds = gdal.Open(tifFile)
+        if ds is None:
+            raise IOError('%s could not be opened' %tifFile)
+        arr = ds.GetRasterBand(band).ReadAsArray()
+        row, col, valid = stationPixelIndex(ds.GetGeoTransform(), ds.RasterYSize, ds.RasterXSize, X, Y)
+        ds = None
+        values = arr[row, col].astype(np.float64)
+        values[~valid] = np.nan
+        return values
+
+def iterTifSamples(tifFiles, X, Y):
+    '''
+    Iterates over GTiff files and samples each file at the station locations.
+
+    Input:
+    ------
+        tifFiles: List with full paths to the GTiff files
+        X:        Array with NZTMX coordinates of the stations
+        Y:        Array with NZTMY coordinates of the stations
+
+    Returns:
+    --------
+        Generator that yields [hours, tstamp, values]: the forecast hours, the (NZ) timestamp for which the forecast is valid, and an array
+                                                       with the forecasted values at the stations (NaN if the file could not be read).
+    '''
+    #-forecast hours and timestamps of all files, parsed at once from the file names
+    allHours, tstamps = parseTifNames(tifFiles)
+    for tifFile, hours, tstamp in zip(tifFiles, allHours.tolist(), tstamps):
+        try:
+            values = sampleRaster(tifFile, X, Y)
+        except Exception:
+            values = np.full(len(X), np.nan)
+        yield hours, tstamp, values
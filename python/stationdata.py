@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+import pandas as pd
+import numpy as np
+import os, json, hashlib
+from instrument import log
+
+'''
+Data-access layer for the hourly precipitation station data. The date range, dataset types and quality codes are pushed into the query,
+the result is read in fixed-size chunks, and the chunks are streamed into a local columnar (Parquet) station store. The store keeps
+track of the periods that have been fetched, so only periods that are not in the store yet are requested from the database. A period is
+only recorded as fetched up to the last hour that the database returned, so hours that were not in the database yet are fetched again
+by the next sync.
+
+Besides the production SQL Server database ('mssql'), an SQLite ('sqlite') or DuckDB ('duckdb') database with the same tables and columns
+can be used, so that the pipeline can be tested and benchmarked offline (see createSchema).
+'''
+
+#-tables and columns of the hydro database that are used
+schema = {'TSDataNumericHourlySumm': [('ExtSiteID', 'VARCHAR(50)'), ('DatasetTypeID', 'INTEGER')],
+          'TSDataNumericHourly': [('ExtSiteID', 'VARCHAR(50)'), ('DatasetTypeID', 'INTEGER'), ('DateTime', 'TIMESTAMP'), ('Value', 'DOUBLE PRECISION'),
+                                  ('QualityCode', 'INTEGER')],
+          'ExternalSite': [('ExtSiteID', 'VARCHAR(50)'), ('NZTMX', 'DOUBLE PRECISION'), ('NZTMY', 'DOUBLE PRECISION')]}
+
+#-name of the file in the station store that keeps track of the fetched periods
+coverageFile = 'coverage.json'
+
+
+def connect(backend='mssql', server=None, database=None, path=None):
+    '''
+    Opens a DB-API connection to the station database.
+
+    Optional Input:
+    ---------------
+        backend:  'mssql' for SQL Server (via pyodbc), 'sqlite' or 'duckdb' for a local database file
+        server:   Name of the SQL Server (mssql only)
+        database: Name of the database (mssql only)
+        path:     Full path to the database file (sqlite and duckdb only)
+
+    Returns:
+    --------
+        con: DB-API connection
+    '''
+    if backend == 'mssql':
+        import pyodbc
+        return pyodbc.connect('DRIVER={ODBC Driver 17 for SQL Server};SERVER=%s;DATABASE=%s;Trusted_Connection=yes' %(server, database))
+    elif backend == 'sqlite':
+        import sqlite3
+        return sqlite3.connect(path)
+    elif backend == 'duckdb':
+        import duckdb
+        return duckdb.connect(path)
+    raise ValueError('Unknown database backend: %s' %backend)
+
+def createSchema(con):
+    '''
+    Creates the tables of the hydro database that are used by this module, with an index on station and time for the hourly data. Used to
+    set up an SQLite or DuckDB database for offline testing.
+
+    Input:
+    ------
+        con: DB-API connection
+    '''
+    cur = con.cursor()
+    for table, columns in schema.items():
+        cur.execute('CREATE TABLE IF NOT EXISTS %s (%s)' %(table, ', '.join('%s %s' %(c, t) for c, t in columns)))
+    cur.execute('CREATE INDEX IF NOT EXISTS ix_hourly_site_time ON TSDataNumericHourly (ExtSiteID, DateTime)')
+    con.commit()
+
+def _placeholders(values):
+    return ', '.join(['?'] * len(values))
+
+def _timeParam(t):
+    #-ISO format without 'T' is understood by SQL Server, SQLite (text comparison) and DuckDB
+    return pd.Timestamp(t).strftime('%Y-%m-%d %H:%M:%S')
+
+def iterHourly(con, datasetTypes, qualityCodes, from_date, to_date, chunksize=500000):
+    '''
+    Reads the hourly station data for a period in fixed-size chunks. The filters on period, dataset types and quality codes are done by
+    the database. Only the stations that have a summary for the dataset types are selected (as in TSDataNumericHourlySumm).
+
+    Input:
+    ------
+        con:          DB-API connection
+        datasetTypes: List with dataset type IDs (e.g. [38, 15])
+        qualityCodes: List with quality codes to include (e.g. [600])
+        from_date:    Start of the period (inclusive)
+        to_date:      End of the period (inclusive)
+
+    Optional Input:
+    ---------------
+        chunksize:    Number of records per chunk
+
+    Returns:
+    --------
+        Generator that yields dataframes with the columns 'ExtSiteID', 'DateTime' and 'Value'
+    '''
+    query = ('SELECT ExtSiteID, DateTime, Value FROM TSDataNumericHourly WHERE DatasetTypeID IN (%s) AND QualityCode IN (%s) '
+             'AND DateTime >= ? AND DateTime <= ? AND ExtSiteID IN (SELECT ExtSiteID FROM TSDataNumericHourlySumm WHERE DatasetTypeID IN (%s))'
+             %(_placeholders(datasetTypes), _placeholders(qualityCodes), _placeholders(datasetTypes)))
+    params = list(datasetTypes) + list(qualityCodes) + [_timeParam(from_date), _timeParam(to_date)] + list(datasetTypes)
+    cur = con.cursor()
+    cur.execute(query, params)
+    while True:
+        records = cur.fetchmany(chunksize)
+        if not records:
+            break
+        df = pd.DataFrame.from_records([tuple(r) for r in records], columns=['ExtSiteID', 'DateTime', 'Value'])
+        df['ExtSiteID'] = df['ExtSiteID'].astype(str)
+        df['DateTime'] = pd.to_datetime(df['DateTime']).astype('datetime64[ns]')
+        df['Value'] = df['Value'].astype(np.float64)
+        yield df
+    cur.close()
+
+def readSitesXY(con, sites):
+    '''
+    Reads the NZTM coordinates of stations.
+
+    Input:
+    ------
+        con:   DB-API connection
+        sites: List with station IDs
+
+    Returns:
+    --------
+        df:    Dataframe with the columns 'ExtSiteID', 'NZTMX' and 'NZTMY' without duplicate rows
+    '''
+    frames = []
+    cur = con.cursor()
+    #-SQL Server accepts at most 2100 parameters per query
+    for i in range(0, len(sites), 1000):
+        batch = [str(s) for s in sites[i:i+1000]]
+        cur.execute('SELECT ExtSiteID, NZTMX, NZTMY FROM ExternalSite WHERE ExtSiteID IN (%s)' %_placeholders(batch), batch)
+        frames.append(pd.DataFrame.from_records([tuple(r) for r in cur.fetchall()], columns=['ExtSiteID', 'NZTMX', 'NZTMY']))
+    cur.close()
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['ExtSiteID', 'NZTMX', 'NZTMY'])
+    return df.drop_duplicates().reset_index(drop=True)
+
+def querySignature(datasetTypes, qualityCodes):
+    '''
+    Returns a short hash that identifies the selection of station data, so that a store is not reused for another selection.
+
+    Input:
+    ------
+        datasetTypes: List with dataset type IDs
+        qualityCodes: List with quality codes
+
+    Returns:
+    --------
+        signature: Hex string
+    '''
+    return hashlib.sha1(json.dumps([sorted(datasetTypes), sorted(qualityCodes)]).encode()).hexdigest()[:12]
+
+def missingPeriods(covered, from_date, to_date, freq='h'):
+    '''
+    Returns the parts of a period that are not covered by the periods that have already been fetched.
+
+    Input:
+    ------
+        covered:   List with [start, end] pairs (inclusive) of the fetched periods
+        from_date: Start of the requested period (inclusive)
+        to_date:   End of the requested period (inclusive)
+
+    Optional Input:
+    ---------------
+        freq:      Time step of the data
+
+    Returns:
+    --------
+        periods:   List with (start, end) pairs (inclusive) of the periods that still need to be fetched
+    '''
+    step = pd.Timedelta(1, unit=freq)
+    start = pd.Timestamp(from_date); end = pd.Timestamp(to_date)
+    periods = []
+    for s, e in sorted((pd.Timestamp(s), pd.Timestamp(e)) for s, e in covered):
+        if e < start:
+            continue
+        if s > end:
+            break
+        if s > start:
+            periods.append((start, s - step))
+        start = max(start, e + step)
+        if start > end:
+            return periods
+    periods.append((start, end))
+    return periods
+
+def _loadCoverage(storeDir):
+    f = os.path.join(storeDir, coverageFile)
+    if not os.path.isfile(f):
+        return {}
+    with open(f) as fo:
+        return json.load(fo)
+
+def _saveCoverage(coverage, storeDir):
+    f = os.path.join(storeDir, coverageFile)
+    with open(f + '.tmp', 'w') as fo:
+        json.dump(coverage, fo, indent=1)
+    os.replace(f + '.tmp', f)
+
+def syncStore(con, storeDir, datasetTypes, qualityCodes, from_date, to_date, chunksize=500000, latency=None):
+    '''
+    Fetches the station data of the periods that are not in the station store yet. The chunks of each period are streamed into a Parquet
+    file (one row group per chunk); the period is only recorded as fetched once the file is complete, and only up to the last hour that was
+    returned (the database may not hold the latest hours yet). A period without any data is not recorded.
+
+    Input:
+    ------
+        con:          DB-API connection
+        storeDir:     Directory of the station store
+        datasetTypes: List with dataset type IDs (e.g. [38, 15])
+        qualityCodes: List with quality codes to include (e.g. [600])
+        from_date:    Start of the period (inclusive)
+        to_date:      End of the period (inclusive)
+
+    Optional Input:
+    ---------------
+        chunksize:    Number of records per chunk
+        latency:      Timedelta (or string, e.g. '6h'); hours later than the current time minus latency are not fetched, because not all
+                      stations may have delivered them yet (None fetches up to to_date)
+
+    Returns:
+    --------
+        periods:      List with (start, end) pairs of the periods that were fetched
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    arrowSchema = pa.schema([('ExtSiteID', pa.string()), ('DateTime', pa.timestamp('ns')), ('Value', pa.float64())])
+    signature = querySignature(datasetTypes, qualityCodes)
+    if not os.path.exists(storeDir):
+        os.makedirs(storeDir)
+    coverage = _loadCoverage(storeDir)
+    covered = coverage.setdefault(signature, [])
+    if latency is not None:
+        to_date = min(pd.Timestamp(to_date), pd.Timestamp.now().floor('h') - pd.Timedelta(latency))
+    periods = missingPeriods(covered, from_date, to_date) if pd.Timestamp(from_date) <= pd.Timestamp(to_date) else []
+    for start, end in periods:
+        log('fetch', signature=signature, start=start, end=end)
+        partFile = os.path.join(storeDir, '%s_%s_%s.parquet' %(signature, start.strftime('%Y%m%d%H'), end.strftime('%Y%m%d%H')))
+        writer = pq.ParquetWriter(partFile + '.tmp', arrowSchema)
+        last = None
+        try:
+            for chunk in iterHourly(con, datasetTypes, qualityCodes, start, end, chunksize=chunksize):
+                writer.write_table(pa.Table.from_pandas(chunk, schema=arrowSchema, preserve_index=False))
+                last = chunk['DateTime'].max() if last is None else max(last, chunk['DateTime'].max())
+        finally:
+            writer.close()
+        if last is None:
+            os.remove(partFile + '.tmp')
+            log('fetch_incomplete', signature=signature, start=start, end=end, covered_until=None)
+            continue
+        os.replace(partFile + '.tmp', partFile)
+        #-the hours after the last returned hour are fetched again by the next sync
+        covered.append([str(start), str(min(end, last))])
+        if last < end:
+            log('fetch_incomplete', signature=signature, start=start, end=end, covered_until=last)
+        _saveCoverage(coverage, storeDir)
+    return periods
+
+def iterStore(storeDir, datasetTypes, qualityCodes, from_date, to_date, columns=None):
+    '''
+    Reads the station data of a period from the station store in record batches. The period filter is pushed down into the Parquet reader.
+
+    Input:
+    ------
+        storeDir:     Directory of the station store
+        datasetTypes: List with dataset type IDs
+        qualityCodes: List with quality codes
+        from_date:    Start of the period (inclusive)
+        to_date:      End of the period (inclusive)
+
+    Optional Input:
+    ---------------
+        columns:      List with the names of the columns to read (default is all columns)
+
+    Returns:
+    --------
+        Generator that yields dataframes with the columns 'ExtSiteID', 'DateTime' and 'Value'
+    '''
+    import pyarrow.dataset as ds
+    signature = querySignature(datasetTypes, qualityCodes)
+    files = sorted(os.path.join(storeDir, f) for f in os.listdir(storeDir) if f.startswith(signature + '_') and f.endswith('.parquet'))
+    if not files:
+        return
+    dataset = ds.dataset(files, format='parquet')
+    expression = (ds.field('DateTime') >= pd.Timestamp(from_date)) & (ds.field('DateTime') <= pd.Timestamp(to_date))
+    for batch in dataset.to_batches(columns=columns, filter=expression):
+        if batch.num_rows:
+            yield batch.to_pandas()
+
+def readStore(storeDir, datasetTypes, qualityCodes, from_date, to_date, columns=None):
+    '''
+    Reads the station data of a period from the station store into one dataframe.
+
+    Input:
+    ------
+        storeDir:     Directory of the station store
+        datasetTypes: List with dataset type IDs
+        qualityCodes: List with quality codes
+        from_date:    Start of the period (inclusive)
+        to_date:      End of the period (inclusive)
+
+    Optional Input:
+    ---------------
+        columns:      List with the names of the columns to read (default is all columns)
+
+    Returns:
+    --------
+        df: Dataframe with the columns 'ExtSiteID', 'DateTime' and 'Value'
+    '''
+    frames = list(iterStore(storeDir, datasetTypes, qualityCodes, from_date, to_date, columns=columns))
+    if not frames:
+        return pd.DataFrame(columns=columns or ['ExtSiteID', 'DateTime', 'Value'])
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+import pandas as pd
+import operator
+
+'''
+Reading and writing of the tables that are handed over between the pipeline stages. Besides csv, the tables can be stored in a typed
+columnar format: Parquet ('parquet') or Arrow IPC ('arrow'). The columnar formats support column projection and predicate pushdown
+(e.g. on product, station and date range), and are memory-mapped when read, so a stage only reads the columns and rows it needs.
+'''
+
+#-file extension per table format
+extensions = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow'}
+
+#-comparison operators that can be used in filters
+_operators = {'==': operator.eq, '=': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+
+def tableFile(base, fmt='csv'):
+    '''
+    Returns the full path of a table for a table format.
+
+    Input:
+    ------
+        base: Full path of the table without extension
+        fmt:  Table format ('csv', 'parquet' or 'arrow')
+
+    Returns:
+    --------
+        path: Full path of the table including the extension
+    '''
+    return base + extensions[fmt]
+
+def writeTable(df, base, fmt='csv'):
+    '''
+    Writes a dataframe to a table. For the columnar formats the column names are converted to strings (as they are when the csv-file is read)
+    and object columns are converted to typed columns.
+
+    Input:
+    ------
+        df:   Pandas dataframe
+        base: Full path of the table without extension
+        fmt:  Table format ('csv', 'parquet' or 'arrow')
+
+    Returns:
+    --------
+        path: Full path of the table that was written
+    '''
+    path = tableFile(base, fmt)
+    if fmt == 'csv':
+        df.to_csv(path, index=False)
+        return path
+    df = df.infer_objects()
+    df.columns = [str(c) for c in df.columns]
+    df = df.reset_index(drop=True)
+    if fmt == 'parquet':
+        df.to_parquet(path, index=False)
+    else:
+        df.to_feather(path)
+    return path
+
+def filterDataFrame(df, filters):
+    '''
+    Applies filters to a dataframe.
+
+    Input:
+    ------
+        df:      Pandas dataframe
+        filters: List with (column, operator, value) tuples that are combined with AND. Operators are '==', '!=', '<', '<=', '>', '>=',
+                 'in' and 'not in'.
+
+    Returns:
+    --------
+        df:      Filtered pandas dataframe
+    '''
+    if not filters:
+        return df
+    mask = pd.Series(True, index=df.index)
+    for col, op, value in filters:
+        if op == 'in':
+            mask &= df[col].isin(value)
+        elif op == 'not in':
+            mask &= ~df[col].isin(value)
+        else:
+            mask &= _operators[op](df[col], value)
+    return df.loc[mask]
+
+def readTable(base, fmt='csv', columns=None, filters=None, parse_dates=None, dayfirst=True):
+    '''
+    Reads a table into a dataframe, with optional column projection and filters. For the columnar formats the filters are pushed down into
+    the reader (only the matching row groups and rows are read) and the file is memory-mapped.
+
+    Input:
+    ------
+        base:        Full path of the table without extension
+        fmt:         Table format ('csv', 'parquet' or 'arrow')
+
+    Optional Input:
+    ---------------
+        columns:     List with the names of the columns to read (default is all columns)
+        filters:     List with (column, operator, value) tuples that are combined with AND (see filterDataFrame)
+        parse_dates: List with names of columns that contain dates (only used for csv)
+        dayfirst:    Parse dates with the day first (only used for csv)
+
+    Returns:
+    --------
+        df: Pandas dataframe
+    '''
+    path = tableFile(base, fmt)
+    if fmt == 'csv':
+        df = pd.read_csv(path, usecols=columns, parse_dates=parse_dates, dayfirst=dayfirst)
+        return filterDataFrame(df, filters).reset_index(drop=True)
+    import pyarrow.dataset as ds
+    from pyarrow import fs
+    dataset = ds.dataset(path, format='parquet' if fmt == 'parquet' else 'ipc', filesystem=fs.LocalFileSystem(use_mmap=True))
+    expression = None
+    for col, op, value in (filters or []):
+        field = ds.field(col)
+        if op == 'in':
+            e = field.isin(list(value))
+        elif op == 'not in':
+            e = ~field.isin(list(value))
+        else:
+            e = _operators[op](field, value)
+        expression = e if expression is None else expression & e
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+def readTableLazy(base, fmt='csv', columns=None, filters=None, parse_dates=None, dayfirst=True, blocksize='64MB'):
+    '''
+    Reads a table as a partitioned lazy (dask) dataframe, for tables that do not fit in memory. The partitions are only read when they are
+    computed. For parquet the filters are also used to skip row groups; for arrow each partition is a range of record batches.
+
+    Input:
+    ------
+        base:        Full path of the table without extension
+        fmt:         Table format ('csv', 'parquet' or 'arrow')
+
+    Optional Input:
+    ---------------
+        columns:     List with the names of the columns to read (default is all columns)
+        filters:     List with (column, operator, value) tuples that are combined with AND (see filterDataFrame)
+        parse_dates: List with names of columns that contain dates (only used for csv)
+        dayfirst:    Parse dates with the day first (only used for csv)
+        blocksize:   Size of a csv partition in bytes (e.g. '64MB'); for arrow the number of record batches per partition is chosen so that a
+                     partition has about the same size in memory
+
+    Returns:
+    --------
+        ddf: Dask dataframe
+    '''
+    import dask.dataframe as dd
+    path = tableFile(base, fmt)
+    if fmt == 'csv':
+        ddf = dd.read_csv(path, usecols=columns, parse_dates=parse_dates, dayfirst=dayfirst, blocksize=blocksize)
+    elif fmt == 'parquet':
+        ddf = dd.read_parquet(path, columns=columns, filters=[tuple(f) for f in filters] if filters else None)
+    else:
+        import pyarrow as pa
+        from dask.utils import parse_bytes
+        with pa.memory_map(path) as source:
+            reader = pa.ipc.open_file(source)
+            nbatches = reader.num_record_batches
+            batchBytes = reader.get_batch(0).nbytes if nbatches else 1
+        step = max(1, int(parse_bytes(blocksize) // max(batchBytes, 1)))
+        ddf = dd.from_map(_readBatches, [(path, i, min(i + step, nbatches), columns) for i in range(0, max(nbatches, 1), step)])
+    return ddf.map_partitions(filterDataFrame, filters) if filters else ddf
+
+def _readBatches(args):
+    '''
+    Reads a range of record batches of an Arrow IPC file into a pandas dataframe (one partition of readTableLazy).
+    '''
+    import pyarrow as pa
+    path, start, stop, columns = args
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        if stop <= start:
+            table = reader.schema.empty_table()
+        else:
+            table = pa.Table.from_batches([reader.get_batch(i) for i in range(start, stop)])
+        if columns:
+            table = table.select(columns)
+        return table.to_pandas()
+
+def writeTableParts(parts, base, fmt='csv'):
+    '''
+    Writes dataframes (e.g. the computed partitions of a lazy dataframe) one after another to one table, so that only one part is in memory
+    at a time. The columns of all parts must be the same.
+
+    Input:
+    ------
+        parts: Iterable with pandas dataframes
+        base:  Full path of the table without extension
+        fmt:   Table format ('csv', 'parquet' or 'arrow')
+
+    Returns:
+    --------
+        path:  Full path of the table that was written
+    '''
+    import pyarrow as pa
+    path = tableFile(base, fmt)
+    writer = None; schema = None; first = True
+    try:
+        for df in parts:
+            if fmt == 'csv':
+                df.to_csv(path, index=False, mode='w' if first else 'a', header=first)
+                first = False
+                continue
+            df = df.infer_objects()
+            df.columns = [str(c) for c in df.columns]
+            table = pa.Table.from_pandas(df.reset_index(drop=True), schema=schema, preserve_index=False)
+            if writer is None:
+                schema = table.schema
+                if fmt == 'parquet':
+                    import pyarrow.parquet as pq
+                    writer = pq.ParquetWriter(path, schema)
+                else:
+                    writer = pa.ipc.new_file(path, schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    return path
+
+def exportCsv(base, fmt):
+    '''
+    Exports a table in a columnar format to a csv-file with the same base name (e.g. for plotting).
+
+    Input:
+    ------
+        base: Full path of the table without extension
+        fmt:  Table format of the existing table ('parquet' or 'arrow')
+
+    Returns:
+    --------
+        path: Full path of the csv-file
+    '''
+    if fmt == 'csv':
+        return tableFile(base, fmt)
+    return writeTable(readTable(base, fmt), base, 'csv')
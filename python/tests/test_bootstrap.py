@@ -0,0 +1,34 @@
+import threading
+import numpy as np
+import pandas as pd
+import bootstrap
+
+'''
+Tests of the bootstrap confidence intervals: the intervals do not depend on the number of workers, and no processes are forked while other
+threads are running.
+'''
+
+
+def observations():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'Forecasted hours': np.repeat([1, 2, 3, 4], 50), 'Hcount': 1})
+    df['x'] = rng.gamma(0.5, 2., len(df))
+    df['y'] = df['x'] + rng.normal(0., 0.5, len(df))
+    return df
+
+def test_threads_while_other_threads_run(monkeypatch):
+    df = observations()
+    monkeypatch.setattr(bootstrap, 'maxElements', 5000)
+    serial = bootstrap.bootstrapCI(df, ['Forecasted hours'], 'x', 'y', nBoot=100, nWorkers=1)
+    #-e.g. the worker threads of a dask scheduler
+    stop = threading.Event()
+    other = threading.Thread(target=stop.wait)
+    other.start()
+    try:
+        assert not bootstrap.canFork()
+        monkeypatch.setattr(bootstrap, 'ProcessPoolExecutor', None)
+        parallel = bootstrap.bootstrapCI(df, ['Forecasted hours'], 'x', 'y', nBoot=100, nWorkers=4)
+    finally:
+        stop.set()
+        other.join()
+    pd.testing.assert_frame_equal(serial, parallel)
@@ -0,0 +1,21 @@
+import numpy as np
+import pandas as pd
+from forecastmatrix import newForecastMatrix, fillForecasts, toDataFrame
+
+'''
+Tests of the sparse forecast matrix of combine_station_forecast.py.
+'''
+
+
+def test_fill_forecasts():
+    times = pd.date_range('2019-01-01', periods=4, freq='h')
+    obs = np.array([[1., 0., np.nan, 2.], [3., 1., 1., np.nan]])
+    samples = [(1, times[0], np.array([5., 6.])), (2, times[1], np.array([7., np.nan])), (1, times[2], np.array([8., 9.])),
+               (3, times[3], np.array([1., 1.])), (1, times[3] + pd.Timedelta(hours=1), np.array([1., 1.]))]
+    matrix = newForecastMatrix(2, len(times), 2)
+    assert fillForecasts(matrix, samples, times, obs) == len(samples)
+    df = toDataFrame(matrix, ['S0', 'S1'], times, obs, 'P', ['1', '2'])
+    #-no forecast where the station value is zero or missing, or beyond the forecast hours of the matrix or the date range
+    assert df['ExtSiteID'].tolist() == ['S0', 'S1', 'S1']
+    assert df['DateTime of forecast'].tolist() == [times[0], times[0], times[2]]
+    np.testing.assert_array_equal(df[['1', '2']].to_numpy(), np.array([[5., np.nan], [6., np.nan], [9., np.nan]], dtype=np.float32))
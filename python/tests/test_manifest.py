@@ -0,0 +1,35 @@
+import os
+from manifest import loadManifest, saveManifest, changedFiles, recordFile, settingsChanged
+
+'''
+Tests of the manifest of processed files: changed settings of a stage and missing output files.
+'''
+
+settings = {'from_date': '2018-08-01 00:00', 'to_date': '2019-09-12 23:00', 'accum_hours': [1, 3, 6, 12, 24]}
+
+
+def processed(tmp_path):
+    inFile = str(tmp_path / 'P.csv'); outFile = str(tmp_path / 'out_P.csv')
+    for f in [inFile, outFile]:
+        with open(f, 'w') as fo:
+            fo.write('1,2,3\n')
+    manifest = {}
+    recordFile(manifest, inFile, [outFile], settings)
+    saveManifest(manifest, str(tmp_path / 'manifest.json'))
+    return loadManifest(str(tmp_path / 'manifest.json')), inFile, outFile
+
+def test_unchanged_file_is_skipped(tmp_path):
+    manifest, inFile, outFile = processed(tmp_path)
+    assert changedFiles(manifest, [inFile], settings) == []
+    assert not settingsChanged(manifest, settings)
+
+def test_changed_settings(tmp_path):
+    manifest, inFile, outFile = processed(tmp_path)
+    changed = dict(settings, accum_hours=[1, 3])
+    assert changedFiles(manifest, [inFile], changed) == [inFile]
+    assert settingsChanged(manifest, changed)
+
+def test_missing_output(tmp_path):
+    manifest, inFile, outFile = processed(tmp_path)
+    os.remove(outFile)
+    assert changedFiles(manifest, [inFile], settings) == [inFile]
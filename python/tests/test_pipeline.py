@@ -0,0 +1,101 @@
+import os, shutil
+import numpy as np
+import pandas as pd
+import pytest
+import pipeline
+from benchmark import makeNetCDF, extent
+from gridtools import targetGrid
+from sampling import stationPixelIndex
+from manifest import loadManifest
+
+'''
+Tests of the incremental streaming pipeline: runs that arrive late, changed stations or catchments, and the provisional sums of the windows
+that are still open.
+'''
+
+product = 'P'
+runTimes = pd.date_range('2019-01-01 00:00', periods=5, freq='6h')
+
+
+def linearNZTM(lat, lon, cacheDir):
+    #-linear lat/lon to NZTM mapping over Canterbury, so that the tests do not need a coordinate transformation
+    return 1.3e6 + (lon - 170.) * 1.2e5, 5.0e6 + (lat + 44.5) * 1.5e5
+
+def ncName(runTime, prefix=product):
+    return prefix + '_' + runTime.strftime('%Y%m%d%H') + '.nc'
+
+@pytest.fixture
+def fixture(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, 'gridNZTM', linearNZTM)
+    rng = np.random.default_rng(0)
+    lat = np.linspace(-44.5, -42., 30); lon = np.linspace(170., 173.5, 40)
+    runDir = tmp_path / 'runs'
+    runDir.mkdir()
+    for runTime in runTimes:
+        makeNetCDF(str(runDir / ncName(runTime)), runTime, lat, lon, rng)
+    nstations = 20
+    X = rng.uniform(1.35e6, 1.65e6, nstations); Y = rng.uniform(5.05e6, 5.3e6, nstations)
+    datetime_range = pd.date_range('2019-01-01', '2019-01-07', freq='h')
+    obs = rng.gamma(0.5, 2., (nstations, len(datetime_range)))
+    obs[rng.random(obs.shape) < 0.3] = np.nan
+    geoTrans, xc, yc = targetGrid(*extent, np.ceil((extent[2]-extent[0])/1000), np.ceil((extent[3]-extent[1])/1000))
+    row, col, valid = stationPixelIndex(geoTrans, xc.shape[0], xc.shape[1], X, Y)
+    shared = {'statIDs': ['S%d' %i for i in range(nstations)], 'obs': obs, 'stationMask': np.ones(nstations, dtype=bool),
+              'M': (rng.random((3, nstations)) < 0.4).astype(np.float64), 'catchments': ['A', 'B', 'C'], 'tX': xc[row, col], 'tY': yc[row, col],
+              'valid': valid, 'datetime_range': datetime_range}
+    settings = {'ncRootDir': str(tmp_path / 'nc'), 'gridCacheDir': str(tmp_path / 'grid_cache'), 'bounds': extent, 'timeZone': 'Pacific/Auckland',
+                'incremental': True, 'queueSize': 2, 'statsEvery': 0, 'tableFormat': 'csv', 'tapDir': None, 'leads': 24,
+                'accumHours': [1, 3, 6], 'profile': False, 'inWorker': False}
+    return tmp_path, runDir, shared, settings
+
+def addRuns(tmp_path, runDir, runs):
+    ncDir = tmp_path / 'nc' / product
+    ncDir.mkdir(parents=True, exist_ok=True)
+    for runTime in runs:
+        shutil.copy(str(runDir / ncName(runTime)), str(ncDir / ncName(runTime)))
+
+def run(tmp_path, shared, settings, name, **changes):
+    resultDir = tmp_path / name
+    resultDir.mkdir(exist_ok=True)
+    pipeline.initWorker(shared, dict(settings, resultDir=str(resultDir), **changes))
+    return pipeline.runProduct(product)[1]
+
+def assertSumsEqual(a, b):
+    for x, y in zip(a, b):
+        pd.testing.assert_frame_equal(x, y)
+
+def test_provisional_sums_equal_closed_windows(fixture):
+    tmp_path, runDir, shared, settings = fixture
+    addRuns(tmp_path, runDir, runTimes)
+    incremental = run(tmp_path, shared, settings, 'incremental')
+    full = run(tmp_path, shared, settings, 'full', incremental=False)
+    assertSumsEqual(incremental, full)
+    stats = pd.read_csv(str(tmp_path / 'incremental' / ('cumsum_sums_all_stations_canterbury_' + product + '.csv')))
+    assert stats['n'].sum() == incremental[0]['n'].sum()
+
+def test_late_run_rebuilds_state(fixture):
+    tmp_path, runDir, shared, settings = fixture
+    addRuns(tmp_path, runDir, runTimes.delete(2))
+    run(tmp_path, shared, settings, 'incremental')
+    #-the run of 12:00 arrives after the run of 18:00 was added
+    addRuns(tmp_path, runDir, runTimes[2:3])
+    late = run(tmp_path, shared, settings, 'incremental')
+    assertSumsEqual(late, run(tmp_path, shared, settings, 'full', incremental=False))
+    manifest = loadManifest(str(tmp_path / 'incremental' / ('manifest_pipeline_' + product + '.json')))
+    assert len(manifest) == len(runTimes)
+
+def test_changed_catchments_rebuild_state(fixture):
+    tmp_path, runDir, shared, settings = fixture
+    addRuns(tmp_path, runDir, runTimes)
+    run(tmp_path, shared, settings, 'incremental')
+    changed = dict(shared, M=np.vstack([shared['M'], np.ones(len(shared['statIDs']))]), catchments=shared['catchments'] + ['D'])
+    sums = run(tmp_path, changed, settings, 'incremental')
+    assert 'D' in sums[1].index.get_level_values('Catchment')
+    assertSumsEqual(sums, run(tmp_path, changed, settings, 'full', incremental=False))
+
+def test_duplicate_run_raises(fixture):
+    tmp_path, runDir, shared, settings = fixture
+    addRuns(tmp_path, runDir, runTimes[:2])
+    shutil.copy(str(runDir / ncName(runTimes[1])), str(tmp_path / 'nc' / product / ncName(runTimes[1], 'Q')))
+    with pytest.raises(ValueError):
+        run(tmp_path, shared, settings, 'incremental')
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+import resultstore
+from tableio import writeTable
+
+'''
+Tests of the query API over the tables of organize_for_plots.py.
+'''
+
+product = 'P'
+
+
+def catchmentTable(tmp_path):
+    #-catchment A has months 6 and 7, catchment B months 7 and 8
+    rng = np.random.default_rng(0)
+    rows = [(c, m, t) for c, months in [('A', [6, 7]), ('B', [7, 8])] for m in months
+            for t in pd.date_range('2019-%02d-01' %m, periods=10, freq='h')]
+    df = pd.DataFrame(rows, columns=['Catchment', 'Month', 'DateTime of forecast'])
+    df = df.loc[df.index.repeat(2)].reset_index(drop=True)
+    df['Forecasted hours'] = np.tile([1, 2], len(df) // 2)
+    df['Accum. hours'] = 6
+    df['Accum. catchment precipitation [mm]'] = rng.gamma(0.5, 2., len(df))
+    df['Accum. forecasted precipitation [mm]'] = rng.gamma(0.5, 2., len(df))
+    df['Hcount'] = 6
+    writeTable(df, str(tmp_path / ('cumsum_catchments_avg_' + product)), 'csv')
+    resultstore.invalidate()
+    return str(tmp_path)
+
+def test_existing_combination(tmp_path):
+    d = catchmentTable(tmp_path)
+    stats = resultstore.queryStatistics(d, product, catchment='A', month=7, windows=6)
+    assert stats['Nr. of observations'].tolist() == [10, 10]
+
+def test_nonexistent_combination(tmp_path):
+    #-catchment A and month 8 both occur in the table, but not together
+    d = catchmentTable(tmp_path)
+    stats = resultstore.queryStatistics(d, product, catchment='A', month=8, windows=6)
+    assert len(stats) == 0
+    assert len(resultstore.queryStatistics(d, product, catchment='A', month=[7, 8], windows=6)) == 2
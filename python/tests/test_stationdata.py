@@ -0,0 +1,53 @@
+import sqlite3
+import pandas as pd
+import pytest
+from stationdata import createSchema, syncStore, readStore, missingPeriods
+
+'''
+Tests of the station store against an in-memory SQLite database: only the periods that are not in the store yet are fetched, and hours
+that the database does not hold yet are fetched by a later sync.
+'''
+
+datasetTypes = [38]
+qualityCodes = [600]
+
+
+def insertHours(con, hours, sites=('S1', 'S2')):
+    con.executemany('INSERT INTO TSDataNumericHourly VALUES (?, ?, ?, ?, ?)',
+                    [(s, 38, t.strftime('%Y-%m-%d %H:%M:%S'), 1.0, 600) for s in sites for t in hours])
+    con.commit()
+
+@pytest.fixture
+def con():
+    con = sqlite3.connect(':memory:')
+    createSchema(con)
+    con.executemany('INSERT INTO TSDataNumericHourlySumm VALUES (?, ?)', [('S1', 38), ('S2', 38)])
+    yield con
+    con.close()
+
+def test_missing_periods():
+    covered = [['2019-01-01 05:00', '2019-01-01 09:00']]
+    assert missingPeriods(covered, '2019-01-01 00:00', '2019-01-01 12:00') == [(pd.Timestamp('2019-01-01 00:00'), pd.Timestamp('2019-01-01 04:00')),
+                                                                              (pd.Timestamp('2019-01-01 10:00'), pd.Timestamp('2019-01-01 12:00'))]
+    assert missingPeriods(covered, '2019-01-01 06:00', '2019-01-01 08:00') == []
+
+def test_only_missing_periods_are_fetched(con, tmp_path):
+    storeDir = str(tmp_path / 'store')
+    day = pd.date_range('2019-01-01 00:00', '2019-01-01 23:00', freq='h')
+    #-the database only holds the hours up to 12:00 at the first sync
+    insertHours(con, day[:13])
+    assert syncStore(con, storeDir, datasetTypes, qualityCodes, day[0], day[-1]) == [(day[0], day[-1])]
+    insertHours(con, day[13:])
+    assert syncStore(con, storeDir, datasetTypes, qualityCodes, day[0], day[-1]) == [(day[13], day[-1])]
+    assert syncStore(con, storeDir, datasetTypes, qualityCodes, day[0], day[-1]) == []
+    df = readStore(storeDir, datasetTypes, qualityCodes, day[0], day[-1])
+    assert len(df) == 2 * len(day)
+    assert not df.duplicated(subset=['ExtSiteID', 'DateTime']).any()
+
+def test_period_without_data_is_fetched_again(con, tmp_path):
+    storeDir = str(tmp_path / 'store')
+    day = pd.date_range('2019-01-02 00:00', '2019-01-02 23:00', freq='h')
+    assert syncStore(con, storeDir, datasetTypes, qualityCodes, day[0], day[-1]) == [(day[0], day[-1])]
+    insertHours(con, day)
+    assert syncStore(con, storeDir, datasetTypes, qualityCodes, day[0], day[-1]) == [(day[0], day[-1])]
+    assert len(readStore(storeDir, datasetTypes, qualityCodes, day[0], day[-1])) == 2 * len(day)
@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import pytest
+import zonal
+from cubestore import appendRuns, cubeSignature
+
+'''
+Tests of the catchment means of the forecast grid: only the runs that are new or overwritten in a cube store are calculated again.
+'''
+
+geoTrans = (1.5e6, 1000., 0., 5.2e6, 0., -1000.)
+nleads = 6
+
+
+def addRuns(cubeFile, runTimes, rng):
+    validTimes = np.array([pd.date_range(t + pd.Timedelta(hours=1), periods=nleads, freq='h') for t in runTimes])
+    appendRuns(cubeFile, runTimes, validTimes, rng.gamma(0.5, 2., (len(runTimes), nleads, 8, 10)).astype(np.float32), geoTrans, nleads=nleads,
+               runChunk=2, spatialChunk=4)
+
+@pytest.fixture
+def cube(tmp_path, monkeypatch):
+    calls = []
+    zonalMeans = zonal.zonalMeans
+    monkeypatch.setattr(zonal, 'zonalMeans', lambda W, fields: calls.append(1) or zonalMeans(W, fields))
+    rng = np.random.default_rng(0)
+    cubeFile = str(tmp_path / 'P.zarr')
+    addRuns(cubeFile, pd.date_range('2019-01-01', periods=3, freq='6h'), rng)
+    #-two catchments: the left and the right half of the grid
+    cells = np.arange(80).reshape(8, 10)
+    C = sp.csr_matrix((np.ones(80), (np.repeat([0, 1], 40), np.concatenate([cells[:, :5].ravel(), cells[:, 5:].ravel()]))), shape=(2, 80))
+    W = sp.diags(1. / np.asarray(C.sum(axis=1)).ravel()).dot(C).tocsr()
+    return cubeFile, W, calls, rng, str(tmp_path / 'cache')
+
+def test_only_new_runs_are_calculated(cube):
+    cubeFile, W, calls, rng, cacheDir = cube
+    zonal.cubeZonalMeans(cubeFile, W, ['A', 'B'], 'P', cacheDir=cacheDir)
+    assert len(calls) == 3
+    signature = cubeSignature(cubeFile)
+    addRuns(cubeFile, pd.date_range('2019-01-01 18:00', periods=1), rng)
+    assert cubeSignature(cubeFile) != signature
+    df = zonal.cubeZonalMeans(cubeFile, W, ['A', 'B'], 'P', cacheDir=cacheDir)
+    assert len(calls) == 4
+    pd.testing.assert_frame_equal(df, zonal.cubeZonalMeans(cubeFile, W, ['A', 'B'], 'P'))
+
+def test_overwritten_run_is_calculated(cube):
+    cubeFile, W, calls, rng, cacheDir = cube
+    zonal.cubeZonalMeans(cubeFile, W, ['A', 'B'], 'P', cacheDir=cacheDir)
+    addRuns(cubeFile, pd.date_range('2019-01-01 06:00', periods=1), rng)
+    df = zonal.cubeZonalMeans(cubeFile, W, ['A', 'B'], 'P', cacheDir=cacheDir)
+    assert len(calls) == 4
+    pd.testing.assert_frame_equal(df, zonal.cubeZonalMeans(cubeFile, W, ['A', 'B'], 'P'))
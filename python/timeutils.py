@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+import pandas as pd
+import numpy as np
+import os
+
+'''
+Time handling that is shared by the pipeline stages: conversion of UTC to (naive) NZ local time, and parsing of the run and forecast times
+from the names of the netCDF files and GTiffs. The conversion uses a table with the UTC offset per hour of the years that are converted,
+which is built once per time zone and period and cached, so that all timestamps of a file (or all files) are converted with one lookup
+instead of localizing and converting them one by one.
+'''
+
+#-UTC offset tables per time zone and period: {(timeZone, firstYear, lastYear): (utcStart, offsets)}
+_offsetTables = {}
+
+
+def offsetTable(timeZone, start, end):
+    '''
+    Returns the UTC offsets of a time zone for every hour of the years from start to end. The table is built once per time zone and period
+    and then taken from the cache. Offsets are taken per whole UTC hour, which holds for the daylight saving changes of New Zealand.
+
+    Input:
+    ------
+        timeZone: Name of the time zone (e.g. 'Pacific/Auckland')
+        start:    First UTC timestamp that needs to be converted
+        end:      Last UTC timestamp that needs to be converted
+
+    Returns:
+    --------
+        [utcStart, offsets]: utcStart is the first UTC hour of the table (numpy datetime64[ns]), and offsets is an array with the UTC offset
+                             (timedelta64[ns]) of each hour from utcStart onwards
+    '''
+    key = (timeZone, pd.Timestamp(start).year, pd.Timestamp(end).year)
+    if key not in _offsetTables:
+        hours = pd.date_range(pd.Timestamp(year=key[1], month=1, day=1), pd.Timestamp(year=key[2] + 1, month=1, day=1), freq='h', tz='utc')
+        offsets = hours.tz_convert(timeZone).tz_localize(None).to_numpy(dtype='datetime64[ns]') - hours.tz_localize(None).to_numpy(dtype='datetime64[ns]')
+        _offsetTables[key] = (hours[0].tz_localize(None).to_datetime64().astype('datetime64[ns]'), offsets)
+    return _offsetTables[key]
+
+def utcToLocal(times, timeZone):
+    '''
+    Converts UTC timestamps to naive local timestamps with one lookup in the cached offset table (see offsetTable).
+
+    Input:
+    ------
+        times:    Array-like with naive UTC timestamps
+        timeZone: Name of the time zone (e.g. 'Pacific/Auckland')
+
+    Returns:
+    --------
+        times:    DatetimeIndex with the naive local timestamps
+    '''
+    t = pd.DatetimeIndex(times).to_numpy(dtype='datetime64[ns]')
+    if len(t) == 0:
+        return pd.DatetimeIndex(t)
+    utcStart, offsets = offsetTable(timeZone, t.min(), t.max())
+    hour = (t - utcStart) // np.timedelta64(1, 'h')
+    return pd.DatetimeIndex(t + offsets[hour])
+
+def ncRunTime(ncF):
+    '''
+    Parses the UTC run time of a forecast from the name of a MetService netCDF file, which ends with the run time as YYYYmmddHH
+    (e.g. ..._2019010100.nc).
+
+    Input:
+    ------
+        ncF:     (Full path to) the netCDF file
+
+    Returns:
+    --------
+        runTime: Naive UTC timestamp of the run (pd.Timestamp)
+    '''
+    return pd.Timestamp(pd.to_datetime(os.path.basename(ncF)[-13:-3], format='%Y%m%d%H'))
+
+def tifName(hours, validTimes, runTime):
+    '''
+    Returns the names of the GTiffs of a run ({hours}h_{YYYYmmdd_HHMM of forecast}_{YYYYmmdd_HHMM of run}.tif), formatting all timestamps at
+    once.
+
+    Input:
+    ------
+        hours:      Array-like with the forecast hours
+        validTimes: Array-like with the (local) timestamps for which the forecasts are valid
+        runTime:    (Local) timestamp of the run
+
+    Returns:
+    --------
+        names:      List with the file names
+    '''
+    run = pd.Timestamp(runTime).strftime('%Y%m%d_%H%M')
+    return ['%sh_%s_%s.tif' %(h, v, run) for h, v in zip(hours, pd.DatetimeIndex(validTimes).strftime('%Y%m%d_%H%M'))]
+
+def parseTifNames(tifFiles):
+    '''
+    Parses the forecast hours and the (local) timestamps for which the forecasts are valid from the names of GTiffs written by process_nc.py
+    (see tifName), for all files at once.
+
+    Input:
+    ------
+        tifFiles: List with (full paths to) the GTiff files
+
+    Returns:
+    --------
+        [hours, tstamps]: Array with the forecast hours (int) and DatetimeIndex with the timestamps of the forecasts
+    '''
+    parts = pd.Series([os.path.basename(f) for f in tifFiles], dtype=object).str.split('_', n=3, expand=True)
+    if len(parts) == 0:
+        return np.zeros(0, dtype=int), pd.DatetimeIndex([])
+    hours = parts[0].str.rstrip('h').astype(int).to_numpy()
+    tstamps = pd.DatetimeIndex(pd.to_datetime(parts[1] + parts[2], format='%Y%m%d%H%M'))
+    return hours, tstamps
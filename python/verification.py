@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+import pandas as pd
+import numpy as np
+
+'''
+Grouped verification statistics of forecasted versus station (or catchment) precipitation. Per group only the sufficient statistics
+(n, sum(x), sum(y), sum(x^2), sum(y^2), sum(xy) and the sum of Hcount) are collected in one groupby pass. The adjusted R-squared of the
+linear fit y = a + b*x, the RMSE, the bias and the number of observations are derived from these sums in closed form, so no regression
+model has to be fitted per group. Because the sums can be added, the statistics can be updated with new forecast runs without reading
+the history again.
+'''
+
+#-names of the sufficient statistics
+sumCols = ['n', 'Sx', 'Sy', 'Sxx', 'Syy', 'Sxy', 'Sh']
+
+
+def groupSums(df, keys, xCol, yCol, countCol='Hcount'):
+    '''
+    Calculates the sufficient statistics for each group in one groupby pass.
+
+    Input:
+    ------
+        df:       Dataframe with the observations
+        keys:     List with the names of the columns to group by (e.g. ['Forecasted hours', 'Accum. hours'])
+        xCol:     Name of the column with the observed precipitation (x)
+        yCol:     Name of the column with the forecasted precipitation (y)
+
+    Optional Input:
+    ---------------
+        countCol: Name of the column with the number of hours that were aggregated (Hcount)
+
+    Returns:
+    --------
+        sums:     Dataframe indexed by keys with the columns 'n', 'Sx', 'Sy', 'Sxx', 'Syy', 'Sxy' and 'Sh'
+    '''
+    x = df[xCol].to_numpy(dtype=np.float64)
+    y = df[yCol].to_numpy(dtype=np.float64)
+    terms = pd.DataFrame({'n': 1, 'Sx': x, 'Sy': y, 'Sxx': x * x, 'Syy': y * y, 'Sxy': x * y,
+                          'Sh': df[countCol].to_numpy(dtype=np.float64)}, index=df.index)
+    sums = terms.groupby([df[k] for k in keys], sort=True).sum()
+    sums['n'] = sums['n'].astype(np.int64)
+    return sums
+
+def mergeSums(sums, newSums):
+    '''
+    Merges two tables with sufficient statistics, e.g. the statistics of the history with those of new forecast runs. The observations
+    behind both tables must not overlap.
+
+    Input:
+    ------
+        sums:    Dataframe with sufficient statistics (see groupSums), or None
+        newSums: Dataframe with sufficient statistics with the same index levels
+
+    Returns:
+    --------
+        sums:    Dataframe with the summed statistics of all groups in both tables
+    '''
+    if sums is None or len(sums) == 0:
+        return newSums.copy()
+    merged = sums[sumCols].add(newSums[sumCols], fill_value=0).sort_index()
+    merged['n'] = merged['n'].astype(np.int64)
+    return merged
+
+def statsFromArrays(n, Sx, Sy, Sxx, Syy, Sxy, Sh):
+    '''
+    Derives the adjusted R-squared, the RMSE and the bias (see statsFromSums) from arrays with sufficient statistics. The arrays can have
+    any (broadcastable) shape, e.g. (resamples, groups) for bootstrap resamples of all groups at once.
+
+    Input:
+    ------
+        n, Sx, Sy, Sxx, Syy, Sxy, Sh: Arrays with the sufficient statistics (see groupSums)
+
+    Returns:
+    --------
+        [r2adj, rmse, bias]: Arrays with the adjusted R-squared [-], the RMSE [mm] and the bias [%]
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mx = Sx / n
+        my = Sy / n
+        #-centered sums of squares and cross products
+        cxx = np.maximum(Sxx - n * mx * mx, 0.)
+        cyy = np.maximum(Syy - n * my * my, 0.)
+        cxy = Sxy - n * mx * my
+        r2 = cxy * cxy / (cxx * cyy)
+        r2adj = 1. - (n - 1.) / (n - 2.) * (1. - r2)
+        mse = np.maximum(Sxx - 2. * Sxy + Syy, 0.) / n
+        rmse = np.sqrt(mse) / (Sh / n)
+        bias = ((my - mx) / mx) * 100
+    return r2adj, rmse, bias
+
+def statsFromSums(sums):
+    '''
+    Derives the verification statistics from the sufficient statistics in closed form. These are the same statistics as the adjusted
+    R-squared of an OLS fit with intercept of y on x, the RMSE between y and x divided by the mean Hcount, the bias of the mean y relative to
+    the mean x (in %), and the number of observations.
+
+    Input:
+    ------
+        sums:  Dataframe with sufficient statistics (see groupSums)
+
+    Returns:
+    --------
+        stats: Dataframe with the same index and the columns 'R-squared [-]', 'RMSE [mm]', 'Bias [%]' and 'Nr. of observations'
+    '''
+    r2adj, rmse, bias = statsFromArrays(*[sums[c].to_numpy(dtype=np.float64) for c in sumCols])
+    return pd.DataFrame({'R-squared [-]': r2adj, 'RMSE [mm]': rmse, 'Bias [%]': bias, 'Nr. of observations': sums['n'].to_numpy()},
+                        index=sums.index)
+
+def percentError(df, leads, keepCols, obsCol='Station precipitation [mm]'):
+    '''
+    Calculates the percentual difference between the forecasted and the observed precipitation, ((forecast - observed) / observed) * 100,
+    for all forecast hours at once. Where the observed precipitation is 0 mm the percentual difference is undefined and set to NaN (instead
+    of inf).
+
+    Input:
+    ------
+        df:       Dataframe with the observed precipitation and a column with the forecasted precipitation for each forecast hour
+        leads:    List with the names of the forecast hour columns (e.g. ['1', '2', ..., '85'])
+        keepCols: List with the names of the columns that are copied to the output
+
+    Optional Input:
+    ---------------
+        obsCol:   Name of the observed precipitation column
+
+    Returns:
+    --------
+        df_proc:  Dataframe with keepCols, followed by the percentual differences with the forecast hours (int) as column names
+    '''
+    obs = df[obsCol].to_numpy(dtype=np.float64)[:, None]
+    proc = np.full((len(df), len(leads)), np.nan)
+    np.divide(df[leads].to_numpy(dtype=np.float64) - obs, obs, out=proc, where=(obs != 0))
+    proc *= 100
+    return pd.concat([df[keepCols].reset_index(drop=True), pd.DataFrame(proc, columns=[int(h) for h in leads])], axis=1)
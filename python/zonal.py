@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+import xarray as xr
+import os, hashlib
+from catchments import shapefileHash
+from forecastmatrix import newForecastMatrix, addForecasts, toWide
+from instrument import timer
+
+'''
+Zonal statistics of the forecast grid. The catchment polygons are rasterized once onto the 1 km Canterbury grid of process_nc.py as a sparse
+weight matrix (catchments x grid cells) with the fraction of each cell that is covered by the catchment, normalized so that each row sums
+to one. The area-mean forecast of all catchments is then one sparse matrix product per field (or per run for all lead hours at once),
+which gives true catchment-mean forecasts instead of the average of the few station pixels within each catchment.
+'''
+
+
+def coverageFractions(geometry, geotransform, shape, supersample=10):
+    '''
+    Returns the grid cells that are (partly) covered by a polygon and the covered fraction of each cell. The fractions are estimated from
+    supersample x supersample sub-cells per grid cell.
+
+    Input:
+    ------
+        geometry:     Shapely (multi)polygon in the coordinate system of the grid
+        geotransform: GDAL geotransform of the grid (north-up)
+        shape:        (rows, cols) of the grid
+
+    Optional Input:
+    ---------------
+        supersample:  Number of sub-cells per cell in each direction
+
+    Returns:
+    --------
+        [cells, fractions]: Array with the flat indices (row * cols + col) of the covered cells and array with their covered fractions
+    '''
+    import shapely
+    nrows, ncols = shape
+    x0, dx, _, y0, _, dy = geotransform
+    xmin, ymin, xmax, ymax = geometry.bounds
+    #-block of cells that contains the polygon
+    c0 = max(int(np.floor((xmin - x0) / dx)), 0); c1 = min(int(np.ceil((xmax - x0) / dx)), ncols)
+    r0 = max(int(np.floor((ymax - y0) / dy)), 0); r1 = min(int(np.ceil((ymin - y0) / dy)), nrows)
+    if c1 <= c0 or r1 <= r0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    #-centres of the sub-cells
+    sub = (np.arange(supersample) + 0.5) / supersample
+    xs = x0 + (np.arange(c0, c1)[:, None] + sub[None, :]).ravel() * dx
+    ys = y0 + (np.arange(r0, r1)[:, None] + sub[None, :]).ravel() * dy
+    shapely.prepare(geometry)
+    inside = shapely.contains_xy(geometry, xs[None, :], ys[:, None])
+    fractions = inside.reshape(r1 - r0, supersample, c1 - c0, supersample).mean(axis=(1, 3))
+    rows, cols = np.nonzero(fractions)
+    return (rows + r0) * ncols + (cols + c0), fractions[rows, cols]
+
+def catchmentWeights(catchmentShp, geotransform, shape, cacheDir, catchCol='CATCH_NAME', supersample=10, epsg=2193):
+    '''
+    Returns the sparse zonal weight matrix of the catchments on a grid. Polygons with the same catchment name are merged. The matrix is cached
+    in cacheDir as long as the shapefile and the grid do not change.
+
+    Input:
+    ------
+        catchmentShp: Full path to the polygon shapefile with the catchments
+        geotransform: GDAL geotransform of the grid (north-up)
+        shape:        (rows, cols) of the grid
+        cacheDir:     Directory where the weight matrix is cached
+
+    Optional Input:
+    ---------------
+        catchCol:     Name of the catchment name attribute
+        supersample:  Number of sub-cells per cell in each direction used to estimate the covered fractions
+        epsg:         EPSG number of the coordinate system of the grid
+
+    Returns:
+    --------
+        [W, catchments, coverage]: scipy.sparse CSR matrix (catchments x grid cells) with rows that sum to one, list with the catchment names
+                                   in the order of the shapefile, and array with the covered area of each catchment in grid cells
+    '''
+    key = '_'.join([shapefileHash(catchmentShp), catchCol, str(supersample), str(epsg), str(tuple(shape)),
+                    hashlib.sha1(np.asarray(geotransform, dtype=np.float64).tobytes()).hexdigest()])
+    cacheFile = os.path.join(cacheDir, 'zonal_' + hashlib.sha1(key.encode()).hexdigest() + '.npz')
+    if os.path.isfile(cacheFile):
+        with np.load(cacheFile) as cache:
+            C = sp.csr_matrix((cache['data'], cache['indices'], cache['indptr']), shape=tuple(cache['shape']))
+            catchments = cache['catchments'].tolist()
+    else:
+        import geopandas as gpd
+        import shapely
+        catchment_gdf = gpd.read_file(catchmentShp)
+        if catchment_gdf.crs is not None and catchment_gdf.crs.to_epsg() != epsg:
+            catchment_gdf = catchment_gdf.to_crs(epsg=epsg)
+        catchments = pd.unique(catchment_gdf[catchCol]).tolist()
+        rows = []; cells = []; fractions = []
+        for i, name in enumerate(catchments):
+            geometry = shapely.union_all(catchment_gdf.geometry[catchment_gdf[catchCol] == name].values)
+            c, f = coverageFractions(geometry, geotransform, shape, supersample)
+            rows.append(np.full(len(c), i)); cells.append(c); fractions.append(f)
+        C = sp.csr_matrix((np.concatenate(fractions), (np.concatenate(rows), np.concatenate(cells))), shape=(len(catchments), shape[0] * shape[1]))
+        if not os.path.exists(cacheDir):
+            os.makedirs(cacheDir)
+        np.savez(cacheFile, data=C.data, indices=C.indices, indptr=C.indptr, shape=np.asarray(C.shape), catchments=np.asarray(catchments, dtype=str))
+    coverage = np.asarray(C.sum(axis=1)).ravel()
+    #-normalize to area-weighted means; catchments outside the grid get an empty row
+    W = sp.diags(np.where(coverage > 0, 1. / np.where(coverage > 0, coverage, 1.), 0.)).dot(C).tocsr()
+    return W, catchments, coverage
+
+def zonalMeans(W, fields):
+    '''
+    Calculates the area-mean of fields for each catchment with one sparse matrix product.
+
+    Input:
+    ------
+        W:      Zonal weight matrix (see catchmentWeights)
+        fields: Array with shape (..., rows, cols), e.g. (lead, y, x) for all lead hours of a run
+
+    Returns:
+    --------
+        means:  Array with shape (catchments, ...) with the area-mean of each field
+    '''
+    fields = np.asarray(fields)
+    lead = fields.shape[:-2]
+    n = int(np.prod(lead))
+    with timer('zonal', n, 'fields'):
+        means = W.dot(fields.reshape(n, -1).T.astype(np.float64))
+    #-catchments that do not cover any cell of the grid
+    means[W.getnnz(axis=1) == 0] = np.nan
+    return means.reshape((W.shape[0],) + lead)
+
+def _runMeansFile(cacheDir, cubeFile, W, catchments):
+    '''
+    Returns the path of the cache file with the catchment means per run of a cube store and zonal weight matrix.
+    '''
+    h = hashlib.sha1(os.path.abspath(cubeFile).encode())
+    for a in [W.data, W.indices, W.indptr]:
+        h.update(np.ascontiguousarray(a).tobytes())
+    h.update('|'.join(catchments).encode())
+    return os.path.join(cacheDir, 'zonal_means_' + h.hexdigest() + '.npz')
+
+def cubeZonalMeans(cubeFile, W, catchments, product, from_date=None, to_date=None, cacheDir=None):
+    '''
+    Calculates the catchment-mean forecasts of all runs and lead hours in a cube store (see cubestore.py), with one sparse matrix product per
+    run. If a cacheDir is given, the catchment means of each run are cached together with the time at which the run was written to the store,
+    so that only the runs that are new or overwritten since the previous call are calculated.
+
+    Input:
+    ------
+        cubeFile:   Full path to the Zarr store (*.zarr)
+        W:          Zonal weight matrix of the grid of the store (see catchmentWeights)
+        catchments: List with the catchment names (rows of W)
+        product:    Name of the MetService product
+
+    Optional Input:
+    ---------------
+        from_date:  Only include forecasts that are valid from this (NZ) timestamp onwards
+        to_date:    Only include forecasts that are valid up to this (NZ) timestamp
+        cacheDir:   Directory where the catchment means per run are cached (None does not cache)
+
+    Returns:
+    --------
+        df:         Dataframe with the columns 'Catchment', 'DateTime of forecast', 'MetService product' and a column per lead hour ('1', '2', ...)
+                    with the catchment-mean forecasted precipitation, ordered by catchment (in the order of catchments) and time
+    '''
+    with xr.open_zarr(cubeFile) as ds:
+        leads = ds['lead'].values
+        runs = pd.DatetimeIndex(ds['run'].values)
+        validTimes = ds['valid_time'].values
+        written = ds['written'].values if 'written' in ds else np.full(len(runs), np.nan)
+        keep = ~pd.isnull(validTimes)
+        if from_date is not None:
+            keep &= validTimes >= np.datetime64(pd.Timestamp(from_date))
+        if to_date is not None:
+            keep &= validTimes <= np.datetime64(pd.Timestamp(to_date))
+        times = pd.DatetimeIndex(np.unique(validTimes[keep]))
+        matrix = newForecastMatrix(len(catchments), len(times), len(leads))
+        catchCodes = np.arange(len(catchments))
+        #-cached catchment means per (run, write time); runs of which the write time is unknown are always calculated
+        cacheFile = _runMeansFile(cacheDir, cubeFile, W, catchments) if cacheDir is not None else None
+        cached = {}
+        if cacheFile is not None and os.path.isfile(cacheFile):
+            with np.load(cacheFile) as cache:
+                cached = dict(zip(zip(cache['runs'].tolist(), cache['written'].tolist()), cache['means']))
+        current = set(zip(runs.asi8.tolist(), written.tolist()))
+        for r in np.argsort(runs.values, kind='stable'):
+            if not keep[r].any():
+                continue
+            key = (int(runs.asi8[r]), float(written[r]))
+            means = cached.get(key)
+            if means is None:
+                means = zonalMeans(W, ds['precipitation'].isel(run=r).values)
+                if np.isfinite(key[1]):
+                    cached[key] = means
+            h = times.get_indexer(validTimes[r])
+            for l in np.flatnonzero(keep[r]):
+                ok = ~np.isnan(means[:, l])
+                addForecasts(matrix, h[l], l, catchCodes[ok], means[ok, l])
+    if cacheFile is not None:
+        #-drop the runs that were overwritten or removed from the store
+        keys = [k for k in cached if k in current]
+        if not os.path.exists(cacheDir):
+            os.makedirs(cacheDir)
+        np.savez(cacheFile, runs=np.asarray([k[0] for k in keys], dtype=np.int64), written=np.asarray([k[1] for k in keys], dtype=np.float64),
+                 means=np.asarray([cached[k] for k in keys]).reshape(len(keys), len(catchments), len(leads)))
+    c, h, wide = toWide(matrix)
+    df = pd.DataFrame(wide, columns=[str(l) for l in leads])
+    df.insert(0, 'Catchment', np.asarray(catchments, dtype=object)[c])
+    df.insert(1, 'DateTime of forecast', times[h])
+    df.insert(2, 'MetService product', product)
+    return df